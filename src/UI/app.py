@@ -2,9 +2,10 @@ from flask import Flask, request, render_template, jsonify, send_file, make_resp
 import boto3
 import json
 import logging
-import zipfile
-import io
 import os
+from botocore.exceptions import ClientError
+from status_cache import StatusCache, FakeStepFunctionsClient, fetch_execution_status, metrics_summary, TERMINAL_STATUSES
+from request_coalescing import RequestCoalescer, S3RequestStore, MemoryRequestStore
 
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
@@ -12,21 +13,67 @@ app = Flask(__name__, static_folder='static', template_folder='templates')
 # AWS Setup
 AWS_REGION = "us-east-1"
 STEP_FUNCTION_ARN = "arn:aws:states:us-east-1:864981724706:stateMachine:ImageEnhancementToPrediction"
+MULTI_SITE_STEP_FUNCTION_ARN = "arn:aws:states:us-east-1:864981724706:stateMachine:MultiSiteBatch"
+SHARDED_STEP_FUNCTION_ARN = "arn:aws:states:us-east-1:864981724706:stateMachine:ShardedLargeAOI"
+TIME_SERIES_STEP_FUNCTION_ARN = "arn:aws:states:us-east-1:864981724706:stateMachine:TimeSeriesChangeDetection"
+MAX_SITES_PER_BATCH = 100
+DEFAULT_DATETIME_RANGE = "2024-07-01/2024-08-31"
+TILE_SIZE_KM = 2.56  # one 256 px acquisition tile at the cube's 10 m resolution
 S3_BUCKET = "satellite-ml-solarp-detection-data"
+RESULTS_ARCHIVE_KEY = "reports/{transaction_id}/{transaction_id}.zip"
 
 # Ensure required AWS environment variables are set
 if not STEP_FUNCTION_ARN or not S3_BUCKET:
     raise ValueError("Missing required AWS environment variables")
 
-stepfunctions = boto3.client("stepfunctions", region_name=AWS_REGION)
+# FAKE_STEPFUNCTIONS=1 runs the UI against a local fake workflow (no AWS calls for /start and /status)
+FAKE_STEPFUNCTIONS = os.getenv("FAKE_STEPFUNCTIONS", "").lower() in ("1", "true", "yes")
+if FAKE_STEPFUNCTIONS:
+    stepfunctions = FakeStepFunctionsClient()
+else:
+    stepfunctions = boto3.client("stepfunctions", region_name=AWS_REGION)
+
+s3_client = boto3.client("s3", region_name=AWS_REGION)
+
+
+# METRICS=1 (as on the stages): /status of a finished execution carries its merged stage metrics
+METRICS_ENABLED = os.getenv("METRICS", "false").lower() in ("1", "true", "yes")
+
+
+def fetch_status_with_metrics(execution_arn):
+    """
+    Execution status, plus the stage metrics of its transaction once it has finished
+    (read once: finished executions stay cached).
+    """
+    status = fetch_execution_status(stepfunctions, execution_arn)
+    if METRICS_ENABLED and status["status"] in TERMINAL_STATUSES and status["transaction_id"] and not FAKE_STEPFUNCTIONS:
+        try:
+            status["metrics"] = metrics_summary(s3_client, S3_BUCKET, status["transaction_id"])
+        except Exception as e:
+            logger.warning(f"Could not read metrics of {status['transaction_id']}: {e}")
+    return status
+
+
+# Execution status is cached per executionArn, so browser polls share Step Functions calls
+status_cache = StatusCache(fetch_status_with_metrics, ttl=float(os.getenv("STATUS_TTL_SECONDS", 2)))
+STATUS_MAX_WAIT_SECONDS = 25  # long poll duration, below the 30 s Lambda timeout
+
+# Identical /start requests share one execution (see request_coalescing.py). The S3 store
+# is shared by every Lambda container; "memory" is the local stand-in.
+REQUEST_STORE = os.getenv("REQUEST_STORE", "memory" if FAKE_STEPFUNCTIONS else "s3")
+request_store = S3RequestStore(s3_client, S3_BUCKET) if REQUEST_STORE == "s3" else MemoryRequestStore()
+coalescer = RequestCoalescer(request_store, status_cache.get)
+COALESCED_MESSAGES = {
+    "started": "Workflow started!",
+    "in_flight": "Identical request already running, following its execution.",
+    "completed": "Identical request completed recently, serving its results.",
+}
 
 # Configure logging
 logging.basicConfig(filename='flask.log', level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())  # Send logs to CloudWatch
 
-s3_client = boto3.client("s3", region_name=AWS_REGION)
-
 
 @app.route("/", methods=["GET", "OPTIONS"])
 def home():
@@ -60,6 +107,10 @@ def start_workflow():
         
         logger.info(f"Received request data: {data}")
 
+        # Multi-site batch: {"sites": [{center_point, ns_distance_km, we_distance_km, name}, ...]}
+        if "sites" in data:
+            return start_batch(data)
+
         center_point = data.get("center_point")
         ns_distance = data.get("ns_distance_km")
         we_distance = data.get("we_distance_km")
@@ -71,18 +122,31 @@ def start_workflow():
             "center_point": center_point,
             "ns_distance_km": int(ns_distance),
             "we_distance_km": int(we_distance),
+            "datetime_range": str(data.get("datetime_range") or DEFAULT_DATETIME_RANGE),
         }
 
-        # Start Step Function Execution
-        response = stepfunctions.start_execution(
-            stateMachineArn=STEP_FUNCTION_ARN,
-            input=json.dumps(input_data)
-        )
-
-        execution_arn = response.get("executionArn")
-        logger.info(f"Step Function started successfully: {execution_arn}")
-
-        return _corsify_response(jsonify({"message": "Workflow started!", "executionArn": execution_arn}))
+        # Large AOIs: acquisition, enhancement and prediction run per shard in parallel
+        state_machine_arn = STEP_FUNCTION_ARN
+        if data.get("sharded"):
+            input_data["sharded"] = True
+            state_machine_arn = SHARDED_STEP_FUNCTION_ARN
+        else:
+            # Small AOIs run in a single fused job (RouteBySize choice of the workflow)
+            input_data["estimated_tiles"] = estimate_tiles(input_data["ns_distance_km"], input_data["we_distance_km"])
+
+        # Time series: one composite per date window and a change report between them
+        datetime_windows = data.get("datetime_windows")
+        if datetime_windows:
+            if not isinstance(datetime_windows, list) or len(datetime_windows) < 2:
+                return jsonify({"error": "Invalid request: 'datetime_windows' must list at least two date ranges."}), 400
+            input_data["datetime_windows"] = [str(window) for window in datetime_windows]
+            input_data.pop("estimated_tiles", None)
+            state_machine_arn = TIME_SERIES_STEP_FUNCTION_ARN
+
+        # Start Step Function Execution (or reuse the one of an identical request)
+        execution_arn, outcome = start_coalesced(state_machine_arn, input_data)
+
+        return _corsify_response(jsonify(coalesced_response(execution_arn, outcome)))
 
     except ValueError:
         logger.error("Invalid data type received")
@@ -98,6 +162,63 @@ def start_workflow():
 
 
 
+def start_batch(data):
+    sites = data.get("sites")
+    if not isinstance(sites, list) or not sites:
+        return jsonify({"error": "Invalid request: 'sites' must be a non-empty list."}), 400
+    if len(sites) > MAX_SITES_PER_BATCH:
+        return jsonify({"error": f"Too many sites: at most {MAX_SITES_PER_BATCH} per batch."}), 400
+
+    input_sites = []
+    for index, site in enumerate(sites):
+        center_point = site.get("center_point") if isinstance(site, dict) else None
+        if not center_point or site.get("ns_distance_km") is None or site.get("we_distance_km") is None:
+            return jsonify({"error": f"Site #{index}: missing required parameters: center_point, ns_distance_km, we_distance_km"}), 400
+        input_sites.append({
+            "name": site.get("name") or f"site_{index:03}",
+            "center_point": center_point,
+            "ns_distance_km": int(site["ns_distance_km"]),
+            "we_distance_km": int(site["we_distance_km"]),
+        })
+
+    input_data = {"sites": input_sites}
+    if data.get("group_margin_km") is not None:
+        input_data["group_margin_km"] = float(data["group_margin_km"])
+
+    execution_arn, outcome = start_coalesced(MULTI_SITE_STEP_FUNCTION_ARN, input_data)
+    result = coalesced_response(execution_arn, outcome)
+    if outcome == "started":
+        result["message"] = "Batch started!"
+
+    return _corsify_response(jsonify(dict(result, sites=len(input_sites))))
+
+
+def estimate_tiles(ns_distance_km, we_distance_km):
+    """Tile count of a request, computed like the acquisition's grid (int(pixels / 256) + 1 per side)."""
+    return (int(ns_distance_km / TILE_SIZE_KM) + 1) * (int(we_distance_km / TILE_SIZE_KM) + 1)
+
+
+def start_coalesced(state_machine_arn, input_data):
+    """Starts an execution, unless an identical request is running or completed recently."""
+    def start():
+        response = stepfunctions.start_execution(stateMachineArn=state_machine_arn, input=json.dumps(input_data))
+        return response.get("executionArn")
+
+    execution_arn, outcome, key = coalescer.submit(state_machine_arn, input_data, start)
+    if outcome == "started":
+        logger.info(f"Step Function started successfully: {execution_arn}")
+    else:
+        logger.info(f"Request {key} coalesced ({outcome}) with {execution_arn}")
+    return execution_arn, outcome
+
+
+def coalesced_response(execution_arn, outcome):
+    result = {"message": COALESCED_MESSAGES[outcome], "executionArn": execution_arn, "coalesced": outcome != "started"}
+    if outcome == "completed":
+        result["transaction_id"] = status_cache.get(execution_arn)["transaction_id"]
+    return result
+
+
 @app.route("/status", methods=["GET"])
 def check_status():
     # No token check anymore - it's public
@@ -110,49 +231,23 @@ def check_status():
         if not execution_arn:
             return jsonify({"error": "Missing executionArn parameter"}), 400
 
-        response = stepfunctions.describe_execution(executionArn=execution_arn)
-        status = response["status"]
+        # Long poll: with wait=<seconds>, answer once the status differs from `since`
+        # (the "version" of the previous answer) or the wait is over
+        wait = min(float(request.args.get("wait", 0)), STATUS_MAX_WAIT_SECONDS)
+        if wait > 0:
+            status = status_cache.wait_for_change(execution_arn, request.args.get("since"), timeout=wait)
+        else:
+            status = status_cache.get(execution_arn)
 
-        # Fetch execution history
-        history_response = stepfunctions.get_execution_history(
-            executionArn=execution_arn, 
-            maxResults=10,  # Get the most recent events
-            reverseOrder=True  # Get newest events first
-        )
+        return jsonify(status)
 
-        events = history_response.get("events", [])
-        
-        # Extract the correct step name
-        current_step = "Unknown"
-        for event in events:
-            if "stateEnteredEventDetails" in event and "name" in event["stateEnteredEventDetails"]:
-                current_step = event["stateEnteredEventDetails"]["name"]
-                break  # Take the most recent step
-
-        # Extract transaction_id from execution output
-        transaction_id = None
-        if "output" in response:
-            try:
-                output_data = json.loads(response["output"])
-                if "Container" in output_data and "Environment" in output_data["Container"]:
-                    for env_var in output_data["Container"]["Environment"]:
-                        if env_var["Name"] == "TRANSACTION_ID":
-                            transaction_id = env_var["Value"]
-                            break
-            except json.JSONDecodeError:
-                pass  # Ignore JSON errors
-
-        return jsonify({
-            "status": status,
-            "current_step": current_step,
-            "transaction_id": transaction_id  # Now always included
-        })
+    except ValueError:
+        return jsonify({"error": "Invalid wait parameter"}), 400
 
     except Exception as e:
         return jsonify({"error": f"Failed to retrieve execution status: {str(e)}"}), 500
 
 
-
 @app.route("/get-report", methods=["GET"])
 def get_report():
     # No token check anymore - it's public
@@ -199,32 +294,15 @@ def download_results():
     if not transaction_id:
         return jsonify({"error": "Missing transaction_id"}), 400
 
-    # List of files to download
-    files = [
-        f"reports/{transaction_id}/overlay.png",
-        f"reports/{transaction_id}/report.html",
-        f"reports/{transaction_id}/input.png",
-        f"reports/{transaction_id}/prediction.png"
-    ]
-
-    # Create an in-memory ZIP file
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for file_key in files:
-            try:
-                obj = s3_client.get_object(Bucket=S3_BUCKET, Key=file_key)
-                zip_file.writestr(os.path.basename(file_key), obj["Body"].read())
-            except Exception as e:
-                logging.error(f"Error adding {file_key} to ZIP: {str(e)}")
-
-    zip_buffer.seek(0)
-
-    #Now we set the filename to transaction_id.zip
-    zip_filename = f"{transaction_id}.zip"
-    
-    # Upload ZIP to S3
-    zip_key = f"reports/{transaction_id}/{zip_filename}"
-    s3_client.put_object(Bucket=S3_BUCKET, Key=zip_key, Body=zip_buffer.getvalue(), ContentType="application/zip")
+    # Built by the report job when the report is sealed (report/results_archive.py)
+    zip_key = RESULTS_ARCHIVE_KEY.format(transaction_id=transaction_id)
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET, Key=zip_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return jsonify({"error": f"No results archive for transaction {transaction_id} (built when its report completes)"}), 404
+        logger.error(f"Error checking results archive: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
     # Generate a pre-signed URL
     presigned_url = s3_client.generate_presigned_url(
@@ -0,0 +1,204 @@
+#
+# Duplicate-request coalescing for /start.
+#
+# A submission is keyed by a hash of its normalized workflow input (center rounded to
+# COALESCE_CENTER_DECIMALS, distances, date range(s), workflow options). The first
+# submission of a key claims it with a create-only write, starts the execution and
+# records its executionArn. A later identical submission then:
+#   - attaches to the execution while it is running ("in_flight"),
+#   - gets the finished execution (and so its report) if it succeeded less than
+#     COALESCE_RECENT_SECONDS ago ("completed"), measured from when it finished
+#     (finished_at: its stop date, recorded the first time it is seen finished),
+#   - otherwise (failed, aborted, expired) takes the key over and starts a new one.
+# A claim whose execution never got recorded (the claimer crashed) is taken over after
+# COALESCE_PENDING_SECONDS; until then identical submissions wait for the executionArn.
+#
+# Stores (same semantics, versions for compare-and-swap):
+#   S3RequestStore     - one JSON record per key under etc/requests/, written with
+#                        If-None-Match / If-Match conditional puts (shared by every
+#                        Lambda container).
+#   MemoryRequestStore - in-process stand-in (local runs, FAKE_STEPFUNCTIONS=1).
+#
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+REQUEST_PREFIX = "etc/requests/"
+COALESCE_CENTER_DECIMALS = int(os.getenv("COALESCE_CENTER_DECIMALS", 4))  # ~11 m
+COALESCE_RECENT_SECONDS = float(os.getenv("COALESCE_RECENT_SECONDS", 24 * 3600))
+COALESCE_PENDING_SECONDS = float(os.getenv("COALESCE_PENDING_SECONDS", 15))
+COALESCE_POLL_SECONDS = 0.2
+
+
+class ConflictError(Exception):
+    """A conditional write lost against a concurrent writer."""
+
+
+def normalize_request(state_machine_arn, input_data):
+    """Canonical form of a workflow submission: center points rounded, keys sorted."""
+    def normalize(value, name=None):
+        if isinstance(value, dict):
+            return {key: normalize(item, key) for key, item in sorted(value.items())}
+        if name == "center_point":
+            return [round(float(coordinate), COALESCE_CENTER_DECIMALS) for coordinate in value]
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        if isinstance(value, float):
+            return round(value, 6)
+        return value
+
+    return {"state_machine": state_machine_arn.rsplit(":", 1)[-1], "input": normalize(input_data)}
+
+
+def request_key(state_machine_arn, input_data):
+    canonical = json.dumps(normalize_request(state_machine_arn, input_data), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+# ------------------------------------------------------------------ stores
+
+class S3RequestStore:
+    """Request records in S3, written with If-Match / If-None-Match conditions."""
+
+    def __init__(self, s3, bucket, prefix=REQUEST_PREFIX):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}{key}.json"
+
+    def get(self, key):
+        """(record, version), None if the key is not claimed."""
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(obj["Body"].read()), obj["ETag"]
+
+    def put(self, key, record, version=None):
+        """Writes a record if the key is still at `version` (None: not claimed); raises ConflictError otherwise."""
+        condition = {"IfMatch": version} if version is not None else {"IfNoneMatch": "*"}
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(record).encode("utf-8"),
+                               ContentType="application/json", **condition)
+        except self.s3.exceptions.ClientError as e:
+            # 412: precondition failed, 409: concurrent conditional write in progress
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                raise ConflictError(key) from e
+            raise
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+class MemoryRequestStore:
+    """In-process store with the same semantics."""
+
+    def __init__(self):
+        self.records = {}  # key -> (record, version)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.records.get(key)
+
+    def put(self, key, record, version=None):
+        with self.lock:
+            current = self.records.get(key)
+            if (current[1] if current else None) != version:
+                raise ConflictError(key)
+            self.records[key] = (dict(record), (version or 0) + 1)
+
+    def delete(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+
+
+# ------------------------------------------------------------------ coalescer
+
+class RequestCoalescer:
+    """
+    Starts each distinct request once. `status_of(execution_arn)` returns the status
+    dict of an execution (the UI's status cache).
+    """
+
+    def __init__(self, store, status_of, recent_seconds=COALESCE_RECENT_SECONDS,
+                 pending_seconds=COALESCE_PENDING_SECONDS, clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.status_of = status_of
+        self.recent_seconds = recent_seconds
+        self.pending_seconds = pending_seconds
+        self.clock = clock
+        self.sleep = sleep
+
+    def submit(self, state_machine_arn, input_data, start):
+        """
+        `start()` starts the execution and returns its executionArn; it runs only if no
+        identical request can be reused. Returns (executionArn, outcome, key), outcome in
+        "started", "in_flight", "completed".
+        """
+        key = request_key(state_machine_arn, input_data)
+        deadline = self.clock() + self.pending_seconds + 5.0
+
+        while self.clock() < deadline:
+            found = self.store.get(key)
+            version = None
+            if found is not None:
+                record, version = found
+                outcome = self._reusable(key, record, version)
+                if outcome:
+                    return record["execution_arn"], outcome, key
+                if not record.get("execution_arn") and self.clock() - record["claimed_at"] < self.pending_seconds:
+                    self.sleep(COALESCE_POLL_SECONDS)  # claimed, execution starting
+                    continue
+
+            # Unclaimed, or a failed / expired / abandoned request: claim it
+            claim = {"claimed_at": self.clock(), "execution_arn": None, "request": normalize_request(state_machine_arn, input_data)}
+            try:
+                self.store.put(key, claim, version)
+            except ConflictError:
+                continue  # somebody else claimed it first, use theirs
+            return self._start(key, claim, start), "started", key
+
+        raise ConflictError(f"Request {key} is still being claimed")
+
+    def _start(self, key, claim, start):
+        try:
+            execution_arn = start()
+        except Exception:
+            self.store.delete(key)
+            raise
+        found = self.store.get(key)
+        if found is not None and found[0]["claimed_at"] == claim["claimed_at"]:
+            try:
+                self.store.put(key, dict(claim, execution_arn=execution_arn, started_at=self.clock()), found[1])
+            except ConflictError:
+                pass  # taken over meanwhile (claim thought abandoned): the other execution serves the key
+        return execution_arn
+
+    def _reusable(self, key, record, version):
+        """"in_flight" / "completed" if the recorded execution can serve the request, else None."""
+        execution_arn = record.get("execution_arn")
+        if not execution_arn:
+            return None
+        status = self.status_of(execution_arn)
+        if status["status"] == "RUNNING":
+            return "in_flight"
+        if status["status"] != "SUCCEEDED":
+            return None
+
+        # Recency counts from the end of the run (its stop date, else the first time it is seen finished)
+        finished_at = record.get("finished_at")
+        if finished_at is None:
+            finished_at = status.get("finished_at") or self.clock()
+            try:
+                self.store.put(key, dict(record, finished_at=finished_at), version)
+            except ConflictError:
+                pass  # updated or taken over meanwhile: the next submission reads the new record
+        if self.clock() - finished_at < self.recent_seconds:
+            return "completed"
+        return None
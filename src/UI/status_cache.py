@@ -0,0 +1,318 @@
+#
+# Cached Step Functions status for the UI. Each execution's status is fetched from
+# Step Functions at most once per TTL, and concurrent polls of the same executionArn
+# share a single upstream call. Finished executions are cached until evicted.
+# If an upstream call fails (e.g. throttling), the last known status is served and
+# counts as fresh for another TTL (an execution with none re-raises the error for a TTL),
+# so a throttled or unavailable Step Functions still sees one call per TTL.
+#
+# metrics_summary() merges the per-stage metrics of a transaction (metrics/{tid}/*.json,
+# written by the stages when METRICS=1) for the /status answer.
+#
+# FakeStepFunctionsClient is a local stand-in for the boto3 client. It walks an
+# execution through the workflow states on a timer, for running the UI and exercising
+# the cache without AWS (FAKE_STEPFUNCTIONS=1 in app.py).
+#
+
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+STATUS_TTL_SECONDS = 2.0
+MAX_CACHED_EXECUTIONS = 1024
+
+TERMINAL_STATUSES = {"SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED"}
+
+
+def _transaction_id_from(document):
+    """TRANSACTION_ID of a Batch job result (execution output) or of a state input holding one."""
+    try:
+        data = json.loads(document)
+    except (TypeError, json.JSONDecodeError):
+        return None  # Ignore JSON errors
+
+    if isinstance(data, dict) and "acquisition_result" in data:
+        data = data["acquisition_result"]
+    if not isinstance(data, dict):
+        return None
+
+    for env_var in data.get("Container", {}).get("Environment", []):
+        if env_var.get("Name") == "TRANSACTION_ID":
+            return env_var.get("Value")
+    return None
+
+
+def fetch_execution_status(stepfunctions, execution_arn):
+    """One upstream read: status, most recent step and transaction ID of an execution."""
+    response = stepfunctions.describe_execution(executionArn=execution_arn)
+    status = response["status"]
+
+    # Fetch execution history
+    history_response = stepfunctions.get_execution_history(
+        executionArn=execution_arn,
+        maxResults=10,  # Get the most recent events
+        reverseOrder=True  # Get newest events first
+    )
+    events = history_response.get("events", [])
+
+    # Extract the correct step name
+    current_step = "Unknown"
+    for event in events:
+        if "stateEnteredEventDetails" in event and "name" in event["stateEnteredEventDetails"]:
+            current_step = event["stateEnteredEventDetails"]["name"]
+            break  # Take the most recent step
+
+    # Extract transaction_id from execution output, or while running from the input
+    # of the latest state (the report is published incrementally during prediction)
+    transaction_id = None
+    if "output" in response:
+        transaction_id = _transaction_id_from(response["output"])
+    for event in events:
+        if transaction_id:
+            break
+        if "stateEnteredEventDetails" in event and "input" in event["stateEnteredEventDetails"]:
+            transaction_id = _transaction_id_from(event["stateEnteredEventDetails"]["input"])
+
+    result = {
+        "status": status,
+        "current_step": current_step,
+        "transaction_id": transaction_id,
+        "version": f"{status}:{current_step}:{transaction_id or ''}",
+    }
+    if response.get("stopDate"):
+        result["finished_at"] = response["stopDate"].timestamp()
+
+    # Multi-site batches end with the per-site transactions (one report each)
+    sites = _sites_from(response.get("output"))
+    if sites is not None:
+        result["sites"] = sites
+    return result
+
+
+def _sites_from(document):
+    """Per-site transactions of a multi-site batch output, None for single-site executions."""
+    try:
+        data = json.loads(document)
+    except (TypeError, json.JSONDecodeError):
+        return None
+    if isinstance(data, dict) and isinstance(data.get("sites"), list):
+        return data["sites"]
+    return None
+
+
+def metrics_summary(s3, bucket, transaction_id):
+    """
+    Per-stage summaries of a transaction (metrics/{tid}/{stage}[.{part}].json) and their
+    totals: span times and counters summed, largest peak RSS. None if nothing was recorded.
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = [obj["Key"] for page in paginator.paginate(Bucket=bucket, Prefix=f"metrics/{transaction_id}/")
+            for obj in page.get("Contents", []) if obj["Key"].endswith(".json")]
+    if not keys:
+        return None
+
+    stages, spans, counters, peak_rss_mb = {}, {}, {}, 0.0
+    for key in sorted(keys):
+        summary = json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+        stages[key.rsplit("/", 1)[-1][:-len(".json")]] = summary
+        peak_rss_mb = max(peak_rss_mb, summary.get("peak_rss_mb", 0.0))
+        for name, value in summary.get("counters", {}).items():
+            counters[name] = counters.get(name, 0) + value
+        for name, span in summary.get("spans", {}).items():
+            total = spans.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            total["count"] += span["count"]
+            total["seconds"] = round(total["seconds"] + span["seconds"], 3)
+            total["max_seconds"] = max(total["max_seconds"], span["max_seconds"])
+
+    return {"stages": stages, "spans": spans, "counters": counters, "peak_rss_mb": peak_rss_mb}
+
+
+class _Flight:
+    """An upstream call in progress; concurrent callers wait on it instead of calling again."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StatusCache:
+    """
+    Per-executionArn status cache with a TTL and single-flight upstream calls.
+    `fetch(execution_arn)` returns the status dict of one execution.
+    """
+
+    def __init__(self, fetch, ttl=STATUS_TTL_SECONDS, max_entries=MAX_CACHED_EXECUTIONS, clock=time.monotonic):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()  # arn -> (fetched_at, status)
+        self.flights = {}             # arn -> _Flight
+        self.failures = OrderedDict() # arn -> (failed_at, error), executions without a known status
+        self.lock = threading.Lock()
+        self.upstream_calls = 0
+
+    def _fresh(self, entry):
+        fetched_at, status = entry
+        return status["status"] in TERMINAL_STATUSES or self.clock() - fetched_at < self.ttl
+
+    def get(self, execution_arn):
+        """Cached status of an execution, fetched upstream at most once per TTL."""
+        with self.lock:
+            entry = self.entries.get(execution_arn)
+            if entry is not None and self._fresh(entry):
+                self.entries.move_to_end(execution_arn)
+                return entry[1]
+            failure = self.failures.get(execution_arn)
+            if entry is None and failure is not None and self.clock() - failure[0] < self.ttl:
+                raise failure[1]
+
+            flight = self.flights.get(execution_arn)
+            leader = flight is None
+            if leader:
+                flight = self.flights[execution_arn] = _Flight()
+                self.upstream_calls += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self.fetch(execution_arn)
+        except Exception as e:
+            # Serve the last known status rather than failing every poll
+            if entry is not None:
+                flight.result = entry[1]
+            else:
+                flight.error = e
+        finally:
+            with self.lock:
+                if flight.error is None:
+                    # A stale status served after an error is fresh again for one TTL
+                    self.entries[execution_arn] = (self.clock(), flight.result)
+                    self.entries.move_to_end(execution_arn)
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                    self.failures.pop(execution_arn, None)
+                else:
+                    self.failures[execution_arn] = (self.clock(), flight.error)
+                    self.failures.move_to_end(execution_arn)
+                    while len(self.failures) > self.max_entries:
+                        self.failures.popitem(last=False)
+                del self.flights[execution_arn]
+            flight.done.set()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def wait_for_change(self, execution_arn, known_version=None, timeout=20.0, sleep=time.sleep):
+        """
+        Long poll: returns the status as soon as its version differs from `known_version`,
+        the execution is finished, or `timeout` seconds have passed. Polls the cache, so
+        upstream calls stay at one per TTL however many clients wait.
+        """
+        deadline = self.clock() + timeout
+        while True:
+            status = self.get(execution_arn)
+            if status["version"] != known_version or status["status"] in TERMINAL_STATUSES:
+                return status
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return status
+            sleep(min(self.ttl, remaining))
+
+
+class FakeStepFunctionsClient:
+    """
+    In-memory stand-in for the boto3 Step Functions client (the calls used by the UI).
+    Every execution enters one state of `steps` every `step_seconds` and succeeds after
+    the last one, with a Batch-like output holding its TRANSACTION_ID.
+    """
+
+    DEFAULT_STEPS = ("RunBDC_Acquisition", "RunImageEnhancementJob", "RunPredictionAndReport")
+
+    def __init__(self, steps=DEFAULT_STEPS, step_seconds=5.0, clock=time.monotonic):
+        self.steps = list(steps)
+        self.step_seconds = step_seconds
+        self.clock = clock
+        self.executions = {}
+        self.calls = {"start_execution": 0, "describe_execution": 0, "get_execution_history": 0}
+        self.lock = threading.Lock()
+
+    def start_execution(self, stateMachineArn, input="{}", name=None):
+        with self.lock:
+            self.calls["start_execution"] += 1
+            name = name or uuid.uuid4().hex
+            execution_arn = f"{stateMachineArn.replace(':stateMachine:', ':execution:')}:{name}"
+            transaction_id = f"{len(self.executions) + 1:06d}-{time.strftime('%Y-%m-%d')}"
+            self.executions[execution_arn] = {"started": self.clock(), "input": input, "transaction_id": transaction_id}
+        return {"executionArn": execution_arn, "startDate": time.time()}
+
+    def _progress(self, execution_arn):
+        execution = self.executions[execution_arn]
+        entered = int((self.clock() - execution["started"]) // self.step_seconds) + 1
+        return execution, min(entered, len(self.steps)), entered > len(self.steps)
+
+    def _batch_result(self, transaction_id):
+        return json.dumps({"Container": {"Environment": [{"Name": "TRANSACTION_ID", "Value": transaction_id}]}})
+
+    def describe_execution(self, executionArn):
+        with self.lock:
+            self.calls["describe_execution"] += 1
+            execution, _, finished = self._progress(executionArn)
+
+        response = {"executionArn": executionArn, "status": "SUCCEEDED" if finished else "RUNNING", "input": execution["input"]}
+        if finished:
+            response["output"] = self._batch_result(execution["transaction_id"])
+        return response
+
+    def get_execution_history(self, executionArn, maxResults=100, reverseOrder=False):
+        with self.lock:
+            self.calls["get_execution_history"] += 1
+            execution, entered, _ = self._progress(executionArn)
+
+        events = []
+        for index, step in enumerate(self.steps[:entered]):
+            # States after the first get the previous Batch result as input, like the real workflow
+            state_input = execution["input"] if index == 0 else json.dumps(
+                {"acquisition_result": json.loads(self._batch_result(execution["transaction_id"]))})
+            events.append({
+                "id": index + 1,
+                "type": "TaskStateEntered",
+                "stateEnteredEventDetails": {"name": step, "input": state_input},
+            })
+
+        if reverseOrder:
+            events.reverse()
+        return {"events": events[:maxResults]}
+
+
+if __name__ == "__main__":
+    # Many concurrent pollers of one execution against the fake client
+    from concurrent.futures import ThreadPoolExecutor
+
+    fake = FakeStepFunctionsClient(step_seconds=1.0)
+    cache = StatusCache(lambda arn: fetch_execution_status(fake, arn), ttl=0.5)
+    arn = fake.start_execution(stateMachineArn="arn:aws:states:us-east-1:000000000000:stateMachine:Local")["executionArn"]
+
+    def poll(_):
+        steps = []
+        status = {"version": None, "status": "RUNNING"}
+        while status["status"] not in TERMINAL_STATUSES:
+            status = cache.wait_for_change(arn, status["version"], timeout=5)
+            steps.append(status["current_step"])
+        return steps
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        results = list(pool.map(poll, range(50)))
+
+    print(f"50 long-polling clients followed {len(set(map(tuple, results)))} distinct step sequence(s) "
+          f"in {time.monotonic() - start:.1f} s: {results[0]}")
+    print(f"Upstream calls: {fake.calls} (cache misses: {cache.upstream_calls})")
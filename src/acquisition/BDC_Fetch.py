@@ -4,12 +4,10 @@ import boto3
 
 import math
 import numpy as np
-import numpy.ma as ma
 
 from datetime import datetime
 import os
-
-from io import BytesIO
+import sys
 
 import time
 
@@ -24,11 +22,19 @@ from rasterio.mask import mask
 from rasterio.windows import Window, transform as window_transform
 from rasterio.windows import from_bounds
 from geopy.distance import geodesic
+from concurrent.futures import ThreadPoolExecutor
+
+from id_allocator import S3CounterStore, make_allocator
+import multi_site
+import sharding
+import global_grid
+import metrics
+from compositing import sub_image_pixels, compute_median_band, extract_tile, encode_tile
 
 # -------------------
 
 # AWS S3 Client
-s3 = boto3.client('s3')
+s3 = metrics.watch_s3(boto3.client('s3'))
 #batch_client = boto3.client('batch')
 stepfunctions_client = boto3.client('stepfunctions')
 
@@ -37,8 +43,20 @@ stepfunctions_client = boto3.client('stepfunctions')
 S3_BUCKET = "satellite-ml-solarp-detection-data"
 COUNTER_FILE = "etc/transaction_counter.txt"
 
+# Transaction ID allocation: "block" (default), "counter" or "time" (see id_allocator.py)
+ID_ALLOCATOR = os.getenv("ID_ALLOCATOR", "block")
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", 16))
+id_allocator = make_allocator(ID_ALLOCATOR, S3CounterStore(s3, S3_BUCKET, COUNTER_FILE), ID_BLOCK_SIZE)
+
 # General variables
-sub_image_pixels = 256  # input images' size
+BDC_STAC_URL = "https://data.inpe.br/bdc/stac/v1/"
+COLLECTION = "S2-16D-2"
+DEFAULT_DATETIME_RANGE = "2024-07-01/2024-08-31"
+BANDS = ['B04', 'B03', 'B02', 'B08']  # red, green, blue, NIR
+
+# "request": tile grid relative to each request's extended bbox (default).
+# "global": tiles snapped to the global cell grid and cached under cells/ (see global_grid.py).
+TILING_MODE = os.getenv("TILING_MODE", "request")
 
 def lambda_handler(event, context):
     """
@@ -47,6 +65,22 @@ def lambda_handler(event, context):
     and triggers a Step Function to continue the workflow.
     """
 
+    # Steps of multi-site and sharded workflows that run after the compute environment is provisioned
+    if 'fan_out_batch' in event:
+        return fan_out_handler(event)
+    if 'shard' in event:
+        return shard_handler(event['shard'])
+    if 'merge_shards' in event:
+        return merge_shards_handler(event)
+    if 'publish_cells' in event:
+        return publish_cells_handler(event)
+    # Transaction ID of a request run by the fused single-process pipeline (see fused/fused_pipeline.py).
+    # Global tiling needs the cell cache and PublishCells, so those requests take the stage-per-job path
+    if event.get('allocate_transaction_id'):
+        if TILING_MODE == 'global':
+            return {"run_fused": False}
+        return {"run_fused": True, "transaction_id": ID_Gen()}
+
     # ---
     # Start provisioning the compute environment for the following Batch Jobs in the workflow
     batch = boto3.client('batch')
@@ -59,11 +93,20 @@ def lambda_handler(event, context):
     # ---
 
 
+    # Multi-site batches (see multi_site.py), sharded large AOIs (see sharding.py), time series
+    if 'sites' in event:
+        return multi_site_handler(event)
+    if event.get('sharded'):
+        return plan_shards_handler(event)
+    if 'datetime_windows' in event:
+        return time_series_handler(event)
+
     start_time = time.time()
     print("Lambda execution started...")
 
     # Extract parameters from API Gateway request
     transaction_ID = ID_Gen()
+    metrics.start("acquisition", transaction_ID)
     
 
     try:
@@ -98,13 +141,14 @@ def lambda_handler(event, context):
         bbox = (original_bb_west, original_bb_south, original_bb_east, original_bb_north)
 
         # Step 2 - Define original bbox
-        item_search = service.search(
-            bbox=bbox, 
-            datetime=datetime_range, 
-            collections=["S2-16D-2"]
-        )
-        
-        items_list = list(item_search.items())
+        with metrics.span("stac_search"):
+            item_search = service.search(
+                bbox=bbox, 
+                datetime=datetime_range, 
+                collections=["S2-16D-2"]
+            )
+            
+            items_list = list(item_search.items())
         print("Image fetching took:", time.time() - fetch_start, "seconds")
 
 
@@ -115,6 +159,11 @@ def lambda_handler(event, context):
         if not items_list:
             return {"statusCode": 404, "body": json.dumps("No images found for the given parameters.")}
 
+        # Global tiling: tiles snapped to the cell grid (see global_grid.py), reused across transactions
+        if event.get('tiling', TILING_MODE) == 'global':
+            acquire_cells(transaction_ID, items_list, bbox, datetime_range)
+            return start_workflow(transaction_ID, start_time)
+
         # Extract one image (example with Red band)
         red_data_list, red_transforms, red_crs_list = read_multiple_items(items_list, 'B04', bbox)
         median_red = compute_median_band(red_data_list)
@@ -172,107 +221,459 @@ def lambda_handler(event, context):
             rows_start = time.time()
             for i in range(nb_rows):
 
-                # Define slice bounds
+                # Extract tile (edge tiles padded with nodata to full size)
                 row_start = i * sub_image_pixels
-                row_end = row_start + sub_image_pixels
                 col_start = j * sub_image_pixels
-                col_end = col_start + sub_image_pixels
-
-                # Extract tile
-                red_tile = median_red_filled[row_start:row_end, col_start:col_end]
-                green_tile = median_green_filled[row_start:row_end, col_start:col_end]
-                blue_tile = median_blue_filled[row_start:row_end, col_start:col_end]
-                nir_tile = median_nir_filled[row_start:row_end, col_start:col_end]
+                stacked_tile = extract_tile([median_red_filled, median_green_filled, median_blue_filled, median_nir_filled], row_start, col_start, nodata_value)
 
                 # Compute correct transform for this tile
                 tile_window = Window(col_start, row_start, sub_image_pixels, sub_image_pixels)
                 tile_transform = rasterio.windows.transform(tile_window, reference_transform)
 
-                stacked_tile = np.stack([red_tile, green_tile, blue_tile, nir_tile])
-
                 # Save directly to S3
                 s3_key = save_tile_to_s3(S3_BUCKET, transaction_ID, i, j, stacked_tile, reference_crs, tile_transform, nodata_value)
             print(f"Row #{i} images extracted and saved:", time.time() - rows_start, "seconds")
         print(f"Loop (cols {j} and rows{i} finished: ", time.time() - grid_start, "seconds")
 
-        total_duration = time.time() - start_time
+        return start_workflow(transaction_ID, start_time)
+         
+            
+    except Exception as e:
+        print("Error occurred:", traceback.format_exc())  # Logs the full error
+        return {"statusCode": 500, "body": json.dumps(str(e))}
+
+    finally:
+        metrics.finish(s3, S3_BUCKET)
 
-        print(f"Lambda completed execution in {total_duration:.2f} seconds.")
+    
 
-        print(f"Images saved to S3 under transaction_id: {transaction_ID}")
 
-        # Prepare input for Step Function
-        step_function_input = {
-            "transaction_id": transaction_ID
-        }
+def start_workflow(transaction_ID, start_time):
+
+    """Starts the Step Function of an acquired transaction."""
+
+    total_duration = time.time() - start_time
+
+    print(f"Lambda completed execution in {total_duration:.2f} seconds.")
+
+    print(f"Images saved to S3 under transaction_id: {transaction_ID}")
+
+    # Prepare input for Step Function
+    step_function_input = {
+        "transaction_id": transaction_ID
+    }
+
+    # Start the Step Function Execution (identical requests are coalesced at /start, see UI/request_coalescing.py)
+    print(f"Starting Step Function for transaction: {transaction_ID}")
+    response = stepfunctions_client.start_execution(
+        stateMachineArn="arn:aws:states:us-east-1:864981724706:stateMachine:ImageEnhancementToPrediction",
+        input=json.dumps(step_function_input)
+    )
+
+    print(f"Step Function started with executionArn: {response['executionArn']}")
+
+    return {
+        "transaction_id": transaction_ID
+    }
 
-        # Check for duplicate execution
-        running_executions = stepfunctions_client.list_executions(
-            stateMachineArn="arn:aws:states:us-east-1:864981724706:stateMachine:ImageEnhancementToPrediction",
-            statusFilter="RUNNING"
+
+
+def acquire_cells(transaction_ID, items_list, bbox, datetime_range, read_cache=None):
+    """
+    Acquires the global-grid cells covering a bbox. Cells already in the cell cache are
+    copied into the transaction (with their cached enhancement/prediction results);
+    the others are read from the COGs in one read and written to both the transaction
+    and the cache. acquisition/{tid}/cells.json records the cell of each tile.
+    """
+    with rasterio.open(items_list[0].assets[BANDS[0]].href) as dataset:
+        grid = global_grid.GlobalGrid.from_dataset(dataset, sub_image_pixels)
+
+    namespace = global_grid.cache_namespace(COLLECTION, datetime_range)
+    tiles = global_grid.transaction_tiles(transaction_ID, grid.cells_covering(bbox))
+    cached = global_grid.cached_cells(s3, S3_BUCKET, namespace, [row for row, _ in tiles.values()])
+    missing = {name: cell for name, cell in tiles.items() if 'acquisition' not in cached.get(cell, ())}
+    row0 = min(row for row, _ in tiles.values())
+    col0 = min(col for _, col in tiles.values())
+    print(f"{len(tiles)} cells cover the bbox: {len(tiles) - len(missing)} cached, {len(missing)} to acquire")
+    metrics.count("cell_cache_hits", len(tiles) - len(missing))
+    metrics.count("cell_cache_misses", len(missing))
+
+    nodata_value = -9999.0
+    if missing:
+        # One read per item and band over the missing cells
+        bounds = [grid.cell_bounds(*cell) for cell in missing.values()]
+        union = (min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds))
+        with ThreadPoolExecutor(max_workers=len(BANDS)) as pool:
+            reads = list(pool.map(lambda band: read_shard_band([item.assets[band].href for item in items_list], union, grid.crs, read_cache), BANDS))
+        medians = [compute_median_band(data_list).filled(nodata_value).astype('float32') for data_list, _ in reads]
+        top_row, left_col = grid.cell_at(union[0] + grid.resolution / 2, union[3] - grid.resolution / 2)
+
+    def save_cell(item):
+        name, (row, col) = item
+        row_start = (row - top_row) * sub_image_pixels
+        col_start = (col - left_col) * sub_image_pixels
+        stacked_tile = extract_tile(medians, row_start, col_start, nodata_value)
+        s3_key = save_tile_to_s3(S3_BUCKET, transaction_ID, row - row0, col - col0, stacked_tile, CRS.from_string(grid.crs), grid.cell_transform(row, col), nodata_value)
+        s3.copy_object(Bucket=S3_BUCKET, Key=global_grid.cell_key(namespace, row, col, 'acquisition'),
+                       CopySource={"Bucket": S3_BUCKET, "Key": s3_key})
+
+    def copy_cached(item):
+        name, (row, col) = item
+        for stage in cached[(row, col)]:
+            s3.copy_object(Bucket=S3_BUCKET, Key=f"{stage}/{transaction_ID}/{name}",
+                           CopySource={"Bucket": S3_BUCKET, "Key": global_grid.cell_key(namespace, row, col, stage)})
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(save_cell, missing.items()))
+        list(pool.map(copy_cached, [item for item in tiles.items() if item[0] not in missing]))
+
+    manifest = {
+        "grid": grid.to_dict(),
+        "namespace": namespace,
+        "tiles": {
+            name: {"cell": global_grid.cell_id(row, col), "row": row, "col": col,
+                   "cached": sorted(cached.get((row, col), ())) if name not in missing else []}
+            for name, (row, col) in tiles.items()
+        },
+    }
+    s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=f"acquisition/{transaction_ID}/{global_grid.CELLS_MANIFEST}",
+        Body=json.dumps(manifest).encode("utf-8"),
+        ContentType="application/json"
+    )
+    return manifest
+
+
+
+def publish_cells_handler(event):
+    """Publishes the newly computed cell results of transactions (comma separated) to the cell cache."""
+    transaction_IDs = [transaction_ID for transaction_ID in event['publish_cells'].split(',') if transaction_ID]
+    published = sum(global_grid.publish_cells(s3, S3_BUCKET, transaction_ID) for transaction_ID in transaction_IDs)
+    return {"transaction_ids": transaction_IDs, "published": published}
+
+
+
+def time_series_handler(event):
+    """
+    Acquires one composite per date window (event 'datetime_windows') on the global
+    cell grid, from a single STAC search over the whole span. Each window is its own
+    transaction, cached per window in the cell cache, so windows processed before are
+    copied rather than recomputed. reports/{series_id}/series.json lists the windows
+    for the change report.
+    """
+    start_time = time.time()
+
+    try:
+        site = multi_site.normalize_site(event)
+        windows = event.get('datetime_windows') or []
+        if len(windows) < 2:
+            raise ValueError("Invalid 'datetime_windows'. Expected at least two 'YYYY-MM-DD/YYYY-MM-DD' ranges")
+        windows = sorted(windows)
+        bbox = multi_site.site_bbox(site)
+
+        # One search over the whole span; items are then assigned to the windows they overlap
+        span = f"{min(w.split('/')[0] for w in windows)}/{max(w.split('/')[1] for w in windows)}"
+        series_id = ID_Gen()
+        metrics.start("acquisition", series_id)
+        service = pystac_client.Client.open(BDC_STAC_URL)
+        with metrics.span("stac_search"):
+            items_list = list(service.search(bbox=bbox, datetime=span, collections=[COLLECTION]).items())
+        print(f"{len(items_list)} items found for {span}")
+
+        read_cache = {}
+        results = []
+        window_items = [[item for item in items_list if item_overlaps(item, window)] for window in windows]
+        for index, window in enumerate(windows):
+            if not window_items[index]:
+                results.append({"datetime_range": window, "error": "No images found"})
+                continue
+            transaction_ID = ID_Gen()
+            with metrics.span("acquire_window", transaction_id=transaction_ID):
+                acquire_cells(transaction_ID, window_items[index], bbox, window, read_cache)
+            results.append({"datetime_range": window, "transaction_id": transaction_ID, "items": len(window_items[index])})
+
+            # Keep only the reads of items that later (overlapping) windows use again
+            later = {item.assets[band].href for items in window_items[index + 1:] for item in items for band in BANDS}
+            for key in [key for key in read_cache if key[0] not in later]:
+                del read_cache[key]
+
+        s3.put_object(
+            Bucket=S3_BUCKET,
+            Key=f"reports/{series_id}/series.json",
+            Body=json.dumps({"series_id": series_id, "site": site, "windows": results}).encode("utf-8"),
+            ContentType="application/json"
         )
+        print(f"Time series {series_id}: {len(windows)} windows acquired in {time.time() - start_time:.2f} seconds")
 
-        for execution in running_executions.get("executions", []):
-            execution_arn = execution["executionArn"]
+        acquired = [window for window in results if "transaction_id" in window]
+        return {
+            "series_id": series_id,
+            "transaction_ids": ",".join(window["transaction_id"] for window in acquired),
+            "windows": acquired,
+        }
 
-            # Get execution details
-            execution_details = stepfunctions_client.get_execution_history(
-                executionArn=execution_arn,
-                maxResults=1
-            )
+    except Exception as e:
+        print("Error occurred:", traceback.format_exc())  # Logs the full error
+        return {"statusCode": 500, "body": json.dumps(str(e))}
+
+    finally:
+        metrics.finish(s3, S3_BUCKET)
 
-            # Check the first event for transaction_id
-            if execution_details["events"]:
-                event_input = json.loads(execution_details["events"][0]["executionStartedEventDetails"]["input"])
-                if event_input.get("transaction_id") == transaction_ID:
-                    print(f"Execution already running for transaction {transaction_ID}. Skipping duplicate trigger.")
-                    return {"statusCode": 200, "body": json.dumps({"message": "Execution already in progress."})}
 
-        print(f"No duplicate execution found. Starting Step Function for transaction {transaction_ID}.")
 
-        # Start the Step Function Execution
-        print(f"Starting Step Function for transaction: {transaction_ID}")
-        response = stepfunctions_client.start_execution(
-            stateMachineArn="arn:aws:states:us-east-1:864981724706:stateMachine:ImageEnhancementToPrediction",
-            input=json.dumps(step_function_input)
+# True if a STAC item's time span (start/end_datetime, or datetime) overlaps a "start/end" window
+def item_overlaps(item, window):
+    properties = item.properties
+    item_start = (properties.get('start_datetime') or properties.get('datetime'))[:10]
+    item_end = (properties.get('end_datetime') or properties.get('datetime'))[:10]
+    window_start, window_end = window.split('/')
+    return item_start <= window_end and item_end >= window_start
+
+
+
+def multi_site_handler(event):
+    """
+    Acquires a batch of sites. Overlapping/nearby sites are grouped and each group is
+    acquired once (one STAC search, one read per item and band); the tiles go to one
+    transaction per group. Returns the group transactions (comma separated, for the
+    enhancement and prediction jobs) and the per-site transactions (for the reports).
+    """
+    start_time = time.time()
+
+    try:
+        sites = [multi_site.normalize_site(site, index) for index, site in enumerate(event.get('sites') or [])]
+        if not sites:
+            raise ValueError("Invalid or missing 'sites'. Expected a list of {center_point, ns_distance_km, we_distance_km}")
+        datetime_range = event.get('datetime_range', DEFAULT_DATETIME_RANGE)
+        margin_km = float(event.get('group_margin_km', multi_site.GROUP_MARGIN_KM))
+
+        batch_id = ID_Gen()
+        metrics.start("acquisition", batch_id)
+        for site in sites:
+            site['transaction_id'] = ID_Gen()
+            site['bbox'] = multi_site.site_bbox(site)
+
+        groups = multi_site.group_sites(sites, margin_km)
+        print(f"Batch {batch_id}: {len(sites)} sites in {len(groups)} acquisition groups")
+
+        service = pystac_client.Client.open(BDC_STAC_URL)
+        manifest = {"batch_id": batch_id, "datetime_range": datetime_range, "groups": [], "sites": sites}
+        for group in groups:
+            with metrics.span("acquire_group", sites=len(group)):
+                manifest["groups"].append(acquire_group(service, [sites[i] for i in group], datetime_range))
+
+        s3.put_object(
+            Bucket=S3_BUCKET,
+            Key=multi_site.MANIFEST_KEY.format(batch_id=batch_id),
+            Body=json.dumps(manifest).encode("utf-8"),
+            ContentType="application/json"
         )
 
-        print(f"Step Function started with executionArn: {response['executionArn']}")
+        print(f"Batch acquisition completed in {time.time() - start_time:.2f} seconds.")
+
+        acquired = [group["transaction_id"] for group in manifest["groups"] if not group.get("error")]
+        if not acquired:
+            return {"statusCode": 404, "body": json.dumps("No images found for the given sites.")}
 
         return {
-            "transaction_id": transaction_ID
+            "batch_id": batch_id,
+            "transaction_ids": ",".join(acquired),
+            "sites": [
+                {"name": site["name"], "transaction_id": site["transaction_id"]}
+                for site in sites if not site.get("error")
+            ],
         }
-         
-            
+
     except Exception as e:
         print("Error occurred:", traceback.format_exc())  # Logs the full error
         return {"statusCode": 500, "body": json.dumps(str(e))}
 
-    
+    finally:
+        metrics.finish(s3, S3_BUCKET)
 
 
-def ID_Gen():
-    
-    """Reads, increments, and updates a counter in S3, returning it in the format: NNNNNN-YYYY-MM-DD"""
-    
+
+def acquire_group(service, sites, datetime_range):
+    """
+    Acquires the union of the sites' bboxes once and saves the tiles needed by at least
+    one site. Fills each site's group and tile window; returns the group's entry.
+    """
+    group_start = time.time()
+    transaction_ID = ID_Gen()
+    bbox = multi_site.union_bbox(site['bbox'] for site in sites)
+    group = {"transaction_id": transaction_ID, "sites": [site['name'] for site in sites], "bbox": bbox}
+
+    with metrics.span("stac_search"):
+        items_list = list(service.search(bbox=bbox, datetime=datetime_range, collections=[COLLECTION]).items())
+    if not items_list:
+        print(f"No images found for group {transaction_ID}: {group['sites']}")
+        for site in sites:
+            site['error'] = "No images found"
+        group['error'] = "No images found"
+        return group
+
+    bbox = extend_by_half_tile(items_list[0], bbox)
+
+    # One windowed read per item and band for the whole group
+    with ThreadPoolExecutor(max_workers=len(BANDS)) as pool:
+        reads = list(pool.map(lambda band: read_multiple_items(items_list, band, bbox), BANDS))
+
+    nodata_value = -9999.0
+    medians = [compute_median_band(data_list).filled(nodata_value).astype('float32') for data_list, _, _ in reads]
+    reference_transform = reads[0][1][0]
+    reference_crs = reads[0][2][0]
+    mosaic_shape = medians[0].shape
+
+    # Tile windows of the sites in the group grid; shared tiles are saved once
+    needed = set()
+    for site in sites:
+        row0, col0, rows, cols = multi_site.site_tile_window(
+            site['bbox'], reference_transform, reference_crs, mosaic_shape, sub_image_pixels)
+        site.update(group=transaction_ID, row0=row0, col0=col0, rows=rows, cols=cols)
+        needed.update(multi_site.window_tiles((row0, col0, rows, cols)))
+
+    def save_tile(tile):
+        i, j = tile
+        row_start, col_start = i * sub_image_pixels, j * sub_image_pixels
+        stacked_tile = extract_tile(medians, row_start, col_start, nodata_value)
+        tile_window = Window(col_start, row_start, sub_image_pixels, sub_image_pixels)
+        tile_transform = rasterio.windows.transform(tile_window, reference_transform)
+        return save_tile_to_s3(S3_BUCKET, transaction_ID, i, j, stacked_tile, reference_crs, tile_transform, nodata_value)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(save_tile, sorted(needed)))
+
+    site_tiles = sum(site['rows'] * site['cols'] for site in sites)
+    group.update(tiles=len(needed), site_tiles=site_tiles)
+    print(f"Group {transaction_ID}: {len(items_list)} items, {len(needed)} tiles saved for {site_tiles} site tiles "
+          f"({len(sites)} sites) in {time.time() - group_start:.2f} seconds")
+    return group
+
+
+
+def plan_shards_handler(event):
+    """
+    Plans a sharded transaction: one STAC search, then the AOI's tile grid in the cube's
+    native CRS, aligned to its pixels, split into shards (see sharding.plan_shards).
+    The returned shards are the items of the Map state.
+    """
     try:
-        obj = s3.get_object(Bucket=S3_BUCKET, Key=COUNTER_FILE)
-        content = obj["Body"].read().decode("utf-8").strip()
-        counter = int(content) if content.isdigit() else 0
+        site = multi_site.normalize_site(event)
+        datetime_range = event.get('datetime_range', DEFAULT_DATETIME_RANGE)
+        bbox = multi_site.site_bbox(site)
+
+        service = pystac_client.Client.open(BDC_STAC_URL)
+        items_list = list(service.search(bbox=bbox, datetime=datetime_range, collections=[COLLECTION]).items())
+        if not items_list:
+            return {"statusCode": 404, "body": json.dumps("No images found for the given parameters.")}
+
+        west, south, east, north = extend_by_half_tile(items_list[0], bbox)
+        with rasterio.open(items_list[0].assets[BANDS[0]].href) as dataset:
+            xs, ys = transform(CRS.from_string('EPSG:4326'), dataset.crs, [west, east], [south, north])
+            window = from_bounds(xs[0], ys[0], xs[1], ys[1], dataset.transform).round_offsets().round_lengths()
+            grid_transform = dataset.window_transform(window)
+            grid_crs = dataset.crs.to_string()
+
+        transaction_ID = ID_Gen()
+        plan = sharding.plan_shards(
+            transaction_ID,
+            list(grid_transform)[:6],
+            (window.height, window.width),
+            grid_crs,
+            {band: [item.assets[band].href for item in items_list] for band in BANDS},
+            sub_image_pixels,
+            event.get('shard_tiles'),
+        )
+        print(f"Transaction {transaction_ID}: {plan['grid']['tiles']} tiles in {len(plan['shards'])} shards "
+              f"of up to {plan['shard_tiles']} tiles")
+        return plan
+
+    except Exception as e:
+        print("Error occurred:", traceback.format_exc())  # Logs the full error
+        return {"statusCode": 500, "body": json.dumps(str(e))}
+
+
+
+def shard_handler(shard):
+    """
+    Acquires one shard: reads its pixel-aligned native window from every item (no STAC
+    search, the plan carries the COG hrefs) and saves its tiles with their global indices.
+    """
+    start_time = time.time()
+    transaction_ID = shard['transaction_id']
+    rows, cols = shard['rows'], shard['cols']
+    metrics.start("acquisition", transaction_ID, part=f"shard{shard['index']}")
 
-    except (s3.exceptions.NoSuchKey, ValueError):
-        # If file does not exist or is empty, initialize counter at 0
-        counter = 0
+    with ThreadPoolExecutor(max_workers=len(BANDS)) as pool:
+        reads = list(pool.map(lambda band: read_shard_band(shard['assets'][band], shard['bounds'], shard['crs']), BANDS))
 
-    # Increment counter
-    counter += 1
+    nodata_value = -9999.0
+    medians = [compute_median_band(data_list).filled(nodata_value).astype('float32') for data_list, _ in reads]
+    shard_transform = reads[0][1]
+    reference_crs = CRS.from_string(shard['crs'])
 
-    # Upload updated counter back to S3
-    s3.put_object(Bucket=S3_BUCKET, Key=COUNTER_FILE, Body=str(counter), ContentType="text/plain")
+    def save_tile(tile):
+        i, j = tile
+        row_start, col_start = (i - rows[0]) * sub_image_pixels, (j - cols[0]) * sub_image_pixels
+        stacked_tile = extract_tile(medians, row_start, col_start, nodata_value)
+        tile_window = Window(col_start, row_start, sub_image_pixels, sub_image_pixels)
+        tile_transform = rasterio.windows.transform(tile_window, shard_transform)
+        return save_tile_to_s3(S3_BUCKET, transaction_ID, i, j, stacked_tile, reference_crs, tile_transform, nodata_value)
 
-    # Generate transaction ID with the current date
-    current_date = datetime.utcnow().strftime("%Y-%m-%d")
-    return f"{counter:06d}-{current_date}"
+    tiles = [(i, j) for i in range(*rows) for j in range(*cols)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(save_tile, tiles))
+
+    print(f"Shard {shard['index']} of {transaction_ID}: {len(tiles)} tiles in {time.time() - start_time:.2f} seconds")
+    metrics.finish(s3, S3_BUCKET)
+    return {"transaction_id": transaction_ID, "index": shard['index'], "tiles": len(tiles)}
+
+
+
+def merge_shards_handler(event):
+    """
+    Merge step of a sharded transaction: combines the per-shard enhancement manifests
+    into manifest.json and writes the prediction completion marker.
+    """
+    transaction_ID = event['merge_shards']
+    prefix = f"image_enhancement/{transaction_ID}/"
+
+    tile_stats, parts = {}, 0
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{prefix}manifest_"):
+        for obj in page.get('Contents', []):
+            tile_stats.update(json.loads(s3.get_object(Bucket=S3_BUCKET, Key=obj['Key'])["Body"].read())["tiles"])
+            parts += 1
+
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{prefix}manifest.json", Body=json.dumps({"tiles": tile_stats}), ContentType="application/json")
+    s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=f"predictions/{transaction_ID}/_SUCCESS",
+        Body=json.dumps({"tiles": event.get('tiles', len(tile_stats))}).encode("utf-8")
+    )
+    print(f"Merged {parts} shard manifests ({len(tile_stats)} tiles) of {transaction_ID}")
+    return {"transaction_id": transaction_ID, "tiles": len(tile_stats)}
+
+
+
+def fan_out_handler(event):
+    """Copies the predicted tiles of a batch into one transaction per site (see multi_site.fan_out)."""
+    batch_id = event['fan_out_batch']
+    obj = s3.get_object(Bucket=S3_BUCKET, Key=multi_site.MANIFEST_KEY.format(batch_id=batch_id))
+    manifest = json.loads(obj["Body"].read())
+    copied = multi_site.fan_out(s3, S3_BUCKET, manifest)
+    return {"batch_id": batch_id, "copied": copied}
+
+
+
+def ID_Gen():
+    
+    """Allocates a unique transaction ID in the format: NNNNNN-YYYY-MM-DD (UTC date)"""
+    
+    # Conditional writes (or block reservations) replace the unconditional
+    # read-increment-write of the counter, so concurrent Lambdas never share an ID
+    return id_allocator.next_id()
 
 
 
@@ -291,7 +692,7 @@ def read_multiple_items(items, band_name, bbox, masked=True, crs=None):
         # Expects the bounding box has 4 values
         w, s, e, n = bbox
         
-        with rasterio.open(uri) as dataset:
+        with metrics.span("cog_read", band=band_name), rasterio.open(uri) as dataset:
             # Transform the bounding box to the dataset's CRS
             xs, ys = transform(source_crs, dataset.crs, [w, e], [s, n])
             # Create a window from the transformed bounds
@@ -306,17 +707,61 @@ def read_multiple_items(items, band_name, bbox, masked=True, crs=None):
             data_list.append(data)
             transforms.append(window_transform)
             crs_list.append(data_crs)
+            metrics.count("cog_reads")
+            metrics.count("cog_pixel_bytes", data.nbytes)
     
     return data_list, transforms, crs_list
 
 
 
-# Compute median bands to mitigate the cloud distortion
-def compute_median_band(band_data_list):
-    data_stack = ma.stack(band_data_list, axis=0)
-    median_band = ma.median(data_stack, axis=0)
-    return median_band
-    
+# Shape (rows, cols) of the window of a bbox in an item's band, read from the COG header only
+def window_shape(item, band_name, bbox):
+    w, s, e, n = bbox
+    with rasterio.open(item.assets[band_name].href) as dataset:
+        xs, ys = transform(CRS.from_string('EPSG:4326'), dataset.crs, [w, e], [s, n])
+        window = from_bounds(xs[0], ys[0], xs[1], ys[1], dataset.transform)
+    return window.height, window.width
+
+
+
+# Grows a lon/lat bbox by half a tile on every side (tile size in degrees from the COG header)
+def extend_by_half_tile(item, bbox):
+    height, width = window_shape(item, BANDS[0], bbox)
+    west, south, east, north = bbox
+    ns_deg_by_row = (north - south) / (height / sub_image_pixels)
+    we_deg_by_col = (east - west) / (width / sub_image_pixels)
+    return west - we_deg_by_col / 2, south - ns_deg_by_row / 2, east + we_deg_by_col / 2, north + ns_deg_by_row / 2
+
+
+
+# Reads native-CRS bounds (on the cube's pixel edges) from every COG of a band.
+# The window is rounded and read boundless, so every item yields the same grid.
+# `cache` ({(uri, bounds): (data, transform)}) shares reads between calls.
+def read_shard_band(hrefs, bounds, crs, cache=None):
+    left, bottom, right, top = bounds
+    data_list = []
+    shard_transform = None
+
+    for uri in hrefs:
+        key = (uri, tuple(bounds))
+        if cache is not None and key in cache:
+            data, window_transform = cache[key]
+            metrics.count("read_cache_hits")
+        else:
+            with metrics.span("cog_read"), rasterio.open(uri) as dataset:
+                xs, ys = transform(CRS.from_string(crs), dataset.crs, [left, right], [bottom, top])
+                window = from_bounds(xs[0], ys[0], xs[1], ys[1], dataset.transform).round_offsets().round_lengths()
+                data = dataset.read(1, window=window, masked=True, boundless=True)
+                window_transform = dataset.window_transform(window)
+            metrics.count("cog_reads")
+            metrics.count("cog_pixel_bytes", data.nbytes)
+            if cache is not None:
+                cache[key] = (data, window_transform)
+        data_list.append(data)
+        shard_transform = shard_transform or window_transform
+
+    return data_list, shard_transform
+
 
 
 def save_tile_to_s3(bucket, transaction_id, i, j, stacked_tile, crs, transform, nodata_value):
@@ -327,34 +772,20 @@ def save_tile_to_s3(bucket, transaction_id, i, j, stacked_tile, crs, transform,
     # Define S3 key (file path in S3)
     s3_key = f"acquisition/{transaction_id}/{transaction_id}_{i:03}_{j:03}.tif"
 
-    # Create an in-memory buffer
-    buffer = BytesIO()
-
-    # Write the image to the buffer instead of a file
-    with rasterio.open(
-        buffer,
-        'w',
-        driver='GTiff',
-        height=stacked_tile.shape[1],
-        width=stacked_tile.shape[2],
-        count=4,  # 4 bands: Red, Green, Blue, NIR
-        dtype='float32',
-        crs=crs,
-        transform=transform,
-        nodata=nodata_value
-    ) as dst:
-        dst.write(stacked_tile)
-        dst.set_band_description(1, 'Red')
-        dst.set_band_description(2, 'Green')
-        dst.set_band_description(3, 'Blue')
-        dst.set_band_description(4, 'NIR')
-
-    # Move to the beginning of the buffer before uploading
-    buffer.seek(0)
-
     # Upload to S3
-    s3.put_object(Bucket=bucket, Key=s3_key, Body=buffer.getvalue(), ContentType="image/tiff")
+    body = encode_tile(stacked_tile, crs, transform, nodata_value)
+    with metrics.span("upload"):
+        s3.put_object(Bucket=bucket, Key=s3_key, Body=body, ContentType="image/tiff")
+    metrics.count("tiles")
+    metrics.count("bytes_out", len(body))
 
     print(f"Uploaded {s3_key} to S3 successfully.")
 
     return s3_key
+
+
+
+# Local runs (sharding.py runs shards this way): python BDC_Fetch.py '<event json>'
+if __name__ == "__main__":
+    import sys
+    print(json.dumps(lambda_handler(json.loads(sys.argv[1]), None)))
@@ -0,0 +1,67 @@
+#
+# Compositing and tiling of the acquisition: the temporal median of each band, the
+# 256 x 256 tiles cut from the median bands and their GeoTIFF encoding.
+#
+# Every acquisition path (request and global tiling, multi-site groups, shards, the
+# fused pipeline) goes through these functions. They only need numpy and rasterio, so
+# tests/benchmark.py can time them without the STAC client, geopy or boto3 that
+# BDC_Fetch imports.
+#
+
+from io import BytesIO
+
+import numpy as np
+import numpy.ma as ma
+import rasterio
+
+import metrics
+
+sub_image_pixels = 256  # input images' size
+
+
+# Compute median bands to mitigate the cloud distortion
+def compute_median_band(band_data_list):
+    with metrics.span("median"):
+        data_stack = ma.stack(band_data_list, axis=0)
+        median_band = ma.median(data_stack, axis=0)
+    return median_band
+
+
+
+# (4, 256, 256) tile of the median bands at a pixel offset; tiles cut short by the
+# mosaic edge are padded with nodata so every stage sees full-size tiles
+def extract_tile(medians, row_start, col_start, nodata_value):
+    stacked_tile = np.stack([m[row_start:row_start + sub_image_pixels, col_start:col_start + sub_image_pixels] for m in medians])
+    missing_rows, missing_cols = sub_image_pixels - stacked_tile.shape[1], sub_image_pixels - stacked_tile.shape[2]
+    if missing_rows or missing_cols:
+        stacked_tile = np.pad(stacked_tile, ((0, 0), (0, missing_rows), (0, missing_cols)), constant_values=nodata_value)
+    return stacked_tile
+
+
+
+# Encode a (4, H, W) float32 tile as an in-memory GeoTIFF
+def encode_tile(stacked_tile, crs, transform, nodata_value):
+
+    # Create an in-memory buffer
+    buffer = BytesIO()
+
+    # Write the image to the buffer instead of a file
+    with metrics.span("encode"), rasterio.open(
+        buffer,
+        'w',
+        driver='GTiff',
+        height=stacked_tile.shape[1],
+        width=stacked_tile.shape[2],
+        count=4,  # 4 bands: Red, Green, Blue, NIR
+        dtype='float32',
+        crs=crs,
+        transform=transform,
+        nodata=nodata_value
+    ) as dst:
+        dst.write(stacked_tile)
+        dst.set_band_description(1, 'Red')
+        dst.set_band_description(2, 'Green')
+        dst.set_band_description(3, 'Blue')
+        dst.set_band_description(4, 'NIR')
+
+    return buffer.getvalue()
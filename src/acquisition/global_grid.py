@@ -0,0 +1,175 @@
+#
+# Global tiling: acquisition tiles snapped to a fixed grid of cells instead of a grid
+# relative to each request's bbox, so tiles (and their enhancement and prediction
+# results) can be reused by any later transaction covering the same cells.
+#
+# The grid lives in the native CRS of the BDC cube (one CRS per collection) and is
+# aligned to its pixels: cell (row, col) covers 256 x 256 cube pixels starting at
+# (X0 + col * size, Y0 - row * size), with (X0, Y0) the pixel-edge phase of the cube.
+# Cell IDs look like "R-1234C567". Which cells cover a bbox is pure arithmetic on
+# the bbox's native bounds, O(number of cells).
+#
+# Cache layout: cells/{namespace}/{cell_id}/{stage}.tif, stage in acquisition,
+# image_enhancement, predictions, probabilities. The namespace holds the collection
+# and datetime range (and CELL_CACHE_VERSION, to bump when the model changes).
+# Listing cells/{namespace}/R{row}C returns the cached cells of one grid row.
+#
+
+import os
+import math
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+CELL_CACHE_PREFIX = "cells/"
+CELL_CACHE_VERSION = os.getenv("CELL_CACHE_VERSION", "v1")
+CELL_STAGES = ["acquisition", "image_enhancement", "predictions", "probabilities"]
+CELLS_MANIFEST = "cells.json"
+
+
+class GlobalGrid:
+    """Fixed grid of tile_pixels x tile_pixels cells in a cube's native CRS."""
+
+    def __init__(self, crs, resolution, x0=0.0, y0=0.0, tile_pixels=256):
+        self.crs = crs
+        self.resolution = float(resolution)
+        self.x0 = float(x0) % self.resolution
+        self.y0 = float(y0) % self.resolution
+        self.tile_pixels = tile_pixels
+        self.size = self.resolution * tile_pixels
+
+    @classmethod
+    def from_dataset(cls, dataset, tile_pixels=256):
+        """Grid aligned to the pixels of an open rasterio dataset of the cube."""
+        return cls(dataset.crs.to_string(), dataset.transform.a, dataset.transform.c, dataset.transform.f, tile_pixels)
+
+    def to_dict(self):
+        return {"crs": self.crs, "resolution": self.resolution, "x0": self.x0, "y0": self.y0, "tile_pixels": self.tile_pixels}
+
+    @classmethod
+    def from_dict(cls, grid):
+        return cls(grid["crs"], grid["resolution"], grid["x0"], grid["y0"], grid["tile_pixels"])
+
+    def cell_at(self, x, y):
+        """(row, col) of the cell containing a native-CRS point."""
+        return math.floor((self.y0 - y) / self.size), math.floor((x - self.x0) / self.size)
+
+    def cell_bounds(self, row, col):
+        """Native-CRS (left, bottom, right, top) of a cell."""
+        left = self.x0 + col * self.size
+        top = self.y0 - row * self.size
+        return left, top - self.size, left + self.size, top
+
+    def cell_transform(self, row, col):
+        from rasterio.transform import from_origin
+        left, _, _, top = self.cell_bounds(row, col)
+        return from_origin(left, top, self.resolution, self.resolution)
+
+    def native_bounds(self, bbox):
+        """Native-CRS bounds of a lon/lat bbox (edges densified, the projection bends them)."""
+        from rasterio.warp import transform_bounds
+        return transform_bounds("EPSG:4326", self.crs, *bbox, densify_pts=21)
+
+    def cells_covering(self, bbox):
+        """(row, col) of every cell intersecting a lon/lat bbox, row-major."""
+        left, bottom, right, top = self.native_bounds(bbox)
+        row0, col0 = self.cell_at(left, top)
+        # Cells touched by the far edges; an edge on a cell boundary does not add a cell
+        row1, col1 = self.cell_at(right - 1e-6, bottom + 1e-6)
+        return [(row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+
+def cell_id(row, col):
+    return f"R{row}C{col}"
+
+
+def cache_namespace(collection, datetime_range):
+    return f"{collection}/{datetime_range.replace('/', '_')}/{CELL_CACHE_VERSION}"
+
+
+def cell_key(namespace, row, col, stage):
+    return f"{CELL_CACHE_PREFIX}{namespace}/{cell_id(row, col)}/{stage}.tif"
+
+
+def cached_cells(s3, bucket, namespace, rows, workers=16):
+    """{(row, col): set of cached stages} for the given grid rows (one listing per row)."""
+    def list_row(row):
+        prefix = f"{CELL_CACHE_PREFIX}{namespace}/R{row}C"
+        found = {}
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                cell, _, filename = obj["Key"][len(prefix):].partition("/")
+                stage = filename[:-len(".tif")] if filename.endswith(".tif") else None
+                if stage in CELL_STAGES:
+                    found.setdefault((row, int(cell)), set()).add(stage)
+        return found
+
+    cached = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for found in pool.map(list_row, sorted(set(rows))):
+            cached.update(found)
+    return cached
+
+
+def tile_name(transaction_id, i, j):
+    return f"{transaction_id}_{i:03}_{j:03}.tif"
+
+
+def transaction_tiles(transaction_id, cells):
+    """{tile filename: (row, col)}: cells numbered from the top-left covering cell, like request tiles."""
+    row0 = min(row for row, _ in cells)
+    col0 = min(col for _, col in cells)
+    return {tile_name(transaction_id, row - row0, col - col0): (row, col) for row, col in cells}
+
+
+def read_cells_manifest(s3, bucket, transaction_id):
+    """acquisition/{tid}/cells.json, None for transactions acquired with request tiling."""
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=f"acquisition/{transaction_id}/{CELLS_MANIFEST}")
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(obj["Body"].read())
+
+
+def cached_tile_stages(s3, bucket, transaction_id):
+    """
+    {tile filename: stages copied from the cell cache} of a transaction ({} with request
+    tiling). The enhancement and prediction stages skip the tiles cached for them.
+    """
+    manifest = read_cells_manifest(s3, bucket, transaction_id)
+    if manifest is None:
+        return {}
+    return {name: set(tile["cached"]) for name, tile in manifest["tiles"].items()}
+
+
+def publish_cells(s3, bucket, transaction_id, workers=32):
+    """
+    Copies the results of a transaction's newly computed cells into the cell cache
+    (server-side copies), so later transactions reuse them. Returns the number copied.
+    """
+    manifest = read_cells_manifest(s3, bucket, transaction_id)
+    if manifest is None:
+        return 0
+
+    existing = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for stage in CELL_STAGES:
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{stage}/{transaction_id}/"):
+            existing.update(obj["Key"] for obj in page.get("Contents", []))
+
+    copies = []
+    for name, tile in manifest["tiles"].items():
+        for stage in CELL_STAGES:
+            source = f"{stage}/{transaction_id}/{name}"
+            if stage not in tile["cached"] and source in existing:
+                copies.append((source, cell_key(manifest["namespace"], tile["row"], tile["col"], stage)))
+
+    def copy(pair):
+        source, target = pair
+        s3.copy_object(Bucket=bucket, Key=target, CopySource={"Bucket": bucket, "Key": source})
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(copy, copies))
+
+    print(f"Published {len(copies)} cell results of {transaction_id} to {CELL_CACHE_PREFIX}{manifest['namespace']}/")
+    return len(copies)
@@ -0,0 +1,268 @@
+#
+# Transaction ID allocation (NNNNNN-YYYY-MM-DD, the shape expected by the cleanup job).
+#
+# Backends:
+#   counter - shared counter in S3 updated with a conditional put (ETag compare-and-swap),
+#             retried with jittered backoff when another caller wins the race.
+#   block   - reserves a block of counter values with one compare-and-swap and hands
+#             them out locally; warm Lambda containers allocate without any S3 call.
+#   time    - number = deciseconds since midnight UTC, strictly increasing per process.
+#             Uniqueness across processes comes from claiming the ID with a create-only
+#             conditional put (one round trip, no shared hotspot); without a claim store
+#             it is only unique within the process.
+#
+# Run `python id_allocator.py --backend block --callers 64` for a local load test.
+#
+
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+
+ID_MODULO = 10 ** 6  # six digits
+COUNTER_KEY = "etc/transaction_counter.txt"
+CLAIM_PREFIX = "etc/transaction_ids/"
+
+
+def format_transaction_id(number, when=None):
+    """NNNNNN-YYYY-MM-DD (UTC date); the number wraps at one million."""
+    when = when or datetime.now(timezone.utc)
+    return f"{number % ID_MODULO:06d}-{when:%Y-%m-%d}"
+
+
+class ConflictError(Exception):
+    """A conditional write lost against a concurrent writer."""
+
+
+# ------------------------------------------------------------------ stores
+
+class S3CounterStore:
+    """Counter object in S3, written with If-Match / If-None-Match conditions."""
+
+    def __init__(self, s3, bucket, key=COUNTER_KEY):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+
+    def read(self):
+        """(value, version); version is None if the counter does not exist yet."""
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3.exceptions.NoSuchKey:
+            return 0, None
+        content = obj["Body"].read().decode("utf-8").strip()
+        return (int(content) if content.isdigit() else 0), obj["ETag"]
+
+    def write(self, value, version):
+        """Writes `value` only if the counter is still at `version`; raises ConflictError otherwise."""
+        condition = {"IfMatch": version} if version is not None else {"IfNoneMatch": "*"}
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=str(value), ContentType="text/plain", **condition)
+        except self.s3.exceptions.ClientError as e:
+            # 412: precondition failed, 409: concurrent conditional write in progress
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                raise ConflictError(self.key) from e
+            raise
+
+    def claim(self, name):
+        """Creates CLAIM_PREFIX/<name> if it does not exist; False if somebody else has it."""
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=f"{CLAIM_PREFIX}{name}", Body=b"", IfNoneMatch="*")
+        except self.s3.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                return False
+            raise
+        return True
+
+
+class MemoryCounterStore:
+    """In-process store with the same semantics (and an optional simulated latency)."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.value, self.version = 0, None
+        self.claims = set()
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def read(self):
+        self._round_trip()
+        with self.lock:
+            self.calls += 1
+            return self.value, self.version
+
+    def write(self, value, version):
+        self._round_trip()
+        with self.lock:
+            self.calls += 1
+            if version != self.version:
+                raise ConflictError("counter")
+            self.value, self.version = value, (self.version or 0) + 1
+
+    def claim(self, name):
+        self._round_trip()
+        with self.lock:
+            self.calls += 1
+            if name in self.claims:
+                return False
+            self.claims.add(name)
+            return True
+
+
+# ------------------------------------------------------------------ allocators
+
+class CounterAllocator:
+    """Sequential IDs from a shared counter, one compare-and-swap per reservation."""
+
+    def __init__(self, store, max_attempts=50, backoff=0.01):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.conflicts = 0
+
+    def reserve(self, count=1):
+        """Reserves `count` consecutive numbers; returns the first one."""
+        for attempt in range(self.max_attempts):
+            value, version = self.store.read()
+            try:
+                self.store.write(value + count, version)
+                return value + 1
+            except ConflictError:
+                self.conflicts += 1
+                # Full jitter, capped: spreads the retries of colliding callers
+                time.sleep(random.uniform(0, min(1.0, self.backoff * 2 ** attempt)))
+
+        raise RuntimeError(f"Could not reserve a transaction number after {self.max_attempts} attempts")
+
+    def next_id(self):
+        return format_transaction_id(self.reserve())
+
+
+class BlockAllocator(CounterAllocator):
+    """Reserves `block_size` numbers per compare-and-swap and hands them out locally."""
+
+    def __init__(self, store, block_size=16, **kwargs):
+        super().__init__(store, **kwargs)
+        self.block_size = block_size
+        self.next_number = self.end = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            if self.next_number >= self.end:
+                self.next_number = self.reserve(self.block_size)
+                self.end = self.next_number + self.block_size
+            number = self.next_number
+            self.next_number += 1
+        return format_transaction_id(number)
+
+
+class TimeOrderedAllocator:
+    """
+    Number = deciseconds since midnight UTC (0 - 863999), strictly increasing within the
+    process. With a store, each ID is claimed (create-only put) and the next decisecond
+    is tried on collision, so concurrent processes never share an ID.
+    """
+
+    def __init__(self, store=None, clock=time.time):
+        self.store = store
+        self.clock = clock
+        self.last = None  # (date, number)
+        self.lock = threading.Lock()
+        self.conflicts = 0
+
+    def _candidate(self, skip=1):
+        now = datetime.fromtimestamp(self.clock(), timezone.utc)
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        number = int((now - midnight).total_seconds() * 10)
+
+        with self.lock:
+            if self.last is not None and self.last[0] == now.date() and number <= self.last[1]:
+                number = self.last[1] + skip
+            self.last = (now.date(), number)
+        return number, now
+
+    def next_id(self):
+        skip = 1
+        for attempt in range(64):
+            number, now = self._candidate(skip)
+            if number >= ID_MODULO:
+                raise RuntimeError("No time-ordered transaction number left for today")
+            transaction_id = format_transaction_id(number, now)
+            if self.store is None or self.store.claim(transaction_id):
+                return transaction_id
+            self.conflicts += 1
+            # Probe ahead by a growing random stride so colliding processes spread out
+            skip = random.randint(1, 2 ** min(attempt + 1, 8))
+
+        raise RuntimeError("Could not claim a time-ordered transaction number")
+
+
+def make_allocator(backend, store, block_size=16):
+    if backend == "counter":
+        return CounterAllocator(store)
+    if backend == "block":
+        return BlockAllocator(store, block_size=block_size)
+    if backend == "time":
+        return TimeOrderedAllocator(store)
+    raise ValueError(f"Unknown transaction ID backend: {backend}")
+
+
+# ------------------------------------------------------------------ load test
+
+def load_test(backend, callers, ids_per_caller, latency, block_size):
+    """
+    `callers` threads allocate `ids_per_caller` IDs each against one shared in-memory
+    store (with `latency` seconds per round trip). Each caller has its own allocator, like
+    separate Lambda containers. Returns the number of duplicate IDs (must be 0).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    store = MemoryCounterStore(latency=latency)
+    allocators = [make_allocator(backend, store, block_size) for _ in range(callers)]
+
+    def run(allocator):
+        latencies = []
+        ids = []
+        for _ in range(ids_per_caller):
+            start = time.perf_counter()
+            ids.append(allocator.next_id())
+            latencies.append(time.perf_counter() - start)
+        return ids, latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        results = list(pool.map(run, allocators))
+    elapsed = time.perf_counter() - start
+
+    ids = [i for caller_ids, _ in results for i in caller_ids]
+    latencies = sorted(l for _, caller_latencies in results for l in caller_latencies)
+    duplicates = len(ids) - len(set(ids))
+    conflicts = sum(getattr(a, "conflicts", 0) for a in allocators)
+
+    print(f"{backend}: {len(ids)} IDs from {callers} concurrent callers in {elapsed:.2f} s "
+          f"({len(ids) / elapsed:,.0f} IDs/s), {duplicates} duplicates, {conflicts} conflicts, "
+          f"{store.calls} store calls")
+    print(f"  latency (ms): p50 {latencies[len(latencies) // 2] * 1000:.1f}, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}, max {latencies[-1] * 1000:.1f}")
+    return duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the transaction ID allocators (in-memory store).")
+    parser.add_argument("--backend", choices=["counter", "block", "time"], nargs="+", default=["counter", "block", "time"])
+    parser.add_argument("--callers", type=int, default=64)
+    parser.add_argument("--ids-per-caller", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.01, help="Simulated store round trip (seconds)")
+    parser.add_argument("--block-size", type=int, default=16)
+    args = parser.parse_args()
+
+    failed = False
+    for backend in args.backend:
+        failed |= load_test(backend, args.callers, args.ids_per_caller, args.latency, args.block_size) > 0
+    raise SystemExit(1 if failed else 0)
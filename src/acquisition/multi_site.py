@@ -0,0 +1,257 @@
+#
+# Multi-site batches: many AOIs (sites) submitted in one request.
+#
+# Sites whose bounding boxes (grown by a margin) overlap are grouped with a
+# union-find. Each group is acquired once, as one "group transaction": one STAC
+# search and one COG read per (item, band) over the union of its sites, and only the
+# tiles needed by at least one site are written, so overlapping sites share tiles.
+# Enhancement and prediction then run over all group transactions (one model load).
+# Finally every site gets its own transaction, filled by server-side copies of its
+# tiles (fan_out), and is reported like a single-site run.
+#
+# The batch manifest (batches/{batch_id}/sites.json) maps every site to its group
+# transaction and to its tile window (row0, col0, rows, cols) in the group grid.
+#
+# `python multi_site.py ../../output_examples/examples.txt --margin-km 15` prints the
+# grouping of a list of sites (examples.txt format or a JSON list) without any AWS call.
+#
+
+import re
+import json
+import math
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from geopy.distance import geodesic
+
+GROUP_MARGIN_KM = 5.0  # sites closer than this are acquired together
+FAN_OUT_WORKERS = 32
+
+MANIFEST_KEY = "batches/{batch_id}/sites.json"
+
+
+# ------------------------------------------------------------------ sites
+
+def normalize_site(site, index=0):
+    """Validates one site of a batch request; same defaults as a single-site run."""
+    center_point = site.get("center_point")
+    if not center_point or len(center_point) != 2:
+        raise ValueError(f"Site #{index}: invalid or missing 'center_point'. Expected format: [latitude, longitude]")
+
+    return {
+        "name": site.get("name") or f"site_{index:03}",
+        "center_point": [float(center_point[0]), float(center_point[1])],
+        "ns_distance_km": float(site.get("ns_distance_km", 10)),
+        "we_distance_km": float(site.get("we_distance_km", 10)),
+    }
+
+
+def site_bbox(site):
+    """(west, south, east, north) of a site, computed like the single-site acquisition."""
+    center_point = tuple(site["center_point"])
+    north = geodesic(kilometers=site["ns_distance_km"] / 2).destination(center_point, 0).latitude
+    south = geodesic(kilometers=site["ns_distance_km"] / 2).destination(center_point, 180).latitude
+    east = geodesic(kilometers=site["we_distance_km"] / 2).destination(center_point, 90).longitude
+    west = geodesic(kilometers=site["we_distance_km"] / 2).destination(center_point, 270).longitude
+    return west, south, east, north
+
+
+def grow_bbox(bbox, margin_km):
+    """Grows a lon/lat bbox by `margin_km` on every side."""
+    west, south, east, north = bbox
+    dlat = margin_km / 110.574
+    dlon = margin_km / (111.320 * max(math.cos(math.radians((south + north) / 2)), 1e-6))
+    return west - dlon, south - dlat, east + dlon, north + dlat
+
+
+def union_bbox(bboxes):
+    bboxes = list(bboxes)
+    return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def group_sites(sites, margin_km=GROUP_MARGIN_KM):
+    """
+    Groups sites whose bboxes, grown by margin_km / 2 each, intersect (transitively).
+    Returns lists of site indexes, in submission order.
+    """
+    grown = [grow_bbox(site_bbox(site), margin_km / 2) for site in sites]
+    parent = list(range(len(sites)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]  # path halving
+            i = parent[i]
+        return i
+
+    for i in range(len(sites)):
+        for j in range(i + 1, len(sites)):
+            if intersects(grown[i], grown[j]):
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(sites)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+# ------------------------------------------------------------------ tiles
+
+def site_tile_window(bbox, mosaic_transform, mosaic_crs, mosaic_shape, tile_pixels):
+    """
+    (row0, col0, rows, cols): tiles of the group grid covering a site's bbox plus half
+    a tile on every side (the single-site acquisition extends its bbox the same way).
+    """
+    from rasterio.crs import CRS
+    from rasterio.warp import transform
+    from rasterio.transform import rowcol
+
+    west, south, east, north = bbox
+    xs, ys = transform(CRS.from_string('EPSG:4326'), mosaic_crs, [west, east], [south, north])
+    (top, bottom), (left, right) = rowcol(mosaic_transform, [xs[0], xs[1]], [ys[1], ys[0]], op=float)
+
+    half = tile_pixels / 2
+    height, width = mosaic_shape
+    top, left = max(top - half, 0), max(left - half, 0)
+    bottom, right = min(bottom + half, height), min(right + half, width)
+
+    # Whole tiles only (a one-site group gets the single-site count, int(pixels / 256) + 1
+    # per side); the tile of a site narrower than one tile at the mosaic edge is padded
+    row0, col0 = int(top // tile_pixels), int(left // tile_pixels)
+    row1 = max(int(bottom // tile_pixels), row0 + 1)
+    col1 = max(int(right // tile_pixels), col0 + 1)
+    return row0, col0, row1 - row0, col1 - col0
+
+
+def window_tiles(window):
+    row0, col0, rows, cols = window
+    return [(row0 + i, col0 + j) for i in range(rows) for j in range(cols)]
+
+
+def tile_name(transaction_id, i, j):
+    return f"{transaction_id}_{i:03}_{j:03}.tif"
+
+
+# ------------------------------------------------------------------ fan-out
+
+def fan_out(s3, bucket, manifest, workers=FAN_OUT_WORKERS):
+    """
+    Copies every site's tiles from its group transaction into the site's own
+    transaction (server-side copies, renamed to the site grid), with the enhancement
+    manifest and the prediction completion marker, so each site can be reported alone.
+    Returns the number of objects copied.
+    """
+    folders = ["image_enhancement", "predictions", "probabilities"]
+
+    def existing(prefix):
+        paginator = s3.get_paginator("list_objects_v2")
+        return {obj["Key"] for page in paginator.paginate(Bucket=bucket, Prefix=prefix) for obj in page.get("Contents", [])}
+
+    group_objects = {
+        (group["transaction_id"], folder): existing(f"{folder}/{group['transaction_id']}/")
+        for group in manifest["groups"] for folder in folders
+    }
+
+    copies, site_manifests = [], []
+    for site in manifest["sites"]:
+        group_id, site_id = site["group"], site["transaction_id"]
+        if site.get("error"):
+            continue
+        row0, col0 = site["row0"], site["col0"]
+
+        group_tile_stats = {}
+        for key in group_objects[(group_id, "image_enhancement")]:
+            if key.endswith("manifest.json"):
+                group_tile_stats = json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read()).get("tiles", {})
+
+        tile_stats = {}
+        for gi, gj in window_tiles((row0, col0, site["rows"], site["cols"])):
+            source_name, target_name = tile_name(group_id, gi, gj), tile_name(site_id, gi - row0, gj - col0)
+            for folder in folders:
+                source = f"{folder}/{group_id}/{source_name}"
+                if source in group_objects[(group_id, folder)]:
+                    copies.append((source, f"{folder}/{site_id}/{target_name}"))
+            if source_name in group_tile_stats:
+                tile_stats[target_name] = group_tile_stats[source_name]
+
+        site_manifests.append((f"image_enhancement/{site_id}/manifest.json", {"tiles": tile_stats}))
+        site_manifests.append((f"predictions/{site_id}/_SUCCESS", {"tiles": site["rows"] * site["cols"]}))
+
+    def copy(pair):
+        source, target = pair
+        s3.copy_object(Bucket=bucket, Key=target, CopySource={"Bucket": bucket, "Key": source})
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(copy, copies))
+
+    # Written last: the completion marker must not appear before the tiles
+    for key, body in site_manifests:
+        s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(body).encode("utf-8"), ContentType="application/json")
+
+    print(f"Fanned out {len(copies)} objects to {len(site_manifests) // 2} site transactions.")
+    return len(copies)
+
+
+# ------------------------------------------------------------------ examples.txt
+
+def parse_sites_text(text):
+    """Sites of a text in the output_examples/examples.txt format."""
+    fields = {
+        "Solar Plant Name": "name",
+        "Latitude": "lat",
+        "Longitude": "lon",
+        "North-South Distance": "ns_distance_km",
+        "West-East Distance": "we_distance_km",
+    }
+    sites, current = [], {}
+    for line in text.splitlines():
+        match = re.match(r'\s*([^:]+):\s*(.+?)\s*$', line)
+        if not match or match.group(1).strip() not in fields:
+            continue
+        field, value = fields[match.group(1).strip()], match.group(2)
+        if field == "name" and current:
+            sites.append(current)
+            current = {}
+        current[field] = value if field == "name" else float(value.split()[0])
+    if current:
+        sites.append(current)
+
+    return [
+        normalize_site({
+            "name": site.get("name"),
+            "center_point": [site.get("lat"), site.get("lon")] if "lat" in site and "lon" in site else None,
+            "ns_distance_km": site.get("ns_distance_km", 10),
+            "we_distance_km": site.get("we_distance_km", 10),
+        }, index)
+        for index, site in enumerate(sites)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the acquisition groups of a multi-site batch.")
+    parser.add_argument("sites", help="examples.txt-style file or JSON list of sites")
+    parser.add_argument("--margin-km", type=float, default=GROUP_MARGIN_KM)
+    parser.add_argument("--json", action="store_true", help="Print the batch request body instead of the groups")
+    args = parser.parse_args()
+
+    with open(args.sites, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        sites = [normalize_site(site, index) for index, site in enumerate(json.loads(text))]
+    except json.JSONDecodeError:
+        sites = parse_sites_text(text)
+
+    if args.json:
+        print(json.dumps({"sites": sites}, ensure_ascii=False, indent=2))
+    else:
+        groups = group_sites(sites, args.margin_km)
+        print(f"{len(sites)} sites -> {len(groups)} acquisition groups (margin {args.margin_km} km)")
+        for number, group in enumerate(groups):
+            west, south, east, north = union_bbox(site_bbox(sites[i]) for i in group)
+            width_km = geodesic((south, west), (south, east)).km
+            height_km = geodesic((south, west), (north, west)).km
+            print(f"  group {number}: {width_km:.1f} x {height_km:.1f} km - " + ", ".join(sites[i]["name"] for i in group))
@@ -0,0 +1,213 @@
+#
+# Sharded execution of a large AOI.
+#
+# The AOI's tile grid is fixed once, in the native CRS of the BDC cube and aligned to
+# its pixels (plan). It is then split into rectangular blocks of tile rows/columns
+# (shards). Acquisition, enhancement and prediction run per shard, in parallel, and
+# every shard writes its tiles into the same transaction with their global indices
+# ({tid}_{row:03}_{col:03}.tif), so the merge step only combines the enhancement
+# manifests and the report runs unchanged on the whole transaction.
+#
+# Stages select their shard with TILE_ROWS / TILE_COLS ("start:stop", tile indices,
+# stop excluded). The shard size is chosen from the tile count and the per-worker
+# throughput (auto_shard_tiles).
+#
+# `python sharding.py plan --tiles-rows 40 --tiles-cols 60` prints a plan;
+# `python sharding.py run '<plan json>'` runs a plan locally with a process per
+# shard stage (the Step Functions Map state semantics, for tests).
+#
+
+import os
+import re
+import sys
+import json
+import math
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-worker throughput of the slowest shard stage (prediction), in tiles per second
+SHARD_TILES_PER_SECOND = float(os.getenv("SHARD_TILES_PER_SECOND", 0.5))
+# A shard should take about this long (the acquisition Lambda stops at 15 minutes)
+SHARD_TARGET_SECONDS = float(os.getenv("SHARD_TARGET_SECONDS", 600))
+# Parallel workers (Map MaxConcurrency) and smallest useful shard
+SHARD_MAX_WORKERS = int(os.getenv("SHARD_MAX_WORKERS", 16))
+SHARD_MIN_TILES = 16
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Shared modules the stages import flat (copied next to them in the images)
+SHARED_DIRS = ("utils", "acquisition")
+
+
+# ------------------------------------------------------------------ plan
+
+def auto_shard_tiles(nb_of_tiles, tiles_per_second=SHARD_TILES_PER_SECOND,
+                     target_seconds=SHARD_TARGET_SECONDS, max_workers=SHARD_MAX_WORKERS):
+    """
+    Tiles per shard: enough shards to keep every worker busy, but no shard longer than
+    target_seconds at the given throughput (more shards than workers then run in waves).
+    """
+    per_worker = math.ceil(nb_of_tiles / max_workers)
+    longest = max(int(tiles_per_second * target_seconds), 1)
+    return max(min(per_worker, longest), min(SHARD_MIN_TILES, nb_of_tiles), 1)
+
+
+def shard_blocks(nb_rows, nb_cols, shard_tiles):
+    """
+    Splits a nb_rows x nb_cols tile grid into as few blocks of at most shard_tiles tiles
+    as possible, evenly sized and as square as possible.
+    """
+    best = None
+    for col_blocks in range(1, nb_cols + 1):
+        block_cols = math.ceil(nb_cols / col_blocks)
+        if block_cols > shard_tiles:
+            continue
+        row_blocks = math.ceil(nb_rows / (shard_tiles // block_cols))
+        block_rows = math.ceil(nb_rows / row_blocks)
+        score = (row_blocks * col_blocks, abs(block_rows - block_cols))
+        if best is None or score < best[0]:
+            best = (score, block_rows, block_cols)
+    _, block_rows, block_cols = best
+
+    return [
+        ((row, min(row + block_rows, nb_rows)), (col, min(col + block_cols, nb_cols)))
+        for row in range(0, nb_rows, block_rows)
+        for col in range(0, nb_cols, block_cols)
+    ]
+
+
+def shard_bounds(grid_transform, grid_shape, rows, cols, tile_pixels):
+    """Native-CRS bounds (left, bottom, right, top) of a shard, on pixel edges of the grid."""
+    height, width = grid_shape
+    top_px, bottom_px = rows[0] * tile_pixels, min(rows[1] * tile_pixels, height)
+    left_px, right_px = cols[0] * tile_pixels, min(cols[1] * tile_pixels, width)
+    a, _, c, _, e, f = grid_transform[:6]
+    return c + left_px * a, f + bottom_px * e, c + right_px * a, f + top_px * e
+
+
+def plan_shards(transaction_id, grid_transform, grid_shape, crs, assets, tile_pixels=256, shard_tiles=None, **kwargs):
+    """
+    Sharding plan of a transaction. grid_transform / grid_shape / crs: the pixel-aligned
+    native grid of the whole AOI, extended by half a tile on every side; assets:
+    {band: [COG hrefs]} shared by every shard.
+    The grid has whole tiles only: int(shape / tile_pixels) per side, the single-site
+    acquisition's int(pixels / 256) + 1 on the original bbox, so no tile is cut short.
+    """
+    nb_rows = max(int(grid_shape[0] // tile_pixels), 1)
+    nb_cols = max(int(grid_shape[1] // tile_pixels), 1)
+    shard_tiles = shard_tiles or auto_shard_tiles(nb_rows * nb_cols, **kwargs)
+
+    shards = []
+    for index, (rows, cols) in enumerate(shard_blocks(nb_rows, nb_cols, shard_tiles)):
+        shards.append({
+            "transaction_id": transaction_id,
+            "index": index,
+            "rows": list(rows),
+            "cols": list(cols),
+            "tile_rows": f"{rows[0]}:{rows[1]}",
+            "tile_cols": f"{cols[0]}:{cols[1]}",
+            "bounds": shard_bounds(grid_transform, grid_shape, rows, cols, tile_pixels),
+            "crs": crs,
+            "assets": assets,
+        })
+
+    return {
+        "transaction_id": transaction_id,
+        "grid": {"rows": nb_rows, "cols": nb_cols, "tiles": nb_rows * nb_cols},
+        "shard_tiles": shard_tiles,
+        "shards": shards,
+    }
+
+
+# ------------------------------------------------------------------ stage filters
+# (shared by the enhancement and prediction stages, which get this module in their images)
+
+def parse_tile_range(value):
+    """"start:stop" -> range (None for an unset or empty value: every index)."""
+    if not value:
+        return None
+    start, _, stop = value.partition(":")
+    return range(int(start or 0), int(stop) if stop else sys.maxsize)
+
+
+def tile_filter(tile_rows=None, tile_cols=None):
+    """Predicate on tile filenames ({tid}_{row}_{col}.tif) for TILE_ROWS / TILE_COLS."""
+    rows, cols = parse_tile_range(tile_rows), parse_tile_range(tile_cols)
+
+    def selected(filename):
+        match = re.search(r'_(\d+)_(\d+)\.tif$', filename)
+        if not match:
+            return False
+        return (rows is None or int(match.group(1)) in rows) and (cols is None or int(match.group(2)) in cols)
+
+    return selected
+
+
+# ------------------------------------------------------------------ local runner
+
+def run_stage(args, cwd, env=None):
+    """Runs one stage as its own process, like a Batch job; raises on a non-zero exit."""
+    python_path = os.pathsep.join([os.path.join(SRC_DIR, shared) for shared in SHARED_DIRS] + [os.environ.get("PYTHONPATH", "")])
+    result = subprocess.run([sys.executable] + args, cwd=cwd, env={**os.environ, "PYTHONPATH": python_path, **(env or {})},
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed ({result.returncode}):\n{result.stderr[-2000:]}")
+    return result.stdout
+
+
+def run_shard(shard):
+    """Acquisition -> enhancement -> prediction of one shard (one Map iteration)."""
+    env = {"TRANSACTION_ID": shard["transaction_id"], "TILE_ROWS": shard["tile_rows"], "TILE_COLS": shard["tile_cols"]}
+    run_stage(["BDC_Fetch.py", json.dumps({"shard": shard})], os.path.join(SRC_DIR, "acquisition"))
+    run_stage(["Image_Enhancement.py"], os.path.join(SRC_DIR, "enhancement"), env)
+    run_stage(["prediction.py"], os.path.join(SRC_DIR, "detection"), env)
+    return shard["index"]
+
+
+def run_local(plan, workers=4, report=True):
+    """
+    Runs a plan on this machine: shards in parallel (at most `workers` at a time, any
+    failure fails the run, like a Map state), then the merge step and the report.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for index in pool.map(run_shard, plan["shards"]):
+            print(f"Shard {index + 1}/{len(plan['shards'])} done")
+
+    merge_event = {"merge_shards": plan["transaction_id"], "tiles": plan["grid"]["tiles"]}
+    run_stage(["BDC_Fetch.py", json.dumps(merge_event)], os.path.join(SRC_DIR, "acquisition"))
+    if report:
+        run_stage(["report.py", "--transaction-id", plan["transaction_id"]], os.path.join(SRC_DIR, "report"))
+    print(f"Transaction {plan['transaction_id']}: {len(plan['shards'])} shards merged")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan or locally run a sharded transaction.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser("plan", help="Print the shard layout of a tile grid")
+    plan_parser.add_argument("--tiles-rows", type=int, required=True)
+    plan_parser.add_argument("--tiles-cols", type=int, required=True)
+    plan_parser.add_argument("--tiles-per-second", type=float, default=SHARD_TILES_PER_SECOND)
+    plan_parser.add_argument("--target-seconds", type=float, default=SHARD_TARGET_SECONDS)
+    plan_parser.add_argument("--max-workers", type=int, default=SHARD_MAX_WORKERS)
+
+    run_parser = subparsers.add_parser("run", help="Run a plan (JSON, as returned by the planning Lambda)")
+    run_parser.add_argument("plan", help="Plan JSON or path to a JSON file")
+    run_parser.add_argument("--workers", type=int, default=4)
+    run_parser.add_argument("--no-report", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        pixels = 256
+        plan = plan_shards("000000-0000-00-00", (10.0, 0.0, 0.0, 0.0, -10.0, 0.0),
+                           (args.tiles_rows * pixels, args.tiles_cols * pixels), None, {}, pixels,
+                           tiles_per_second=args.tiles_per_second, target_seconds=args.target_seconds,
+                           max_workers=args.max_workers)
+        print(f"{plan['grid']['tiles']} tiles -> {len(plan['shards'])} shards of up to {plan['shard_tiles']} tiles "
+              f"(~{plan['shard_tiles'] / args.tiles_per_second:.0f} s each at {args.tiles_per_second} tiles/s)")
+        for shard in plan["shards"]:
+            print(f"  shard {shard['index']}: rows {shard['tile_rows']}, cols {shard['tile_cols']}")
+    else:
+        text = open(args.plan).read() if os.path.exists(args.plan) else args.plan
+        run_local(json.loads(text), args.workers, report=not args.no_report)
@@ -0,0 +1,116 @@
+import os
+import re
+import boto3
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+
+import metrics
+
+# AWS S3 Setup
+s3 = metrics.watch_s3(boto3.client("s3"))
+BUCKET_NAME = "satellite-ml-solarp-detection-data"
+
+# Probabilities are stored as uint8: p in [0, 1] -> round(p * 255)
+PROBABILITY_SCALE = 255
+
+
+
+# Function to sort files numerically
+def numeric_sort_key(filepath):
+
+    match = re.search(r'\d+', filepath)
+    return int(match.group()) if match else 0
+
+
+
+def list_tif_keys(prefix):
+
+    """Lists every .tif key under an S3 prefix (paginated), sorted numerically."""
+
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = []
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".tif"))
+
+    return sorted(keys, key=numeric_sort_key)
+
+
+
+def quantize_probabilities(probabilities):
+
+    """Quantizes sigmoid outputs in [0, 1] to uint8 (1/255 resolution)."""
+
+    quantized = np.rint(np.clip(probabilities, 0, 1) * PROBABILITY_SCALE)
+    return quantized.astype(np.uint8)
+
+
+
+def threshold_probabilities(quantized, threshold):
+
+    """Binarizes a quantized probability map, matching `p > threshold` up to 1/255."""
+
+    return (quantized > threshold * PROBABILITY_SCALE).astype(np.uint8)
+
+
+
+# Function to save prediction to S3
+def save_prediction_s3(pred_mask, metadata, s3_key):
+
+    """Writes a binary (0/1) mask to S3 as a 1-bit, deflate-compressed GeoTIFF."""
+
+    metadata.update(
+        dtype=rasterio.uint8,
+        count=1,
+        nodata=None,
+        nbits=1,
+        compress="deflate"
+    )
+
+    with metrics.span("encode"), MemoryFile() as memfile:
+        with memfile.open(**metadata) as dataset:
+            dataset.write(pred_mask.astype(np.uint8), 1)
+        buffer = memfile.read()
+
+    with metrics.span("upload"):
+        s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=buffer)
+    metrics.count("bytes_out", len(buffer))
+    print(f"Saved Prediction: {s3_key}")
+
+
+
+def save_probability_s3(quantized, metadata, s3_key):
+
+    """Writes a quantized (uint8) probability map to S3 as a deflate-compressed GeoTIFF."""
+
+    metadata.update(
+        dtype=rasterio.uint8,
+        count=1,
+        nodata=None,
+        compress="deflate",
+        predictor=2,
+    )
+
+    with metrics.span("encode"), MemoryFile() as memfile:
+        with memfile.open(**metadata) as dataset:
+            dataset.write(quantized, 1)
+        buffer = memfile.read()
+
+    with metrics.span("upload"):
+        s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=buffer)
+    metrics.count("bytes_out", len(buffer))
+    print(f"Saved Probabilities: {s3_key}")
+
+
+
+def read_probability_s3(s3_key):
+
+    """Reads a quantized probability map and its metadata from S3."""
+
+    obj = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
+    with MemoryFile(obj["Body"].read()) as memfile:
+        with memfile.open() as dataset:
+            quantized = dataset.read(1)
+            metadata = dataset.meta.copy()
+
+    return quantized, metadata
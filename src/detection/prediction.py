@@ -6,12 +6,22 @@ import rasterio
 from rasterio.io import MemoryFile
 from segmentation_models_pytorch import Unet
 import argparse
-import re
 import io
+import json
 from sklearn.preprocessing import MinMaxScaler
+from mask_io import (
+    save_prediction_s3,
+    save_probability_s3,
+    quantize_probabilities,
+    list_tif_keys,
+)
+
+import metrics
+import sharding
+import global_grid
 
 # AWS S3 Setup
-s3 = boto3.client("s3")
+s3 = metrics.watch_s3(boto3.client("s3"))
 BUCKET_NAME = "satellite-ml-solarp-detection-data"
 
 # Model Setup
@@ -20,6 +30,13 @@ CLASSES = ['solar_panel']
 ACTIVATION = 'sigmoid'
 THRESHOLD = 0.5  # Adjust threshold if needed
 
+# Keep the raw sigmoid output (uint8) so masks can be re-thresholded without re-inference
+SAVE_PROBABILITIES = os.getenv("SAVE_PROBABILITIES", "false").lower() in ("1", "true", "yes")
+
+# Shard of a sharded transaction: "start:stop" tile rows / columns (unset: every tile)
+TILE_ROWS = os.getenv("TILE_ROWS")
+TILE_COLS = os.getenv("TILE_COLS")
+
 # Set device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -44,103 +61,110 @@ print("Model loaded successfully.")
 # Function to read image from S3
 def read_image_s3(s3_key):
 
-    obj = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
-    with MemoryFile(obj["Body"].read()) as memfile:
+    with metrics.span("download"):
+        body = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)["Body"].read()
+    metrics.count("bytes_in", len(body))
+    with metrics.span("decode"), MemoryFile(body) as memfile:
         with memfile.open() as dataset:
-            image_data = dataset.read().astype(np.float32)
+            image_data = normalize_bands(dataset.read().astype(np.float32))
             metadata = dataset.meta.copy()
 
-            # Normalize dynamically per image
-            #min_vals = image_data.min(axis=(1,2), keepdims=True)
-            #max_vals = image_data.max(axis=(1,2), keepdims=True)
+    print(f"Raw Image Shape Before Tensor Conversion: {image_data.shape}")  # Debug print
 
-            #image_data = (image_data - min_vals) / (max_vals - min_vals + 1e-8)
-            #image_data = np.clip(image_data, 0, 1)
+    return image_data, metadata
 
-            # Reshape image to apply MinMaxScaler
-            for band in range(image_data.shape[0]):
-                min_val = image_data[band].min()
-                max_val = image_data[band].max()
-                if max_val > min_val:
-                    image_data[band] = (image_data[band] - min_val) / (max_val - min_val)
 
-          
-    print(f"Raw Image Shape Before Tensor Conversion: {image_data.shape}")  # Debug print
 
-    return image_data, metadata
+# Normalize each band of a float32 (bands, H, W) image to [0, 1] with its own min/max (in place)
+def normalize_bands(image_data):
 
+    # Normalize dynamically per image
+    #min_vals = image_data.min(axis=(1,2), keepdims=True)
+    #max_vals = image_data.max(axis=(1,2), keepdims=True)
 
+    #image_data = (image_data - min_vals) / (max_vals - min_vals + 1e-8)
+    #image_data = np.clip(image_data, 0, 1)
+
+    # Reshape image to apply MinMaxScaler
+    for band in range(image_data.shape[0]):
+        min_val = image_data[band].min()
+        max_val = image_data[band].max()
+        if max_val > min_val:
+            image_data[band] = (image_data[band] - min_val) / (max_val - min_val)
+
+    return image_data
 
-# Function to save prediction to S3
-def save_prediction_s3(pred_mask, metadata, s3_key):
-    
-    metadata.update(
-        dtype=rasterio.float32,
-        count=1,
-        compress="lzw"
-    )
 
-    with MemoryFile() as memfile:
-        with memfile.open(**metadata) as dataset:
-            dataset.write(pred_mask, 1)
-        buffer = memfile.read()
 
-    s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=buffer)
-    print(f"Saved Prediction: {s3_key}")
+# Run the model on one normalized (bands, H, W) image; returns the sigmoid output (1, 1, H, W)
+def run_model(image_data):
 
+    # Convert to tensor
+    image_tensor = torch.tensor(image_data, dtype=torch.float32).unsqueeze(0).to(device)
+    print(f"Image Tensor Shape Before Model: {image_tensor.shape}")  # Debug print
 
+    expected_height = (image_tensor.shape[2] % 32 == 0)
+    expected_width = (image_tensor.shape[3] % 32 == 0)
 
-# Function to sort files numerically
-def numeric_sort_key(filepath):
+    if not expected_height or not expected_width:
+        print(f"Warning: Model input shape is not divisible by 32! Shape = {image_tensor.shape}")
 
-    match = re.search(r'\d+', filepath)
-    return int(match.group()) if match else 0
+    # Run inference (CUDA runs asynchronously: synchronize so the span covers the GPU work)
+    with metrics.span("inference"):
+        prediction = model(image_tensor)
+        if metrics.METRICS_ENABLED and device.type == "cuda":
+            torch.cuda.synchronize()
+
+    return prediction
 
 
 
 # Main Processing Function
-def process_images():
+def process_images(transaction_id):
 
-    transaction_id = os.getenv("TRANSACTION_ID")
     print(f"Processing Prediction for Transaction ID: {transaction_id}")
+    part = f"{TILE_ROWS or ''}_{TILE_COLS or ''}".replace(":", "-") if TILE_ROWS or TILE_COLS else None
+    metrics.start("prediction", transaction_id, part)
 
     input_s3_folder = f"image_enhancement/{transaction_id}/"
     output_s3_folder = f"predictions/{transaction_id}/"
+    probability_s3_folder = f"probabilities/{transaction_id}/"
 
-    # List images from S3
-    response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=input_s3_folder)
-    if "Contents" not in response:
+    # List images from S3 (paginated), only this shard's tiles in a sharded transaction
+    in_shard = sharding.tile_filter(TILE_ROWS, TILE_COLS)
+    image_keys = [key for key in list_tif_keys(input_s3_folder) if in_shard(os.path.basename(key))]
+    if not image_keys:
         print(f"No images found in S3 path: {input_s3_folder}")
         return
+    nb_of_tiles = len(image_keys)
 
-    image_keys = sorted(
-        [obj["Key"] for obj in response["Contents"] if obj["Key"].endswith(".tif")],
-        key=numeric_sort_key
-    )
+    # Global tiling: tiles whose prediction came from the cell cache are not predicted again
+    needed = {"predictions", "probabilities"} if SAVE_PROBABILITIES else {"predictions"}
+    cached_stages = global_grid.cached_tile_stages(s3, BUCKET_NAME, transaction_id)
+    image_keys = [key for key in image_keys if not needed <= cached_stages.get(os.path.basename(key), set())]
+    if len(image_keys) < nb_of_tiles:
+        print(f"{nb_of_tiles - len(image_keys)} of {nb_of_tiles} tiles predicted from the cell cache")
+    metrics.count("tiles", nb_of_tiles)
+    metrics.count("cell_cache_hits", nb_of_tiles - len(image_keys))
 
     with torch.no_grad():
         for s3_key in image_keys:
             # Read image from S3
             image_data, metadata = read_image_s3(s3_key)
 
-            # Convert to tensor
-            image_tensor = torch.tensor(image_data, dtype=torch.float32).unsqueeze(0).to(device)
-            print(f"Image Tensor Shape Before Model: {image_tensor.shape}")  # Debug print
-
-            expected_height = (image_tensor.shape[2] % 32 == 0)
-            expected_width = (image_tensor.shape[3] % 32 == 0)
-
-            if not expected_height or not expected_width:
-                print(f"Warning: Model input shape is not divisible by 32! Shape = {image_tensor.shape}")
-
             # Run inference
-            prediction = model(image_tensor)
+            prediction = run_model(image_data)
+
+            if SAVE_PROBABILITIES:
+                probability_s3_key = probability_s3_folder + os.path.basename(s3_key)
+                quantized = quantize_probabilities(prediction.squeeze().cpu().numpy())
+                save_probability_s3(quantized, metadata.copy(), probability_s3_key)
 
             # Debug: Print stats BEFORE thresholding
             print(f"\nPrediction Stats BEFORE Thresholding (Range: {prediction.min().item()} to {prediction.max().item()})")
             print(f"Unique values (before thresholding): {torch.unique(prediction)}")
 
-            prediction = (prediction > THRESHOLD).int().cpu().numpy().astype(np.float32)
+            prediction = (prediction > THRESHOLD).cpu().numpy().astype(np.uint8)
 
             # Debug: Print stats AFTER thresholding
             print(f"\nPrediction Stats AFTER Thresholding (Range: {prediction.min()} to {prediction.max()})")
@@ -150,8 +174,29 @@ def process_images():
             output_s3_key = output_s3_folder + os.path.basename(s3_key)
             save_prediction_s3(prediction.squeeze(), metadata, output_s3_key)
 
+    # Completion marker, watched by the report job in incremental mode.
+    # Shards leave it to the merge step, once every shard is predicted.
+    if TILE_ROWS or TILE_COLS:
+        print(f"Shard rows {TILE_ROWS or ':'}, cols {TILE_COLS or ':'} of {transaction_id} completed.")
+        metrics.finish(s3, BUCKET_NAME)
+        return
+
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=f"{output_s3_folder}_SUCCESS",
+        Body=json.dumps({"tiles": nb_of_tiles}).encode("utf-8")
+    )
+
     print(f"Processing completed for {transaction_id}.")
+    metrics.finish(s3, BUCKET_NAME)
+
+# Transactions to process: TRANSACTION_IDS (comma separated, multi-site batches) or TRANSACTION_ID.
+# The model is loaded once for all of them.
+def transaction_ids_from_env():
+    ids = os.getenv("TRANSACTION_IDS") or os.getenv("TRANSACTION_ID") or ""
+    return [transaction_id.strip() for transaction_id in ids.split(",") if transaction_id.strip()]
 
 # Command-line arguments
 if __name__ == "__main__":
-    process_images()
+    for transaction_id in transaction_ids_from_env():
+        process_images(transaction_id)
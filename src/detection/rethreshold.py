@@ -0,0 +1,132 @@
+#
+# Regenerates prediction masks from the stored probability maps (see SAVE_PROBABILITIES
+# in prediction.py) with a new threshold. No model or torch import is needed, so a full
+# transaction is re-thresholded in seconds.
+#
+# Only the masks are rewritten: the report (mosaics, plants.csv/geojson, statistics,
+# results archive) still reflects the old threshold until the report job runs again.
+# --rerun-report submits it (REPORT_MODE=batch) once the masks are written; without it
+# the tool prints a warning that reports/<transaction_id>/ is stale. (Fused-pipeline
+# transactions keep no enhanced tiles, so their report cannot be rebuilt this way.)
+#
+
+import os
+import time
+import argparse
+import boto3
+import numpy as np
+from mask_io import (
+    PROBABILITY_SCALE,
+    list_tif_keys,
+    read_probability_s3,
+    save_prediction_s3,
+    threshold_probabilities,
+)
+
+# Report job of the workflow (see AWS.settings/step-function-definition.json)
+REPORT_JOB_QUEUE = os.getenv("REPORT_JOB_QUEUE", "arn:aws:batch:us-east-1:864981724706:job-queue/report-job-queue")
+REPORT_JOB_DEFINITION = os.getenv("REPORT_JOB_DEFINITION", "report-job:1")
+
+
+
+def sweep_thresholds(probability_keys, thresholds):
+
+    """Counts positive pixels for several thresholds from one read of each probability map."""
+
+    histogram = np.zeros(PROBABILITY_SCALE + 1, dtype=np.int64)
+    for s3_key in probability_keys:
+        quantized, _ = read_probability_s3(s3_key)
+        histogram += np.bincount(quantized.ravel(), minlength=PROBABILITY_SCALE + 1)
+
+    total_pixels = int(histogram.sum())
+    # positives_above[q] = number of pixels with value > q
+    positives_above = total_pixels - np.cumsum(histogram)
+
+    results = []
+    for threshold in thresholds:
+        q = int(np.floor(threshold * PROBABILITY_SCALE))
+        positives = int(positives_above[min(max(q, 0), PROBABILITY_SCALE)])
+        results.append((threshold, positives, positives / max(total_pixels, 1) * 100))
+
+    return total_pixels, results
+
+
+
+def rethreshold(transaction_id, threshold, output_s3_folder=None):
+
+    """Thresholds every probability map of a transaction and writes the masks to S3."""
+
+    start_time = time.time()
+
+    probability_s3_folder = f"probabilities/{transaction_id}/"
+    output_s3_folder = output_s3_folder or f"predictions/{transaction_id}/"
+
+    probability_keys = list_tif_keys(probability_s3_folder)
+    if not probability_keys:
+        print(f"No probability maps found in S3 path: {probability_s3_folder}")
+        return []
+
+    stats = []
+    for s3_key in probability_keys:
+        quantized, metadata = read_probability_s3(s3_key)
+        pred_mask = threshold_probabilities(quantized, threshold)
+        save_prediction_s3(pred_mask, metadata, output_s3_folder + os.path.basename(s3_key))
+
+        positives = int(np.count_nonzero(pred_mask))
+        stats.append((os.path.basename(s3_key), pred_mask.size, positives))
+
+    total_pixels = sum(s[1] for s in stats)
+    positive_pixels = sum(s[2] for s in stats)
+    print(f"Threshold {threshold}: {positive_pixels:,} / {total_pixels:,} positive pixels "
+          f"({positive_pixels / max(total_pixels, 1) * 100:.4f} %) over {len(stats)} tiles.")
+    print(f"Re-thresholding completed in {time.time() - start_time:.2f} seconds.")
+
+    return stats
+
+
+
+def submit_report_job(transaction_id):
+
+    """Submits the report job of a transaction (batch mode), which rebuilds every report artifact."""
+
+    response = boto3.client("batch").submit_job(
+        jobName=f"report-job-{transaction_id}",
+        jobQueue=REPORT_JOB_QUEUE,
+        jobDefinition=REPORT_JOB_DEFINITION,
+        containerOverrides={"environment": [
+            {"name": "TRANSACTION_ID", "value": transaction_id},
+            {"name": "REPORT_MODE", "value": "batch"},
+        ]},
+    )
+    print(f"Submitted report job {response['jobId']} for {transaction_id}.")
+    return response["jobId"]
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-threshold stored probability maps without re-running inference.")
+    parser.add_argument("--transaction-id", default=os.getenv("TRANSACTION_ID"), help="Transaction ID (default: $TRANSACTION_ID)")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Probability threshold for the new masks")
+    parser.add_argument("--output-prefix", default=None, help='S3 prefix for the masks (default: "predictions/<transaction_id>/")')
+    parser.add_argument("--sweep", type=float, nargs="+", help="Only report coverage for these thresholds; no masks are written")
+    parser.add_argument("--rerun-report", action="store_true", help="Submit the report job afterwards so the report uses the new masks")
+
+    args = parser.parse_args()
+
+    if not args.transaction_id:
+        parser.error("TRANSACTION_ID is missing.")
+
+    if args.sweep:
+        total_pixels, results = sweep_thresholds(list_tif_keys(f"probabilities/{args.transaction_id}/"), args.sweep)
+        print(f"Total pixels: {total_pixels:,}")
+        for threshold, positives, coverage in results:
+            print(f"  threshold {threshold:.3f}: {positives:,} positive pixels ({coverage:.4f} %)")
+    else:
+        stats = rethreshold(args.transaction_id, args.threshold, args.output_prefix)
+        # The report reads predictions/<transaction_id>/; masks written elsewhere leave it as is
+        if stats and args.output_prefix in (None, f"predictions/{args.transaction_id}/"):
+            if args.rerun_report:
+                submit_report_job(args.transaction_id)
+            else:
+                print(f"WARNING: reports/{args.transaction_id}/ (mosaics, plants, statistics, results archive) "
+                      f"still reflects the previous masks. Re-run the report job, e.g. with --rerun-report.")
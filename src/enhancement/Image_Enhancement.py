@@ -1,4 +1,5 @@
 import os
+import json
 import boto3
 import rasterio
 import numpy as np
@@ -10,20 +11,30 @@ import time
 import argparse
 import sys
 
+import metrics
+import sharding
+import global_grid
+
 
 # AWS S3 Setup
-s3 = boto3.client("s3")
+s3 = metrics.watch_s3(boto3.client("s3"))
 BUCKET_NAME = "satellite-ml-solarp-detection-data"
 
 # Set scale_factor internally
 SCALE_FACTOR = 2
 
+# Shard of a sharded transaction: "start:stop" tile rows / columns (unset: every tile)
+TILE_ROWS = os.getenv("TILE_ROWS")
+TILE_COLS = os.getenv("TILE_COLS")
+
 def read_image_s3(s3_key):
 
     """Reads a GeoTIFF image from S3 into memory."""
 
-    obj = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
-    with MemoryFile(obj["Body"].read()) as memfile:
+    with metrics.span("download"):
+        body = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)["Body"].read()
+    metrics.count("bytes_in", len(body))
+    with metrics.span("decode"), MemoryFile(body) as memfile:
         with memfile.open() as dataset:
             image_data = dataset.read()
             metadata = dataset.meta.copy()
@@ -54,24 +65,25 @@ def save_image_s3(image_data, metadata, s3_key):
 
     """Writes processed image back to S3."""
 
-    with MemoryFile() as memfile:
+    with metrics.span("encode"), MemoryFile() as memfile:
         with memfile.open(**metadata) as dataset:
             dataset.write(image_data)
         buffer = BytesIO(memfile.read())
 
-    s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=buffer.getvalue())
+    with metrics.span("upload"):
+        s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=buffer.getvalue())
+    metrics.count("bytes_out", buffer.getbuffer().nbytes)
     print(f"Uploaded: {s3_key}")
 
 
 
-def process_images():
+def process_images(transaction_id):
 
     """Main function to process images from S3."""
 
     start_time = time.time()
 
-    # Retrieve transaction_id and scale_factor from environment variables
-    transaction_id = os.getenv("TRANSACTION_ID")
+    # Retrieve scale_factor from environment variables
     scale_factor = SCALE_FACTOR  # Default = 2
 
     print(f"Processing Transaction ID: {transaction_id}")
@@ -81,37 +93,79 @@ def process_images():
         return
 
     print(f"Processing Transaction ID: {transaction_id} with scale factor {scale_factor}")
+    part = f"{TILE_ROWS or ''}_{TILE_COLS or ''}".replace(":", "-") if TILE_ROWS or TILE_COLS else None
+    metrics.start("image_enhancement", transaction_id, part)
+    in_shard = sharding.tile_filter(TILE_ROWS, TILE_COLS)
 
     s3_folder = f"acquisition/{transaction_id}/"
 
-    # List images from S3
-    response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=s3_folder)
-    if "Contents" not in response:
+    # List images from S3 (paginated: large AOIs have more than 1000 tiles)
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = [obj["Key"] for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=s3_folder) for obj in page.get("Contents", [])]
+    if not keys:
         print(f"No images found in S3 path: {s3_folder}")
         return
 
-    for obj in response["Contents"]:
-        filename = obj["Key"].split("/")[-1]
-        if not filename.endswith(".tif"):
-            continue  # Skip non-TIFF files
-
-        print(f"Processing: {filename}")
+    # Per-tile RGB min/max, lets the report normalize the mosaic in a single pass
+    tile_stats = {}
 
-        # Read image from S3
-        image_data, metadata = read_image_s3(obj["Key"])
+    # Global tiling: tiles whose enhanced image came from the cell cache are not recomputed
+    cached_stages = global_grid.cached_tile_stages(s3, BUCKET_NAME, transaction_id)
 
-        # Apply Bicubic Interpolation
-        upscaled_image, metadata = upscale_image(image_data, metadata, scale_factor)
+    for key in keys:
+        filename = key.split("/")[-1]
+        if not filename.endswith(".tif"):
+            continue  # Skip non-TIFF files
+        if not in_shard(filename):
+            continue  # Tile of another shard
 
-        # Upload enhanced image to S3
         output_s3_key = f"image_enhancement/{transaction_id}/{filename}"
-        save_image_s3(upscaled_image, metadata, output_s3_key)
+        metrics.count("tiles")
+        if "image_enhancement" in cached_stages.get(filename, ()):
+            print(f"Cached: {filename}")
+            metrics.count("cell_cache_hits")
+            upscaled_image, _ = read_image_s3(output_s3_key)
+        else:
+            print(f"Processing: {filename}")
+
+            # Read image from S3
+            image_data, metadata = read_image_s3(key)
+
+            # Apply Bicubic Interpolation
+            with metrics.span("upscale"):
+                upscaled_image, metadata = upscale_image(image_data, metadata, scale_factor)
+
+            # Upload enhanced image to S3
+            save_image_s3(upscaled_image, metadata, output_s3_key)
+
+        rgb = upscaled_image[:3].astype(np.float32)
+        tile_stats[filename] = {"min": float(rgb.min()), "max": float(rgb.max())}
+
+    # Shards write their own part, combined into manifest.json by the merge step
+    manifest_name = "manifest.json"
+    if TILE_ROWS or TILE_COLS:
+        manifest_name = f"manifest_{TILE_ROWS or ''}_{TILE_COLS or ''}.json".replace(":", "-")
+    manifest_key = f"image_enhancement/{transaction_id}/{manifest_name}"
+    s3.put_object(Bucket=BUCKET_NAME, Key=manifest_key, Body=json.dumps({"tiles": tile_stats}), ContentType="application/json")
+    print(f"Uploaded: {manifest_key}")
 
     total_time = time.time() - start_time
     print(f"Processing completed in {total_time:.2f} seconds.")
+    metrics.finish(s3, BUCKET_NAME)
+
+
+
+# Transactions to process: TRANSACTION_IDS (comma separated, multi-site batches) or TRANSACTION_ID
+def transaction_ids_from_env():
+    ids = os.getenv("TRANSACTION_IDS") or os.getenv("TRANSACTION_ID") or ""
+    return [transaction_id.strip() for transaction_id in ids.split(",") if transaction_id.strip()]
 
 
 
 if __name__ == "__main__":
-    process_images()
+    transaction_ids = transaction_ids_from_env()
+    if not transaction_ids:
+        print("ERROR: TRANSACTION_ID is missing.")
+    for transaction_id in transaction_ids:
+        process_images(transaction_id)
 
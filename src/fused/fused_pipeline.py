@@ -0,0 +1,181 @@
+#
+# Fused pipeline for small AOIs: acquisition -> enhancement -> prediction -> report in a
+# single process. Tiles stay in memory as arrays between the stages, so no acquisition
+# or enhancement object is written; only the prediction masks (predictions/{tid}/, and
+# probabilities/{tid}/ with SAVE_PROBABILITIES) and the report artifacts (reports/{tid}/)
+# are, under the same keys as in the distributed workflow.
+#
+# For a few tiles the distributed workflow is dominated by its overheads (compute
+# environment provisioning, three Batch container starts, S3 round trips per tile
+# and stage). The main Step Function therefore routes requests whose estimated tile
+# count (`estimated_tiles`, computed by /start) is at most 16 to this runner (the
+# RouteBySize choice), and the others to the stage-per-job chain. With TILING_MODE=global
+# the acquisition Lambda declines the fused run (no cell cache here) and the request
+# takes the stage-per-job chain as well.
+#
+# The stage code is reused as is: BDC_Fetch reads the COGs, compositing.py composites them,
+# Image_Enhancement.upscale_image enhances, prediction.run_model predicts and
+# report.seal_report publishes the report.
+#
+# Run with `python fused_pipeline.py '<request json>'` (or FUSED_REQUEST); the
+# transaction ID comes from TRANSACTION_ID, or is allocated when unset.
+#
+
+import os
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Stage modules are copied next to this file in the image; from the source tree they are in src/<stage>
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for stage_dir in ("acquisition", "enhancement", "detection", "report", "utils"):
+    sys.path.append(os.path.join(SRC_DIR, stage_dir))
+
+import numpy as np
+import torch
+import rasterio
+import pystac_client
+from rasterio.windows import Window
+
+import metrics
+import multi_site
+import BDC_Fetch
+from BDC_Fetch import BANDS, BDC_STAC_URL, COLLECTION, DEFAULT_DATETIME_RANGE
+from compositing import sub_image_pixels, compute_median_band, extract_tile
+from Image_Enhancement import upscale_image, SCALE_FACTOR
+from prediction import normalize_bands, run_model, THRESHOLD, SAVE_PROBABILITIES
+from mask_io import quantize_probabilities, save_prediction_s3, save_probability_s3
+from report import S3_BUCKET, get_s3, normalize_tile, place_tile, seal_report
+
+
+def acquire_tiles(event):
+    """
+    Median composite tiles of a single-site request, computed like the acquisition
+    Lambda (request tiling). Returns [(row, col, (4, H, W) float32 tile, transform, crs)]
+    and the grid shape (rows, cols).
+    """
+    site = multi_site.normalize_site(event)
+    datetime_range = event.get('datetime_range', DEFAULT_DATETIME_RANGE)
+    bbox = multi_site.site_bbox(site)
+
+    service = pystac_client.Client.open(BDC_STAC_URL)
+    with metrics.span("stac_search"):
+        items_list = list(service.search(bbox=bbox, datetime=datetime_range, collections=[COLLECTION]).items())
+    if not items_list:
+        raise ValueError("No images found for the given parameters.")
+
+    # Grid of the original bbox, read over the bbox extended by half a tile on every side
+    # (sizes from the COG header, like the multi-site and sharded acquisitions)
+    height, width = BDC_Fetch.window_shape(items_list[0], BANDS[0], bbox)
+    nb_rows, nb_cols = int(height / sub_image_pixels) + 1, int(width / sub_image_pixels) + 1
+    bbox = BDC_Fetch.extend_by_half_tile(items_list[0], bbox)
+
+    with ThreadPoolExecutor(max_workers=len(BANDS)) as pool:
+        reads = list(pool.map(lambda band: BDC_Fetch.read_multiple_items(items_list, band, bbox), BANDS))
+
+    nodata_value = -9999.0
+    medians = [compute_median_band(data_list).filled(nodata_value).astype('float32') for data_list, _, _ in reads]
+    reference_transform = reads[0][1][0]
+    reference_crs = reads[0][2][0]
+
+    tiles = []
+    for i in range(nb_rows):
+        for j in range(nb_cols):
+            row_start, col_start = i * sub_image_pixels, j * sub_image_pixels
+            stacked_tile = extract_tile(medians, row_start, col_start, nodata_value)
+            tile_window = Window(col_start, row_start, sub_image_pixels, sub_image_pixels)
+            tiles.append((i, j, stacked_tile, rasterio.windows.transform(tile_window, reference_transform), reference_crs))
+
+    print(f"{len(items_list)} items composited into {nb_rows} x {nb_cols} tiles")
+    return tiles, (nb_rows, nb_cols)
+
+
+def enhance_tiles(tiles):
+    """Bicubic upscaling of every tile (Image_Enhancement.upscale_image)."""
+    enhanced = []
+    for row, col, tile, transform, crs in tiles:
+        metadata = {"height": tile.shape[1], "width": tile.shape[2], "transform": transform}
+        with metrics.span("upscale"):
+            upscaled, metadata = upscale_image(tile, metadata, SCALE_FACTOR)
+        enhanced.append((row, col, upscaled.astype(np.float32), metadata["transform"], crs))
+    return enhanced
+
+
+def predict_tiles(transaction_id, tiles):
+    """
+    0/1 masks of the enhanced tiles (prediction.run_model, THRESHOLD), saved under
+    predictions/{tid}/ (and the probabilities under probabilities/{tid}/ with
+    SAVE_PROBABILITIES) like the prediction job, for the results archive and rethreshold.py.
+    """
+    masks = []
+    with torch.no_grad():
+        for row, col, tile, transform, crs in tiles:
+            prediction = run_model(normalize_bands(tile.copy()))
+            tile_name = f"{transaction_id}_{row:03}_{col:03}.tif"
+            metadata = {"driver": "GTiff", "height": tile.shape[1], "width": tile.shape[2], "transform": transform, "crs": crs}
+
+            if SAVE_PROBABILITIES:
+                quantized = quantize_probabilities(prediction.squeeze().cpu().numpy())
+                save_probability_s3(quantized, metadata.copy(), f"probabilities/{transaction_id}/{tile_name}")
+
+            mask = (prediction > THRESHOLD).cpu().numpy().astype(np.uint8).squeeze()
+            save_prediction_s3(mask, metadata, f"predictions/{transaction_id}/{tile_name}")
+            masks.append(mask)
+    return masks
+
+
+def build_mosaics(tiles, masks, grid_shape):
+    """Input and prediction mosaics, normalized with the group RGB min/max like the report job."""
+    rgb_tiles = [np.moveaxis(tile[:3], 0, -1) for _, _, tile, _, _ in tiles]
+    min_val = min(float(rgb.min()) for rgb in rgb_tiles)
+    max_val = max(float(rgb.max()) for rgb in rgb_tiles)
+
+    canvas = {}
+    for (row, col, _, transform, crs), rgb, mask in zip(tiles, rgb_tiles, masks):
+        place_tile(canvas, grid_shape, row, col, normalize_tile(rgb, min_val, max_val), mask, transform, crs)
+    return canvas["input"], canvas["prediction"], canvas["transform"], canvas["crs"]
+
+
+def run_fused(transaction_id, event):
+    """Runs the whole pipeline for one request and publishes its report."""
+    start_time = time.time()
+
+    with metrics.span("acquisition"):
+        tiles, grid_shape = acquire_tiles(event)
+    metrics.count("tiles", len(tiles))
+    print(f"Acquisition: {time.time() - start_time:.2f} seconds")
+
+    stage_start = time.time()
+    with metrics.span("enhancement"):
+        tiles = enhance_tiles(tiles)
+    print(f"Enhancement: {time.time() - stage_start:.2f} seconds")
+
+    stage_start = time.time()
+    with metrics.span("prediction"):
+        masks = predict_tiles(transaction_id, tiles)
+    print(f"Prediction: {time.time() - stage_start:.2f} seconds")
+
+    stage_start = time.time()
+    with metrics.span("mosaic"):
+        mosaics = build_mosaics(tiles, masks, grid_shape)
+    with metrics.span("seal"):
+        seal_report(transaction_id, grid_shape, *mosaics)
+    print(f"Report: {time.time() - stage_start:.2f} seconds")
+
+    print(f"Fused pipeline of {transaction_id} ({len(tiles)} tiles) completed in {time.time() - start_time:.2f} seconds")
+    return {"transaction_id": transaction_id, "tiles": len(tiles)}
+
+
+if __name__ == "__main__":
+    request_json = sys.argv[1] if len(sys.argv) > 1 else os.getenv("FUSED_REQUEST")
+    if not request_json:
+        sys.exit("Usage: python fused_pipeline.py '<request json>' (or set FUSED_REQUEST)")
+    request = json.loads(request_json)
+
+    transaction_id = os.getenv("TRANSACTION_ID") or BDC_Fetch.ID_Gen()
+    metrics.start("fused", transaction_id)
+    try:
+        print(json.dumps(run_fused(transaction_id, request)))
+    finally:
+        metrics.finish(get_s3(), S3_BUCKET)
@@ -0,0 +1,71 @@
+#
+# Per grid cell statistics of the prediction mosaic. Every cell is reduced in one
+# vectorized pass over a (rows, cell_h, cols, cell_w) view of the mosaic, areas come
+# from the mosaic's GeoTIFF transform, and the table keeps numeric columns so it can
+# be sorted, filtered and re-aggregated; formatting only happens in `statistics_html`.
+#
+
+import numpy as np
+import pandas as pd
+
+
+def pixel_area_m2(transform):
+    """Ground area of one pixel (map units of the CRS, metres for the BDC grids)."""
+    return abs(transform.a * transform.e - transform.b * transform.d)
+
+
+def mosaic_extent_m(shape, transform):
+    """(north-south, west-east) extent of a mosaic of `shape` pixels."""
+    return shape[0] * abs(transform.e), shape[1] * abs(transform.a)
+
+
+def cell_statistics(prediction_mosaic, grid_shape, transform, plants=None):
+    """
+    Statistics of every grid cell (numbered 1, 2, ... row by row) of a prediction
+    mosaic (non-zero = positive). `plants` is the plants table with its "Cell"
+    column; plants are counted in the cell holding their centroid.
+    """
+    rows, cols = grid_shape
+    cell_h, cell_w = prediction_mosaic.shape[0] // rows, prediction_mosaic.shape[1] // cols
+
+    cells = prediction_mosaic[:rows * cell_h, :cols * cell_w].reshape(rows, cell_h, cols, cell_w)
+    positive_pixels = np.count_nonzero(cells, axis=(1, 3)).ravel()
+    cell_pixels = cell_h * cell_w
+    area = pixel_area_m2(transform)
+
+    cell_row, cell_col = np.divmod(np.arange(rows * cols), cols)
+    stats = pd.DataFrame({
+        "Cell": np.arange(1, rows * cols + 1),
+        "Row": cell_row + 1,
+        "Col": cell_col + 1,
+        "Total Pixels": np.full(rows * cols, cell_pixels, dtype=np.int64),
+        "Total Area (km^2)": np.full(rows * cols, cell_pixels * area * 1e-6),
+        "Positive Pixels": positive_pixels.astype(np.int64),
+        "Positive Area (m^2)": positive_pixels * area,
+        "Coverage %": positive_pixels / cell_pixels * 100,
+    })
+
+    if plants is not None:
+        per_cell = plants.groupby("Cell").agg(**{
+            "Plants": ("Plant", "size"),
+            "Plant Area (m^2)": ("Area (m^2)", "sum"),
+        })
+        stats = stats.join(per_cell, on="Cell")
+        stats["Plants"] = stats["Plants"].fillna(0).astype(np.int64)
+        stats["Plant Area (m^2)"] = stats["Plant Area (m^2)"].fillna(0.0)
+
+    return stats
+
+
+def statistics_html(stats):
+    """HTML table of `cell_statistics` with thousands separators and fixed decimals."""
+    formatters = {
+        "Total Pixels": "{:,}".format,
+        "Total Area (km^2)": "{:,.3f}".format,
+        "Positive Pixels": "{:,}".format,
+        "Positive Area (m^2)": "{:,.0f}".format,
+        "Coverage %": "{:.4f}".format,
+        "Plants": "{:,}".format,
+        "Plant Area (m^2)": "{:,.0f}".format,
+    }
+    return stats.to_html(index=False, formatters={k: v for k, v in formatters.items() if k in stats.columns})
@@ -0,0 +1,193 @@
+#
+# Change detection between the periods of a time series (one transaction per date
+# window, all acquired on the same global cells, see acquisition/global_grid.py).
+# For every pair of consecutive windows, each cell's prediction masks are compared:
+# new solar area (positive after, not before), removed area (the reverse) and
+# unchanged area. Components smaller than MIN_PLANT_AREA_M2 are removed from both
+# windows first (over the mosaic of the compared cells), as in the window reports. Results go to reports/{series_id}/: a per-cell table (CSV and
+# Parquet) and a change map (PNG) per pair, summary.json and report.html.
+#
+# Run with `python report.py --mode changes --transaction-id <series_id>`.
+#
+
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from report import S3_BUCKET, FETCH_WORKERS, MIN_PLANT_AREA_M2, get_s3, read_mask_s3, encode_png, report_s3_folder
+from cell_stats import pixel_area_m2
+import metrics
+
+SERIES_MANIFEST = "series.json"
+
+# Change map colors (RGB)
+NEW_COLOR = (0, 255, 0)
+REMOVED_COLOR = (255, 0, 0)
+UNCHANGED_COLOR = (0, 255, 255)
+
+
+def read_json_s3(key):
+    return json.loads(get_s3().get_object(Bucket=S3_BUCKET, Key=key)["Body"].read())
+
+
+def window_label(datetime_range):
+    return datetime_range.replace("/", "_")
+
+
+def cell_tiles(transaction_id):
+    """{cell_id: (tile filename, row, col)} of a transaction acquired with global tiling."""
+    manifest = read_json_s3(f"acquisition/{transaction_id}/cells.json")
+    return {tile["cell"]: (name, tile["row"], tile["col"]) for name, tile in manifest["tiles"].items()}
+
+
+def window_mosaic(transaction_id, cells, grid_origin, grid_shape, workers=FETCH_WORKERS):
+    """
+    Prediction mosaic (0/1 uint8) of the given cells of a window, with small components
+    removed like in the window's own report. `cells`: {cell_id: (tile filename, row, col)}.
+    Returns the mosaic and its transform.
+    """
+    from rasterio import Affine
+    from postprocess import remove_small_components
+
+    def read(item):
+        cell, (name, row, col) = item
+        return row, col, read_mask_s3(f"predictions/{transaction_id}/{name}")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        masks = list(pool.map(read, cells.items()))
+
+    row0, col0 = grid_origin
+    tile_h, tile_w = masks[0][2][0].shape
+    mosaic = np.zeros((grid_shape[0] * tile_h, grid_shape[1] * tile_w), dtype=np.uint8)
+    for row, col, (mask, transform, crs) in masks:
+        if mask.shape != (tile_h, tile_w):
+            raise ValueError(f"Cell shapes differ in {transaction_id}: {mask.shape}, expected {(tile_h, tile_w)}")
+        mosaic[(row - row0) * tile_h:(row - row0 + 1) * tile_h, (col - col0) * tile_w:(col - col0 + 1) * tile_w] = mask > 0
+
+    _, _, (_, tile_transform, crs) = masks[0]
+    first_row, first_col = masks[0][:2]
+    mosaic_transform = tile_transform * Affine.translation(-(first_col - col0) * tile_w, -(first_row - row0) * tile_h)
+    remove_small_components(mosaic, tile_h, mosaic_transform, crs, MIN_PLANT_AREA_M2)
+    return mosaic, mosaic_transform
+
+
+def compare_windows(before, after, workers=FETCH_WORKERS):
+    """
+    Per-cell change table and change map between two windows ({"datetime_range",
+    "transaction_id"} entries of the series manifest). Both windows are filtered with
+    the report's minimum plant area first, so the changes agree with their reports.
+    """
+    cells_before = cell_tiles(before["transaction_id"])
+    cells_after = cell_tiles(after["transaction_id"])
+    common = sorted(set(cells_before) & set(cells_after), key=lambda cell: cells_after[cell][1:])
+
+    row0 = min(cells_after[cell][1] for cell in common)
+    col0 = min(cells_after[cell][2] for cell in common)
+    rows = max(cells_after[cell][1] for cell in common) - row0 + 1
+    cols = max(cells_after[cell][2] for cell in common) - col0 + 1
+
+    mosaic_before, _ = window_mosaic(before["transaction_id"], {cell: cells_before[cell] for cell in common}, (row0, col0), (rows, cols), workers)
+    mosaic_after, transform = window_mosaic(after["transaction_id"], {cell: cells_after[cell] for cell in common}, (row0, col0), (rows, cols), workers)
+    if mosaic_before.shape != mosaic_after.shape:
+        raise ValueError(f"Cell shapes differ: {before['transaction_id']} {mosaic_before.shape}, {after['transaction_id']} {mosaic_after.shape}")
+
+    tile_h, tile_w = mosaic_after.shape[0] // rows, mosaic_after.shape[1] // cols
+    change_map = np.zeros((rows * tile_h, cols * tile_w, 3), dtype=np.uint8)
+    area = pixel_area_m2(transform)
+
+    records = []
+    for cell in common:
+        _, row, col = cells_after[cell]
+        slot = (slice((row - row0) * tile_h, (row - row0 + 1) * tile_h), slice((col - col0) * tile_w, (col - col0 + 1) * tile_w))
+        cell_before, cell_after = mosaic_before[slot] > 0, mosaic_after[slot] > 0
+        new, removed, unchanged = cell_after & ~cell_before, cell_before & ~cell_after, cell_before & cell_after
+        new_pixels, removed_pixels = int(np.count_nonzero(new)), int(np.count_nonzero(removed))
+        records.append({
+            "Cell": cell,
+            "Row": row,
+            "Col": col,
+            "New Pixels": new_pixels,
+            "Removed Pixels": removed_pixels,
+            "New Area (m^2)": new_pixels * area,
+            "Removed Area (m^2)": removed_pixels * area,
+            "Unchanged Area (m^2)": np.count_nonzero(unchanged) * area,
+            "Net Change (m^2)": (new_pixels - removed_pixels) * area,
+        })
+
+        view = change_map[slot]
+        view[unchanged] = UNCHANGED_COLOR
+        view[new] = NEW_COLOR
+        view[removed] = REMOVED_COLOR
+
+    return pd.DataFrame.from_records(records), change_map
+
+
+def changes_html(series_id, pairs):
+    sections = []
+    for pair in pairs:
+        changed = pair["table"][(pair["table"]["New Pixels"] > 0) | (pair["table"]["Removed Pixels"] > 0)]
+        table = changed.sort_values("Net Change (m^2)", ascending=False).to_html(
+            index=False, float_format="{:,.0f}".format
+        )
+        sections.append(f"""
+<h3>{pair['before']} &rarr; {pair['after']}</h3>
+<p>New: {pair['new_m2']:,.0f} m^2 | Removed: {pair['removed_m2']:,.0f} m^2 | Net: {pair['new_m2'] - pair['removed_m2']:,.0f} m^2
+ | Tables: <a href='{pair['folder']}changes.csv'>changes.csv</a>, <a href='{pair['folder']}changes.parquet'>changes.parquet</a></p>
+<p><img src='{pair['folder']}change_map.png' width='800'><br>
+<span style='color: rgb{NEW_COLOR}'>&#9632;</span> new
+<span style='color: rgb{REMOVED_COLOR}'>&#9632;</span> removed
+<span style='color: rgb{UNCHANGED_COLOR}'>&#9632;</span> unchanged</p>
+<h4>Cells with changes ({len(changed)} of {len(pair['table'])})</h4>
+{table}""")
+
+    return f"""
+<html>
+<head><title>Change Report {series_id}</title></head>
+<body>
+<h2>Change Report for {series_id}</h2>
+{''.join(sections)}
+</body>
+</html>
+"""
+
+
+def generate_change_report(series_id):
+    """Compares every pair of consecutive windows of a series and publishes the change report."""
+    s3 = get_s3()
+    report_folder = report_s3_folder(series_id)
+    series = read_json_s3(f"{report_folder}{SERIES_MANIFEST}")
+    windows = [window for window in series["windows"] if window.get("transaction_id") and not window.get("error")]
+    if len(windows) < 2:
+        raise ValueError(f"Series {series_id} needs at least two acquired windows, has {len(windows)}")
+
+    pairs = []
+    for before, after in zip(windows, windows[1:]):
+        with metrics.span("compare_windows", before=before["transaction_id"], after=after["transaction_id"]):
+            table, change_map = compare_windows(before, after)
+        metrics.count("cells", len(table))
+        folder = f"changes/{window_label(before['datetime_range'])}__{window_label(after['datetime_range'])}/"
+
+        s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}{folder}changes.csv", Body=table.to_csv(index=False).encode("utf-8"))
+        parquet = io.BytesIO()
+        table.to_parquet(parquet, index=False)
+        s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}{folder}changes.parquet", Body=parquet.getvalue())
+        s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}{folder}change_map.png", Body=encode_png(change_map))
+
+        pairs.append({
+            "before": before["datetime_range"],
+            "after": after["datetime_range"],
+            "folder": folder,
+            "table": table,
+            "new_m2": float(table["New Area (m^2)"].sum()),
+            "removed_m2": float(table["Removed Area (m^2)"].sum()),
+        })
+        print(f"{before['datetime_range']} -> {after['datetime_range']}: {pairs[-1]['new_m2']:,.0f} m^2 new, "
+              f"{pairs[-1]['removed_m2']:,.0f} m^2 removed over {len(table)} cells")
+
+    summary = [{key: value for key, value in pair.items() if key != "table"} for pair in pairs]
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}summary.json", Body=json.dumps({"series_id": series_id, "pairs": summary}).encode("utf-8"), ContentType="application/json")
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}report.html", Body=changes_html(series_id, pairs).encode("utf-8"))
+    print(f"Change report generated successfully: {report_folder}report.html")
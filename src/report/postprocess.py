@@ -0,0 +1,280 @@
+#
+# Post-processing of the prediction mosaic: connected components are labelled
+# strip by strip (one tile row at a time) and merged across strip seams with a
+# union-find, so a plant spanning several tiles gets a single label without
+# running one labelling pass over the whole mosaic.
+#
+
+import numpy as np
+import pandas as pd
+import cv2
+from rasterio import Affine
+from rasterio.features import shapes
+from rasterio.warp import transform as warp_transform, transform_geom
+from shapely.geometry import shape, mapping
+from shapely.ops import unary_union
+
+
+def _label_strip(strip):
+    """8-connected labelling of one strip; label 0 is the background."""
+    return cv2.connectedComponentsWithStats(strip, connectivity=8, ltype=cv2.CV_32S)
+
+
+def _find(parent, label):
+    while parent[label] != label:
+        parent[label] = parent[parent[label]]
+        label = parent[label]
+    return label
+
+
+def _seam_pairs(upper_row, lower_row):
+    """Pairs of global labels that touch across a strip seam (8-connectivity)."""
+    pairs = []
+    for upper, lower in (
+        (upper_row, lower_row),            # vertical neighbours
+        (upper_row[:-1], lower_row[1:]),   # diagonal down-right
+        (upper_row[1:], lower_row[:-1]),   # diagonal down-left
+    ):
+        touching = (upper > 0) & (lower > 0)
+        if touching.any():
+            pairs.append(np.stack([upper[touching], lower[touching]], axis=1))
+
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def label_components(mask, strip_height):
+    """
+    Labels the connected components of a binary mosaic (non-zero = foreground).
+
+    Returns:
+        component_of (np.ndarray): global strip label -> component index (-1 for background).
+        offsets (list): global label offset of each strip, needed to relabel strips later.
+        components (dict): per-component pixel statistics (area, centroid, bounding box).
+    """
+    height = mask.shape[0]
+    parent = [0]
+    offsets = []
+    stats_chunks = []
+    previous_last_row = None
+
+    for row_start in range(0, height, strip_height):
+        strip = mask[row_start:row_start + strip_height]
+        nb_labels, labels, stats, centroids = _label_strip(strip)
+
+        offset = len(parent) - 1
+        offsets.append(offset)
+        parent.extend(range(offset + 1, offset + nb_labels))
+
+        # Per-label statistics in mosaic coordinates (skip background label 0)
+        area = stats[1:, cv2.CC_STAT_AREA].astype(np.int64)
+        left = stats[1:, cv2.CC_STAT_LEFT]
+        top = stats[1:, cv2.CC_STAT_TOP] + row_start
+        stats_chunks.append(np.column_stack([
+            area,
+            centroids[1:, 0] * area,
+            (centroids[1:, 1] + row_start) * area,
+            left,
+            top,
+            left + stats[1:, cv2.CC_STAT_WIDTH] - 1,
+            top + stats[1:, cv2.CC_STAT_HEIGHT] - 1,
+        ]))
+
+        # Merge labels touching across the seam with the previous strip
+        first_row = np.where(labels[0] > 0, labels[0] + offset, 0)
+        if previous_last_row is not None:
+            for upper, lower in _seam_pairs(previous_last_row, first_row):
+                root_upper, root_lower = _find(parent, upper), _find(parent, lower)
+                if root_upper != root_lower:
+                    parent[max(root_upper, root_lower)] = min(root_upper, root_lower)
+
+        previous_last_row = np.where(labels[-1] > 0, labels[-1] + offset, 0)
+
+    # Resolve every label to its root, then to a dense component index
+    parent = np.asarray(parent, dtype=np.int64)
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    roots, component_index = np.unique(parent[1:], return_inverse=True)
+    component_of = np.concatenate([[-1], component_index])
+    nb_components = len(roots)
+
+    label_stats = np.concatenate(stats_chunks) if stats_chunks else np.empty((0, 7))
+    area = np.bincount(component_index, weights=label_stats[:, 0], minlength=nb_components)
+    sum_x = np.bincount(component_index, weights=label_stats[:, 1], minlength=nb_components)
+    sum_y = np.bincount(component_index, weights=label_stats[:, 2], minlength=nb_components)
+
+    col_min = np.full(nb_components, np.iinfo(np.int64).max)
+    row_min = np.full(nb_components, np.iinfo(np.int64).max)
+    col_max = np.full(nb_components, -1)
+    row_max = np.full(nb_components, -1)
+    np.minimum.at(col_min, component_index, label_stats[:, 3].astype(np.int64))
+    np.minimum.at(row_min, component_index, label_stats[:, 4].astype(np.int64))
+    np.maximum.at(col_max, component_index, label_stats[:, 5].astype(np.int64))
+    np.maximum.at(row_max, component_index, label_stats[:, 6].astype(np.int64))
+
+    components = {
+        "area": area.astype(np.int64),
+        "centroid_col": sum_x / np.maximum(area, 1),
+        "centroid_row": sum_y / np.maximum(area, 1),
+        "col_min": col_min,
+        "row_min": row_min,
+        "col_max": col_max,
+        "row_max": row_max,
+    }
+
+    return component_of, offsets, components
+
+
+def _relabel_strips(mask, strip_height, offsets):
+    """Re-runs the strip labelling of `label_components`, yielding global labels per strip."""
+    for strip_index, row_start in enumerate(range(0, mask.shape[0], strip_height)):
+        strip = mask[row_start:row_start + strip_height]
+        _, labels, _, _ = _label_strip(strip)
+        yield row_start, strip, np.where(labels > 0, labels + offsets[strip_index], 0)
+
+
+def filter_components(mask, strip_height, component_of, offsets, keep, on_strip=None):
+    """
+    Zeros (in place) the pixels of every component whose `keep` flag is False.
+    `on_strip(row_start, components)` is called with the filtered component index
+    raster (-1 = background) of each strip.
+    """
+    keep_label = np.concatenate([[True], keep[component_of[1:]]])
+
+    for row_start, strip, global_labels in _relabel_strips(mask, strip_height, offsets):
+        strip[~keep_label[global_labels]] = 0
+
+        if on_strip is not None:
+            kept_labels = np.where(keep_label[global_labels], global_labels, 0)
+            on_strip(row_start, np.where(kept_labels > 0, component_of[kept_labels], -1).astype(np.int32))
+
+    return mask
+
+
+class PolygonCollector:
+    """
+    Polygonizes component rasters strip by strip. Pieces of a component are kept
+    until the strip holding its last row is done, then merged across the strip
+    seams, simplified, reprojected to EPSG:4326 and handed to `on_polygon`.
+    """
+
+    def __init__(self, transform, crs, row_max, properties, on_polygon, tolerance=None):
+        self.transform = transform
+        self.crs = crs
+        self.row_max = row_max
+        self.properties = properties
+        self.on_polygon = on_polygon
+        self.tolerance = abs(transform.a) if tolerance is None else tolerance
+        self.pieces = {}
+
+    def add_strip(self, row_start, components):
+        strip_transform = self.transform * Affine.translation(0, row_start)
+        for geometry, component in shapes(components, mask=components >= 0, transform=strip_transform):
+            self.pieces.setdefault(int(component), []).append(shape(geometry))
+
+        row_end = row_start + components.shape[0]
+        for component in [c for c in self.pieces if self.row_max[c] < row_end]:
+            self._emit(component)
+
+    def close(self):
+        for component in list(self.pieces):
+            self._emit(component)
+
+    def _emit(self, component):
+        polygon = unary_union(self.pieces.pop(component))
+        polygon = polygon.simplify(self.tolerance, preserve_topology=True)
+        self.on_polygon({
+            "type": "Feature",
+            "geometry": transform_geom(self.crs, "EPSG:4326", mapping(polygon)),
+            "properties": self.properties(component),
+        })
+
+
+def plants_table(components, transform, crs, cell_shape=None, nb_of_cols=None):
+    """
+    Per-plant table: centroid lat/lon, area and bounding box in EPSG:4326.
+    With `cell_shape` (cell height, width in pixels) and `nb_of_cols`, each plant also
+    gets the number of the grid cell holding its centroid (1, 2, ... row by row).
+    """
+    pixel_area_m2 = abs(transform.a * transform.e)
+
+    # Pixel centres for centroids, pixel edges for bounding boxes
+    cx, cy = transform * (components["centroid_col"] + 0.5, components["centroid_row"] + 0.5)
+    west, north = transform * (components["col_min"], components["row_min"])
+    east, south = transform * (components["col_max"] + 1, components["row_max"] + 1)
+
+    lon, lat = warp_transform(crs, "EPSG:4326", list(cx), list(cy))
+    corner_lon, corner_lat = warp_transform(
+        crs, "EPSG:4326",
+        list(west) + list(east) + list(west) + list(east),
+        list(north) + list(north) + list(south) + list(south),
+    )
+    corner_lon = np.reshape(corner_lon, (4, -1))
+    corner_lat = np.reshape(corner_lat, (4, -1))
+
+    table = pd.DataFrame({
+        "Plant": np.arange(1, len(lon) + 1),
+        "Latitude": lat,
+        "Longitude": lon,
+        "Area (m^2)": components["area"] * pixel_area_m2,
+        "Pixels": components["area"],
+        "West": corner_lon.min(axis=0),
+        "South": corner_lat.min(axis=0),
+        "East": corner_lon.max(axis=0),
+        "North": corner_lat.max(axis=0),
+    })
+
+    if cell_shape is not None:
+        cell_row = components["centroid_row"].astype(np.int64) // cell_shape[0]
+        cell_col = components["centroid_col"].astype(np.int64) // cell_shape[1]
+        table.insert(1, "Cell", cell_row * nb_of_cols + cell_col + 1)
+
+    return table
+
+
+def remove_small_components(mask, strip_height, transform, crs, min_area_m2, on_polygon=None, cell_shape=None):
+    """
+    Drops connected components smaller than `min_area_m2` from the mosaic (in place)
+    and returns the table of the remaining plants, largest first.
+    If `on_polygon` is given, every remaining plant is also polygonized in the same
+    strip pass and passed to it as a GeoJSON feature (EPSG:4326).
+    If `cell_shape` is given, the table has the grid cell of each plant (see `plants_table`).
+    """
+    pixel_area_m2 = abs(transform.a * transform.e)
+
+    component_of, offsets, components = label_components(mask, strip_height)
+    keep = components["area"] * pixel_area_m2 >= min_area_m2
+    print(f"Connected components: {len(keep)} found, {int((~keep).sum())} below {min_area_m2} m^2 removed.")
+
+    # Plant numbers follow the table order (largest first)
+    kept_index = np.flatnonzero(keep)
+    kept_index = kept_index[np.argsort(-components["area"][kept_index], kind="stable")]
+    plant_number = np.zeros(len(keep), dtype=np.int64)
+    plant_number[kept_index] = np.arange(1, len(kept_index) + 1)
+
+    collector = None
+    if on_polygon is not None:
+        collector = PolygonCollector(
+            transform, crs, components["row_max"],
+            lambda c: {
+                "plant": int(plant_number[c]),
+                "area_m2": float(components["area"][c] * pixel_area_m2),
+                "pixels": int(components["area"][c]),
+            },
+            on_polygon,
+        )
+
+    if not keep.all() or collector is not None:
+        filter_components(mask, strip_height, component_of, offsets, keep,
+                          on_strip=collector.add_strip if collector is not None else None)
+    if collector is not None:
+        collector.close()
+
+    kept = {name: values[kept_index] for name, values in components.items()}
+    nb_of_cols = mask.shape[1] // cell_shape[1] if cell_shape is not None else None
+    return plants_table(kept, transform, crs, cell_shape, nb_of_cols)
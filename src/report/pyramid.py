@@ -0,0 +1,94 @@
+#
+# Multi-resolution tile pyramid (XYZ layout: <layer>/<z>/<x>/<y>.<ext>) of the report
+# mosaics, plus a small Leaflet viewer page. The highest zoom level is the full
+# resolution mosaic; each level below is a 2x downsampling of the previous one, down
+# to a single tile, so the browser only loads what is on screen.
+#
+
+import math
+import numpy as np
+import cv2
+
+TILE_SIZE = 256
+
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+
+def max_zoom_level(height, width, tile_size=TILE_SIZE):
+    """Zoom level of the full resolution mosaic (level 0 fits in one tile)."""
+    return max(0, math.ceil(math.log2(max(height, width) / tile_size)))
+
+
+def downsample_2x(image):
+    """Halves an image with 2x2 area averaging (odd edges are padded by replication)."""
+    h, w = image.shape[:2]
+    if h % 2 or w % 2:
+        image = cv2.copyMakeBorder(image, 0, h % 2, 0, w % 2, cv2.BORDER_REPLICATE)
+    return cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2), interpolation=cv2.INTER_AREA)
+
+
+def encode_tile(tile, tile_format="png"):
+    """Encodes an RGB uint8 tile; partial edge tiles are padded to a full tile."""
+    h, w = tile.shape[:2]
+    if h < TILE_SIZE or w < TILE_SIZE:
+        tile = cv2.copyMakeBorder(tile, 0, TILE_SIZE - h, 0, TILE_SIZE - w, cv2.BORDER_CONSTANT, value=0)
+
+    params = [cv2.IMWRITE_WEBP_QUALITY, 90] if tile_format == "webp" else [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    ok, buffer = cv2.imencode(f".{tile_format}", np.ascontiguousarray(tile[:, :, ::-1]), params)
+    if not ok:
+        raise ValueError(f"Could not encode tile as {tile_format}")
+    return buffer.tobytes()
+
+
+def iter_pyramid_tiles(image, tile_format="png"):
+    """Yields (z, x, y, encoded tile) for every level, full resolution first."""
+    level = image
+    for zoom in range(max_zoom_level(*image.shape[:2]), -1, -1):
+        h, w = level.shape[:2]
+        for y in range(0, h, TILE_SIZE):
+            for x in range(0, w, TILE_SIZE):
+                tile = level[y:y + TILE_SIZE, x:x + TILE_SIZE]
+                yield zoom, x // TILE_SIZE, y // TILE_SIZE, encode_tile(tile, tile_format)
+
+        if zoom > 0:
+            level = downsample_2x(level)
+
+
+def viewer_html(title, height, width, layers, tile_format="png"):
+    """Leaflet page (CRS.Simple) showing the pyramid layers of a `height` x `width` mosaic."""
+    max_zoom = max_zoom_level(height, width)
+    scale = 2 ** max_zoom
+    layer_js = ",\n".join(
+        f'        "{name}": L.tileLayer("tiles/{name}/{{z}}/{{x}}/{{y}}.{tile_format}", options)'
+        for name in layers
+    )
+
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<title>{title}</title>
+<meta charset="utf-8">
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {{ height: 100%; margin: 0; background: #000; }}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+    var bounds = [[-{height / scale}, 0], [0, {width / scale}]];
+    var map = L.map("map", {{crs: L.CRS.Simple, minZoom: 0, maxZoom: {max_zoom + 2}}});
+    var options = {{
+        tileSize: {TILE_SIZE}, noWrap: true, bounds: bounds,
+        minZoom: 0, maxNativeZoom: {max_zoom}, maxZoom: {max_zoom + 2}
+    }};
+    var layers = {{
+{layer_js}
+    }};
+    var names = Object.keys(layers);
+    layers[names[names.length - 1]].addTo(map);
+    L.control.layers(layers).addTo(map);
+    map.fitBounds(bounds);
+</script>
+</body>
+</html>
+"""
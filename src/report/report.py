@@ -1,226 +1,574 @@
+#
+# Report stage: builds the input/prediction mosaics of a transaction and publishes
+# the report (mosaics, pyramids, plants, statistics, report.html) to S3.
+#
+# Importing this module has no side effects and only loads the standard library and
+# NumPy; boto3, rasterio, OpenCV, pandas and the report helpers are imported by the
+# functions that need them. Run it with `python report.py` (TRANSACTION_ID from the
+# environment; src/utils on PYTHONPATH from the source tree) or call
+# `generate_report(transaction_id)`.
+#
+
 import os
 import re
 import io
+import json
+import base64
+import time
+import argparse
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
-import pandas as pd
-import boto3
-import cv2
-import rasterio
-import imageio.v2 as imageio
-import matplotlib.pyplot as plt
-
-# AWS S3 Setup
-s3 = boto3.client("s3")
-S3_BUCKET = "satellite-ml-solarp-detection-data"
 
-# Retrieve Transaction ID
-TRANSACTION_ID = os.getenv("TRANSACTION_ID")
-if not TRANSACTION_ID:
-    raise ValueError("TRANSACTION_ID environment variable is not set.")
+import metrics
 
-# Define S3 Paths
-input_s3_folder = f"image_enhancement/{TRANSACTION_ID}/"
-prediction_s3_folder = f"predictions/{TRANSACTION_ID}/"
-report_s3_folder = f"reports/{TRANSACTION_ID}/"
+# Concurrent tile downloads (one HTTP connection per worker)
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 16))
 
-# Function to extract row and column from filename
+S3_BUCKET = "satellite-ml-solarp-detection-data"
+
+# Zoomable viewer tiles: "png" or "webp"
+PYRAMID_TILE_FORMAT = os.getenv("PYRAMID_TILE_FORMAT", "png")
+
+# Connected components smaller than this are treated as noise and removed
+MIN_PLANT_AREA_M2 = float(os.getenv("MIN_PLANT_AREA_M2", 1000))
+
+# "batch": build the report once every prediction exists (default).
+# "incremental": run alongside the prediction job, publish a partial report.html as
+# prediction tiles land, and seal the final report once all tiles are in.
+# "changes": change report of a time series (TRANSACTION_ID is the series ID).
+REPORT_MODE = os.getenv("REPORT_MODE", "batch")
+REPORT_POLL_SECONDS = float(os.getenv("REPORT_POLL_SECONDS", 30))
+# Incremental mode gives up after the prediction job's own limit (its 2 h Batch attempt
+# timeout in the workflow) plus a margin, or as soon as the workflow marks it failed
+REPORT_TIMEOUT_SECONDS = float(os.getenv("REPORT_TIMEOUT_SECONDS", 2 * 3600 + 10 * 60))
+PREVIEW_MAX_SIZE = 1024  # longest side (px) of the partial report preview
+
+# Mosaic slot of one grid position: a 256 px acquisition tile upscaled x2 by the
+# enhancement stage. Larger tiles are clipped to it, smaller ones leave nodata (0) margins
+MOSAIC_TILE_PIXELS = int(os.getenv("MOSAIC_TILE_PIXELS", 512))
+
+# AWS S3 Setup (created on first use)
+@lru_cache(maxsize=None)
+def get_s3():
+    import boto3
+    from botocore.config import Config
+    return metrics.watch_s3(boto3.client("s3", config=Config(max_pool_connections=FETCH_WORKERS)))
+
+# S3 folders of a transaction
+def input_s3_folder(transaction_id):
+    return f"image_enhancement/{transaction_id}/"
+
+def prediction_s3_folder(transaction_id):
+    return f"predictions/{transaction_id}/"
+
+def report_s3_folder(transaction_id):
+    return f"reports/{transaction_id}/"
+
+# Written by the prediction job once every tile has been predicted
+def prediction_done_marker(transaction_id):
+    return f"{prediction_s3_folder(transaction_id)}_SUCCESS"
+
+# Written by the workflow (Catch of the prediction job) when the prediction job fails
+def prediction_failed_marker(transaction_id):
+    return f"{prediction_s3_folder(transaction_id)}_FAILED"
+
+# Function to extract row and column from filename (<transaction_id>_<row>_<col>.tif)
 def extract_row_col(filepath):
     match = re.findall(r'(\d+)', os.path.basename(filepath))
-    return (int(match[1]), int(match[2])) if len(match) >= 3 else (9999, 9999)
+    return (int(match[-2]), int(match[-1])) if len(match) >= 3 else (9999, 9999)
 
-# Function to list S3 files
+# Function to list S3 files (paginated, grids can exceed 1000 tiles)
 def list_s3_files(bucket, prefix):
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" not in response:
+    paginator = get_s3().get_paginator("list_objects_v2")
+    keys = [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get("Contents", [])
+        if obj["Key"].endswith(".tif")
+    ]
+    if not keys:
         raise FileNotFoundError(f"No files found in S3 path: {prefix}")
-    return sorted(
-        [obj["Key"] for obj in response["Contents"] if obj["Key"].endswith(".tif")],
-        key=extract_row_col
-    )
+    return sorted(keys, key=extract_row_col)
 
-# Fetch input and prediction image keys from S3
-input_images = list_s3_files(S3_BUCKET, input_s3_folder)
-prediction_images = list_s3_files(S3_BUCKET, prediction_s3_folder)
-
-# Determine grid size
-nb_of_rows = int(input_images[-1][-11:-8]) + 1
-nb_of_cols = int(input_images[-1][-7:-4]) + 1
-print(f"Grid shape: {nb_of_rows} rows x {nb_of_cols} cols.")
+# Determine grid size (rows, cols) from the input tile names
+def grid_shape_of(image_keys):
+    cells = [extract_row_col(key) for key in image_keys]
+    return max(row for row, _ in cells) + 1, max(col for _, col in cells) + 1
 
 # Read images from S3
 def read_image_s3(s3_key, to_rgb=True):
-    obj = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
+    import rasterio
+
+    obj = get_s3().get_object(Bucket=S3_BUCKET, Key=s3_key)
     img_bytes = io.BytesIO(obj["Body"].read())
-    
+    metrics.count("bytes_in", img_bytes.getbuffer().nbytes)
+
     with rasterio.open(img_bytes) as src:
         img = src.read().astype(np.float32)
         print(f"Successfully read {s3_key} (bands: {img.shape[0]}, shape: {img.shape[1:]})")
-        
+
         if to_rgb and img.shape[0] == 4:
             img = img[:3]
         elif img.shape[0] == 1:
             img = img[0]
-        
+
         if len(img.shape) == 3:
             img = np.moveaxis(img, 0, -1)
-        
+
         return img
 
-# Normalize images as a group
-def normalize_images_group(images):
-    min_val = np.min([np.min(img) for img in images])
-    max_val = np.max([np.max(img) for img in images])
-    
-    def normalize(img):
-        if max_val == min_val:
-            return np.zeros_like(img, dtype=np.uint8)
-        return ((img - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-    
-    return [normalize(img) for img in images]
-
-# Create mosaics
-def create_mosaic(image_keys, title, normalize=True):
-
-    images = [read_image_s3(key) for key in image_keys]
-
-    if title == "input":
-        if normalize:
-            images = normalize_images_group(images)
-
-    elif title == "prediction":
-        images = [(img > 0).astype(np.uint8) * 255 for img in images]
-
-    mosaic = np.vstack([
-        np.hstack(images[i * nb_of_cols:(i + 1) * nb_of_cols])
-        for i in range(nb_of_rows)
-    ])
-    
-    mosaic = mosaic.astype(np.uint8)
-    
-    # Save the mosaic
-    mosaic_key = f"{report_s3_folder}{title}.png"
-    image_bytes = io.BytesIO()
-    imageio.imwrite(image_bytes, mosaic, format="png")
-    s3.put_object(Bucket=S3_BUCKET, Key=mosaic_key, Body=image_bytes.getvalue())
+# Read 1-bit/uint8 prediction masks (0 = background, 1 = solar plant) and their georeference
+def read_mask_s3(s3_key):
+    import rasterio
+
+    obj = get_s3().get_object(Bucket=S3_BUCKET, Key=s3_key)
+    body = obj["Body"].read()
+    metrics.count("bytes_in", len(body))
+
+    with rasterio.open(io.BytesIO(body)) as src:
+        mask = src.read(1)
+        transform, crs = src.transform, src.crs
+
+    # float32 masks written before the 1-bit encoding
+    if mask.dtype != np.uint8:
+        mask = (mask > 0).astype(np.uint8)
+
+    print(f"Successfully read mask {s3_key} (shape: {mask.shape})")
+    return mask, transform, crs
+
+# Per-tile fetch + decode latency (seconds) of every tile read by this report
+tile_fetch_latencies = []
+
+# Fetch tiles concurrently, yielding (row, col, result) as they arrive (any order).
+# At most 2 * max_workers tiles are in flight so memory stays bounded.
+def fetch_tiles(tiles, reader, max_workers=FETCH_WORKERS):
+    """tiles: iterable of (row, col, keys); reader(keys) downloads and decodes one tile."""
+
+    def timed_read(keys):
+        start = time.perf_counter()
+        with metrics.span("tile_fetch"):
+            result = reader(keys)
+        return result, time.perf_counter() - start
+
+    latencies = []
+    tiles = iter(tiles)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+
+        def submit_next():
+            for row, col, keys in tiles:
+                pending[pool.submit(timed_read, keys)] = (row, col)
+                return
+
+        for _ in range(2 * max_workers):
+            submit_next()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                row, col = pending.pop(future)
+                result, latency = future.result()
+                latencies.append(latency)
+                submit_next()
+                yield row, col, result
+
+    tile_fetch_latencies.extend(latencies)
+    if latencies:
+        print(f"Fetched {len(latencies)} tiles with {max_workers} workers. Latency (s): "
+              f"mean {np.mean(latencies):.3f}, p50 {np.percentile(latencies, 50):.3f}, "
+              f"p95 {np.percentile(latencies, 95):.3f}, max {np.max(latencies):.3f}")
+
+# Read the enhancement manifest (per-tile RGB min/max), None if missing
+def read_manifest_s3(prefix):
+    s3 = get_s3()
+    try:
+        obj = s3.get_object(Bucket=S3_BUCKET, Key=f"{prefix}manifest.json")
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(obj["Body"].read())
+
+# Group min/max of the input tiles, used to normalize all of them alike
+def group_min_max(image_keys):
+    manifest = read_manifest_s3(os.path.dirname(image_keys[0]) + "/")
+    tile_stats = (manifest or {}).get("tiles", {})
+    names = [os.path.basename(key) for key in image_keys]
+
+    if all(name in tile_stats for name in names):
+        print("Using group min/max from the enhancement manifest.")
+        return (min(tile_stats[name]["min"] for name in names),
+                max(tile_stats[name]["max"] for name in names))
+
+    # Fallback: first streaming pass, only the per-tile min/max is kept
+    def read_min_max(key):
+        img = read_image_s3(key)
+        return float(img.min()), float(img.max())
+
+    min_val, max_val = np.inf, -np.inf
+    for _, _, (tile_min, tile_max) in fetch_tiles(((0, 0, key) for key in image_keys), read_min_max):
+        min_val = min(min_val, tile_min)
+        max_val = max(max_val, tile_max)
+    return min_val, max_val
+
+# Normalize one tile with the group min/max
+def normalize_tile(img, min_val, max_val):
+    if max_val == min_val:
+        return np.zeros_like(img, dtype=np.uint8)
+    return ((img - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+
+# Pair input and prediction tiles by grid position
+def pair_tiles(input_keys, prediction_keys):
+    predictions = {extract_row_col(key): key for key in prediction_keys}
+
+    tiles = []
+    for input_key in input_keys:
+        row, col = extract_row_col(input_key)
+        if (row, col) not in predictions:
+            raise FileNotFoundError(f"No prediction found for tile: {input_key}")
+        tiles.append((row, col, input_key, predictions[(row, col)]))
+
+    return tiles
+
+# Stream (row, col, input_key, prediction_key) tiles into the mosaics of `canvas` in a
+# single pass: each tile is fetched once (concurrently) and written into its slot of a
+# preallocated uint8 canvas, allocated (and georeferenced) from the first tile
+def paint_tiles(canvas, tiles, min_val, max_val, grid_shape):
+    def read_tile_pair(keys):
+        input_key, prediction_key = keys
+        return (normalize_tile(read_image_s3(input_key), min_val, max_val),) + read_mask_s3(prediction_key)
+
+    tile_pairs = ((row, col, (input_key, prediction_key)) for row, col, input_key, prediction_key in tiles)
+    for row, col, (input_tile, mask, tile_transform, tile_crs) in fetch_tiles(tile_pairs, read_tile_pair):
+        place_tile(canvas, grid_shape, row, col, input_tile, mask, tile_transform, tile_crs)
+
+    return canvas
+
+# Paint one normalized input tile and its 0/1 mask into the mosaics (created on the first
+# tile). The canvas is sized from grid_shape and MOSAIC_TILE_PIXELS, not from the first
+# tile, so tiles can arrive in any order and uneven edge tiles are clipped to their slot
+def place_tile(canvas, grid_shape, row, col, input_tile, mask, tile_transform, tile_crs):
+    from rasterio import Affine
+
+    nb_of_rows, nb_of_cols = grid_shape
+    tile_px = MOSAIC_TILE_PIXELS
+    if "input" not in canvas:
+        canvas["input"] = np.zeros((nb_of_rows * tile_px, nb_of_cols * tile_px, 3), dtype=np.uint8)
+        canvas["prediction"] = np.zeros((nb_of_rows * tile_px, nb_of_cols * tile_px), dtype=np.uint8)
+        # Georeference of the mosaic's top-left corner
+        canvas["transform"] = tile_transform * Affine.translation(-col * tile_px, -row * tile_px)
+        canvas["crs"] = tile_crs
+
+    tile_h, tile_w = min(mask.shape[0], tile_px), min(mask.shape[1], tile_px)
+    slot = (slice(row * tile_px, row * tile_px + tile_h), slice(col * tile_px, col * tile_px + tile_w))
+    canvas["input"][slot] = input_tile[:tile_h, :tile_w]
+    canvas["prediction"][slot] = mask[:tile_h, :tile_w] * np.uint8(255)
+
+# Create the input and prediction mosaics from every tile at once
+def build_mosaics(tiles, grid_shape):
+    min_val, max_val = group_min_max([input_key for _, _, input_key, _ in tiles])
+    canvas = paint_tiles({}, tiles, min_val, max_val, grid_shape)
+    return canvas["input"], canvas["prediction"], canvas["transform"], canvas["crs"]
+
+# Encode an RGB (or single band) uint8 image as PNG
+def encode_png(image):
+    import cv2
+
+    if image.ndim == 3:
+        image = np.ascontiguousarray(image[:, :, ::-1])  # OpenCV expects BGR
+    with metrics.span("encode"):
+        ok, buffer = cv2.imencode(".png", image)
+    if not ok:
+        raise ValueError("Could not encode image as PNG")
+    return buffer.tobytes()
+
+# Save a mosaic to the report folder as PNG
+def save_mosaic_s3(mosaic, report_folder, title):
+    mosaic_key = f"{report_folder}{title}.png"
+    get_s3().put_object(Bucket=S3_BUCKET, Key=mosaic_key, Body=encode_png(mosaic))
     print(f"Saved mosaic: {mosaic_key}")
-    
+
     return mosaic_key
 
-# Generate mosaics
-input_mosaic_key = create_mosaic(input_images, "input")
-prediction_mosaic_key = create_mosaic(prediction_images, "prediction", normalize=False)
+# Upload (key, body, content_type) items concurrently, at most 2 * FETCH_WORKERS pending
+def put_objects_concurrently(items):
+    s3 = get_s3()
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        pending = set()
+        for key, body, content_type in items:
+            if len(pending) >= 2 * FETCH_WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(pool.submit(s3.put_object, Bucket=S3_BUCKET, Key=key, Body=body, ContentType=content_type))
+
+        for future in pending:
+            future.result()
+
+# Save the tile pyramid of a mosaic for the zoomable viewer
+def save_pyramid_s3(mosaic, report_folder, layer):
+    from pyramid import iter_pyramid_tiles, CONTENT_TYPES
+
+    start = time.time()
+    content_type = CONTENT_TYPES[PYRAMID_TILE_FORMAT]
+    nb_of_tiles = 0
+
+    def pyramid_objects():
+        nonlocal nb_of_tiles
+        for z, x, y, body in iter_pyramid_tiles(mosaic, PYRAMID_TILE_FORMAT):
+            nb_of_tiles += 1
+            yield f"{report_folder}tiles/{layer}/{z}/{x}/{y}.{PYRAMID_TILE_FORMAT}", body, content_type
+
+    put_objects_concurrently(pyramid_objects())
+    print(f"Saved {layer} pyramid: {nb_of_tiles} tiles in {time.time() - start:.2f} seconds")
 
 # Overlay predictions with grid and quadrant numbering
-def overlay_prediction_with_grid(input_key, prediction_key, output_key, grid_shape, overlay_color=(0, 255, 255), grid_color=(255, 255, 255), thickness=1):
-    """Overlay prediction mask and grid on the input image."""
-    
-    input_img = read_image_s3(input_key, to_rgb=True)
-    pred_mask = read_image_s3(prediction_key, to_rgb=False)
-
-    if input_img is None or pred_mask is None:
-        print(f"Skipping overlay due to missing image: {input_key} or {prediction_key}")
-        return
-
-    # Convert prediction mask (0 → 0, 1 → 255)
-    pred_mask = (pred_mask > 0).astype(np.uint8) * 255
-    pred_mask = np.stack([pred_mask] * 3, axis=-1)
+def overlay_prediction_with_grid(input_mosaic, prediction_mosaic, output_key, grid_shape, overlay_color=(0, 255, 255), grid_color=(255, 255, 255), thickness=1):
+    """Overlay prediction mask and grid on the input mosaic (painted in place, save input.png first)."""
+    from grid_overlay import overlay_grid_with_numbers
 
-    # Overlay detected areas in magenta
-    overlay = input_img.copy()
-    overlay[pred_mask[:, :, 0] > 0] = overlay_color
+    # Overlay detected areas in cyan
+    overlay = input_mosaic
+    overlay[prediction_mosaic > 0] = overlay_color
 
     # Add grid and numbering
     overlay = overlay_grid_with_numbers(overlay, grid_shape, grid_color, thickness)
 
-    overlay = overlay.astype(np.uint8)
-
     # Save the overlay image
-    image_bytes = io.BytesIO()
-    imageio.imwrite(image_bytes, overlay, format="png")
-    s3.put_object(Bucket=S3_BUCKET, Key=output_key, Body=image_bytes.getvalue())
+    get_s3().put_object(Bucket=S3_BUCKET, Key=output_key, Body=encode_png(overlay))
     print(f"Saved final overlay: {output_key}")
 
-# Overlay grid and numbers
-def overlay_grid_with_numbers(image, grid_shape, grid_color=(255, 255, 255), thickness=1):
-    h, w, _ = image.shape
-    grid_h, grid_w = h // grid_shape[0], w // grid_shape[1]
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.5
-    font_thickness = 1
-
-    cell_number = 1
-
-    for i in range(grid_shape[0]):
-        for j in range(grid_shape[1]):
-            x_top_left = j * grid_w + 5
-            y_top_left = i * grid_h + 15
-
-            cv2.putText(
-                image, 
-                str(cell_number), 
-                (x_top_left, y_top_left), 
-                font, font_scale, grid_color, 
-                font_thickness, cv2.LINE_AA
-            )
-            cell_number += 1
-    step = 10
-    for i in range(1, grid_shape[0]):
-        for x in range(0, w, step * 2):
-            cv2.line(image, (x, i * grid_h), (x + step, i * grid_h), grid_color, thickness)
-    for j in range(1, grid_shape[1]):
-        for y in range(0, h, step * 2):
-            cv2.line(image, (j * grid_w, y), (j * grid_w, y + step), grid_color, thickness)
-
-    return image
-
-overlay_key = f"{report_s3_folder}overlay.png"
-overlay_prediction_with_grid(input_mosaic_key, prediction_mosaic_key, overlay_key, (nb_of_rows, nb_of_cols))
-
-# Compute statistics
-def compute_statistics(prediction_keys, sub_image_shape, scale=5):
-    total_pixels, positive_pixels = 0, 0
-    stats = []
-    
-    for i, key in enumerate(prediction_keys):
-        pred_img = read_image_s3(key)
-        cell_pixels = pred_img.size
-        cell_positives = np.sum(pred_img > 0)
-        total_pixels += cell_pixels
-        positive_pixels += cell_positives
-        cell_area = cell_pixels * scale * scale * 10**-6
-        positive_area = cell_positives * scale * scale
-        
-        stats.append({
-            "Cell": i + 1,
-            "Total Pixels": f"{cell_pixels:,}",
-            "Total Area (km^2)": f"{cell_area:,.3f}",
-            "Positive Pixels": f"{cell_positives:,}",
-            "Positive Area (m^2)": f"{positive_area:,}",
-            "Coverage %": (cell_positives / cell_pixels) * 100
-        })
-    
-    ns_extension = f"{nb_of_rows * sub_image_shape[0] * scale:,} m"
-    we_extension = f"{nb_of_cols * sub_image_shape[1] * scale:,} m"
-    
-    return pd.DataFrame(stats), ns_extension, we_extension
-
-stats_df, ns_extension, we_extension = compute_statistics(prediction_images, (512, 512))
-
-# Generate HTML Report
-html_content = f"""
+# Final report: input/prediction mosaics and pyramids, plant table and footprints, overlay,
+# viewer, statistics and report.html. The mosaics are modified in place (small components
+# are removed from the prediction mosaic, the overlay is painted over the input mosaic).
+def seal_report(transaction_id, grid_shape, input_mosaic, prediction_mosaic, mosaic_transform, mosaic_crs):
+    from postprocess import remove_small_components
+    from pyramid import viewer_html
+    from cell_stats import cell_statistics, mosaic_extent_m, statistics_html
+    from results_archive import build_archive
+
+    s3 = get_s3()
+    report_folder = report_s3_folder(transaction_id)
+    nb_of_rows, nb_of_cols = grid_shape
+
+    tile_shape = (prediction_mosaic.shape[0] // nb_of_rows, prediction_mosaic.shape[1] // nb_of_cols)
+    save_mosaic_s3(input_mosaic, report_folder, "input")
+    save_pyramid_s3(input_mosaic, report_folder, "input")
+
+    # Drop small connected components (noise) across the whole prediction mosaic
+    plant_features = []
+    plants_df = remove_small_components(
+        prediction_mosaic, tile_shape[0], mosaic_transform, mosaic_crs, MIN_PLANT_AREA_M2,
+        on_polygon=plant_features.append, cell_shape=tile_shape
+    )
+    save_mosaic_s3(prediction_mosaic, report_folder, "prediction")
+
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}plants.csv", Body=plants_df.to_csv(index=False).encode("utf-8"))
+    print(f"Saved plants table: {report_folder}plants.csv ({len(plants_df)} plants)")
+
+    # Plant footprints as GeoJSON (EPSG:4326), ordered like the plants table
+    plant_features.sort(key=lambda feature: feature["properties"]["plant"])
+    geojson = {"type": "FeatureCollection", "features": plant_features}
+    s3.put_object(
+        Bucket=S3_BUCKET, Key=f"{report_folder}plants.geojson",
+        Body=json.dumps(geojson).encode("utf-8"), ContentType="application/geo+json"
+    )
+    print(f"Saved plant footprints: {report_folder}plants.geojson")
+
+    overlay_key = f"{report_folder}overlay.png"
+    overlay_prediction_with_grid(input_mosaic, prediction_mosaic, overlay_key, grid_shape)
+    save_pyramid_s3(input_mosaic, report_folder, "overlay")
+
+    # Zoomable viewer over the input and overlay pyramids
+    viewer_content = viewer_html(f"Satellite Report {transaction_id}", *input_mosaic.shape[:2], ["input", "overlay"], PYRAMID_TILE_FORMAT)
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}viewer.html", Body=viewer_content.encode("utf-8"), ContentType="text/html")
+    print(f"Saved viewer: {report_folder}viewer.html")
+
+    # Compute statistics (per grid cell of the filtered prediction mosaic)
+    stats_df = cell_statistics(prediction_mosaic, grid_shape, mosaic_transform, plants_df)
+    ns_extension, we_extension = mosaic_extent_m(prediction_mosaic.shape, mosaic_transform)
+
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}stats.csv", Body=stats_df.to_csv(index=False).encode("utf-8"))
+    stats_parquet = io.BytesIO()
+    stats_df.to_parquet(stats_parquet, index=False)
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}stats.parquet", Body=stats_parquet.getvalue())
+    print(f"Saved statistics: {report_folder}stats.csv, {report_folder}stats.parquet")
+
+    # Generate HTML Report
+    plants_html = plants_df.to_html(
+        index=False,
+        float_format="{:.6f}".format,
+        formatters={"Area (m^2)": "{:,.0f}".format}
+    )
+
+    html_content = f"""
 <html>
-<head><title>Satellite Report {TRANSACTION_ID}</title></head>
+<head><title>Satellite Report {transaction_id}</title></head>
 <body>
-<h2>Satellite Report for {TRANSACTION_ID}</h2>
+<h2>Satellite Report for {transaction_id}</h2>
 <h3>Satellite imagery and detection mosaic overlay</h3>
-<img src='overlay.png' width='800'>
+<iframe src='viewer.html' width='800' height='600' style='border: 0'></iframe>
+<p><a href='viewer.html'>Open the zoomable viewer</a> | Full resolution: <a href='overlay.png'>overlay.png</a></p>
 <h3>Statistics</h3>
-{stats_df.to_html(index=False)}
+<p>Extent: {ns_extension:,.0f} m (N-S) x {we_extension:,.0f} m (W-E) | Tables: <a href='stats.csv'>stats.csv</a>, <a href='stats.parquet'>stats.parquet</a></p>
+{statistics_html(stats_df)}
+<h3>Detected plants (area &ge; {MIN_PLANT_AREA_M2:,.0f} m^2)</h3>
+<p>Footprints: <a href='plants.geojson'>plants.geojson</a> (EPSG:4326) | Table: <a href='plants.csv'>plants.csv</a></p>
+{plants_html}
 </body>
 </html>
 """
 
-# Save HTML report to S3
-html_bytes = io.BytesIO(html_content.encode("utf-8"))
-s3.put_object(Bucket=S3_BUCKET, Key=f"{report_s3_folder}report.html", Body=html_bytes.getvalue())
-print(f"Report generated successfully: {report_s3_folder}report.html")
+    # Save HTML report to S3 (replaces the partial report of the incremental mode)
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{report_folder}report.html", Body=html_content.encode("utf-8"))
+    print(f"Report generated successfully: {report_folder}report.html")
+
+    # Results ZIP (served by the UI's /download-results), rebuilt whenever the report is sealed
+    with metrics.span("archive"):
+        archive_key, nb_of_files = build_archive(s3, S3_BUCKET, transaction_id, FETCH_WORKERS)
+    print(f"Saved results archive: {archive_key} ({nb_of_files} files)")
+
+# Low resolution overlay (PNG bytes) of the mosaics painted so far; tiles not yet predicted stay black
+def preview_png(input_mosaic, prediction_mosaic, max_size=PREVIEW_MAX_SIZE):
+    import cv2
+
+    h, w = prediction_mosaic.shape
+    scale = min(1.0, max_size / max(h, w))
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+
+    preview = cv2.resize(input_mosaic, size, interpolation=cv2.INTER_AREA)
+    # Any detection inside a preview pixel shows, so small plants do not vanish
+    preview[cv2.resize(prediction_mosaic, size, interpolation=cv2.INTER_AREA) > 0] = (0, 255, 255)
+
+    return encode_png(preview)
+
+# Partial report.html: progress, preview and statistics of the cells predicted so far.
+# The preview is inlined so the page works through the pre-signed report URL.
+def write_partial_report(transaction_id, grid_shape, canvas, painted):
+    from cell_stats import cell_statistics, statistics_html
+
+    nb_of_rows, nb_of_cols = grid_shape
+    predicted = np.zeros(grid_shape, dtype=bool)
+    predicted[tuple(np.array(sorted(painted)).T)] = True
+
+    stats_df = cell_statistics(canvas["prediction"], grid_shape, canvas["transform"])
+    stats_df = stats_df[predicted.ravel()]
+    preview = base64.b64encode(preview_png(canvas["input"], canvas["prediction"])).decode("ascii")
+    updated = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime())
+
+    html_content = f"""
+<html>
+<head><title>Satellite Report {transaction_id} (partial)</title><meta http-equiv='refresh' content='{max(int(REPORT_POLL_SECONDS), 10)}'></head>
+<body>
+<h2>Satellite Report for {transaction_id}</h2>
+<p><b>Partial report:</b> {len(painted):,} of {nb_of_rows * nb_of_cols:,} tiles predicted
+(updated {updated}). Small-component filtering, plants,
+the zoomable viewer and downloads are added when the prediction job completes.</p>
+<h3>Detections so far (tiles not yet predicted are black)</h3>
+<img src='data:image/png;base64,{preview}' style='max-width: 100%'>
+<h3>Statistics of the predicted cells (before small-component filtering)</h3>
+{statistics_html(stats_df)}
+</body>
+</html>
+"""
+    report_key = f"{report_s3_folder(transaction_id)}report.html"
+    get_s3().put_object(Bucket=S3_BUCKET, Key=report_key, Body=html_content.encode("utf-8"))
+    print(f"Partial report updated: {len(painted)} / {nb_of_rows * nb_of_cols} tiles.")
+
+# True once a marker object (completion or failure of the prediction job) exists
+def marker_exists(key):
+    from botocore.exceptions import ClientError
+
+    try:
+        get_s3().head_object(Bucket=S3_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return True
+
+# Build the mosaics while the prediction job runs: poll the prediction prefix, paint the
+# tiles that landed since the last poll and publish a partial report after each update.
+# Every tile is fetched once; the complete mosaics are returned for the final report.
+def build_mosaics_incrementally(transaction_id, input_images, grid_shape):
+    min_val, max_val = group_min_max(input_images)
+    input_by_cell = {extract_row_col(key): key for key in input_images}
+    canvas, painted = {}, set()
+    start = time.time()
+
+    while True:
+        if marker_exists(prediction_failed_marker(transaction_id)):
+            raise RuntimeError(f"Prediction job of {transaction_id} failed ({len(painted)} / {len(input_by_cell)} tiles predicted).")
+
+        # Checked before listing: once the marker exists, the listing is complete
+        done = marker_exists(prediction_done_marker(transaction_id))
+        try:
+            prediction_keys = list_s3_files(S3_BUCKET, prediction_s3_folder(transaction_id))
+        except FileNotFoundError:
+            prediction_keys = []
+
+        new_tiles = []
+        for prediction_key in prediction_keys:
+            cell = extract_row_col(prediction_key)
+            if cell in input_by_cell and cell not in painted:
+                new_tiles.append(cell + (input_by_cell[cell], prediction_key))
+
+        if new_tiles:
+            paint_tiles(canvas, new_tiles, min_val, max_val, grid_shape)
+            painted.update((row, col) for row, col, _, _ in new_tiles)
+            print(f"Painted {len(new_tiles)} new tiles ({len(painted)} / {len(input_by_cell)}) "
+                  f"after {time.time() - start:.0f} seconds.")
+
+        if len(painted) == len(input_by_cell):
+            return canvas["input"], canvas["prediction"], canvas["transform"], canvas["crs"]
+
+        if done:
+            missing = sorted(set(input_by_cell) - painted)
+            raise FileNotFoundError(f"Prediction job finished without {len(missing)} tiles, e.g. {input_by_cell[missing[0]]}")
+        if time.time() - start > REPORT_TIMEOUT_SECONDS:
+            raise TimeoutError(f"Only {len(painted)} / {len(input_by_cell)} predictions after {REPORT_TIMEOUT_SECONDS:.0f} seconds.")
+
+        if new_tiles:
+            write_partial_report(transaction_id, grid_shape, canvas, painted)
+        time.sleep(REPORT_POLL_SECONDS)
+
+# Generate the report of a transaction ("batch" or "incremental" mode, see REPORT_MODE)
+def generate_report(transaction_id, mode=REPORT_MODE):
+    # Fetch input image keys from S3 (predictions are listed when the report is built)
+    input_images = list_s3_files(S3_BUCKET, input_s3_folder(transaction_id))
+    grid_shape = grid_shape_of(input_images)
+    print(f"Grid shape: {grid_shape[0]} rows x {grid_shape[1]} cols.")
+
+    metrics.count("tiles", len(input_images))
+
+    with metrics.span("mosaic", mode=mode):
+        if mode == "incremental":
+            mosaics = build_mosaics_incrementally(transaction_id, input_images, grid_shape)
+        else:
+            prediction_images = list_s3_files(S3_BUCKET, prediction_s3_folder(transaction_id))
+            mosaics = build_mosaics(pair_tiles(input_images, prediction_images), grid_shape)
+
+    with metrics.span("seal"):
+        seal_report(transaction_id, grid_shape, *mosaics)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the report of a transaction.")
+    parser.add_argument("--transaction-id", default=os.getenv("TRANSACTION_ID"), help="Transaction ID (default: $TRANSACTION_ID)")
+    parser.add_argument("--mode", choices=["batch", "incremental", "changes"], default=REPORT_MODE,
+                        help="Report mode (default: $REPORT_MODE or batch); \"changes\": change report of a time series ID")
+    args = parser.parse_args(argv)
+
+    if not args.transaction_id:
+        parser.error("TRANSACTION_ID environment variable is not set.")
+
+    metrics.start("change_report" if args.mode == "changes" else "report", args.transaction_id)
+    try:
+        if args.mode == "changes":
+            from change_detection import generate_change_report
+            generate_change_report(args.transaction_id)
+        else:
+            generate_report(args.transaction_id, args.mode)
+    finally:
+        metrics.finish(get_s3(), S3_BUCKET)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#
+# Results archive of a transaction: the report artifacts (mosaics, tables, footprints,
+# report and viewer pages; not the viewer's tile pyramid) plus the prediction GeoTIFFs.
+# The report job builds it when the report is sealed, next to the report
+# (reports/{tid}/{tid}.zip); the UI only presigns it. Objects are downloaded
+# concurrently (a bounded window, written in listing order) and the ZIP is streamed
+# to S3 as a multipart upload, so memory stays bounded whatever the archive size.
+# Already compressed formats are stored as is; text files are deflated.
+#
+
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+PART_SIZE = 8 * 1024 * 1024   # multipart upload part size (S3 minimum is 5 MiB)
+FETCH_WORKERS = 16            # concurrent downloads
+ZIP64_THRESHOLD = 2 ** 31     # entries above this need ZIP64 headers up front
+
+# Compressed formats gain nothing from deflate
+STORED_EXTENSIONS = {".png", ".webp", ".jpg", ".jpeg", ".tif", ".tiff", ".parquet", ".zip", ".gz"}
+
+
+def archive_key(transaction_id):
+    return f"reports/{transaction_id}/{transaction_id}.zip"
+
+
+class S3MultipartWriter:
+    """Write-only, unseekable file object uploading to S3 in PART_SIZE parts."""
+
+    def __init__(self, s3, bucket, key, content_type="application/zip", part_size=PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)["UploadId"]
+        self.parts = []
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, body):
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """Uploads the last part and completes the upload."""
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def list_objects(s3, bucket, prefix):
+    """(key, size, last_modified) of every object under a prefix (paginated)."""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj["Key"], obj["Size"], obj["LastModified"]
+
+
+def archive_entries(s3, bucket, transaction_id):
+    """(archive name, S3 key, size) of the files of a transaction's results archive."""
+    report_prefix = f"reports/{transaction_id}/"
+    for key, size, _ in list_objects(s3, bucket, report_prefix):
+        name = key[len(report_prefix):]
+        if not name.endswith(".zip") and not name.startswith("tiles/"):
+            yield name, key, size
+
+    prediction_prefix = f"predictions/{transaction_id}/"
+    for key, size, _ in list_objects(s3, bucket, prediction_prefix):
+        if key.endswith(".tif"):
+            yield f"predictions/{key[len(prediction_prefix):]}", key, size
+
+
+def fetch_ordered(s3, bucket, entries, max_workers=FETCH_WORKERS):
+    """Yields (name, size, body bytes) in order, with at most 2 * max_workers downloads in flight."""
+    def read(key):
+        return s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    entries = iter(entries)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for name, key, size in entries:
+            pending.append((name, size, pool.submit(read, key)))
+            if len(pending) >= 2 * max_workers:
+                break
+        while pending:
+            name, size, future = pending.popleft()
+            for next_name, next_key, next_size in entries:
+                pending.append((next_name, next_size, pool.submit(read, next_key)))
+                break
+            yield name, size, future.result()
+
+
+def build_archive(s3, bucket, transaction_id, max_workers=FETCH_WORKERS):
+    """Streams the results archive of a transaction to S3; returns (key, number of files)."""
+    entries = list(archive_entries(s3, bucket, transaction_id))
+    if not entries:
+        raise FileNotFoundError(f"No results found for transaction {transaction_id}")
+
+    key = archive_key(transaction_id)
+    writer = S3MultipartWriter(s3, bucket, key)
+
+    try:
+        with zipfile.ZipFile(writer, "w") as archive:
+            for name, size, body in fetch_ordered(s3, bucket, entries, max_workers):
+                stored = os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+                info = zipfile.ZipInfo(name)
+                info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+
+                with archive.open(info, "w", force_zip64=size >= ZIP64_THRESHOLD) as entry:
+                    entry.write(body)
+    except BaseException:
+        writer.abort()
+        raise
+
+    writer.close()
+    return key, len(entries)
@@ -1,69 +1,127 @@
 import boto3
 import re
+import time
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
 # === CONFIGURATION ===
 bucket_name = "satellite-ml-solarp-detection-data"
-base_folders = ['acquisition/', 'image_enhancement/', 'predictions/', 'reports/']
-#days_to_keep = 30  # Keep last 30 days
-#cutoff_date = datetime.utcnow() - timedelta(days=days_to_keep)
+base_folders = ['acquisition/', 'image_enhancement/', 'predictions/', 'probabilities/', 'reports/', 'batches/', 'metrics/', 'etc/transaction_ids/']
+days_to_keep = 30  # default retention for --days-to-keep
+max_workers = 16
+batch_size = 1000  # delete_objects limit
 
 # === INIT S3 CLIENT ===
 s3 = boto3.client('s3')
 
 # === REGEX TO MATCH SUBFOLDER ===
-pattern = re.compile(r'(\d{6})-(\d{4}-\d{2}-\d{2})/')
+# Transaction folders (<base><NNNNNN-YYYY-MM-DD>/) and claim objects (<base><NNNNNN-YYYY-MM-DD>)
+pattern = re.compile(r'(\d{6})-(\d{4}-\d{2}-\d{2})(/|$)')
 
-# === FUNCTION TO DELETE OLD OBJECTS ===
-def delete_old_subfolders(target_date):
+# === LIST TRANSACTION PREFIXES (one entry per transaction, not per key) ===
+def transaction_prefixes(base, is_selected):
+    """Yields the transaction folders/objects directly under `base` whose date is selected."""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=base, Delimiter='/'):
+        entries = [p['Prefix'] for p in page.get('CommonPrefixes', [])] + [o['Key'] for o in page.get('Contents', [])]
+        for entry in entries:
+            match = pattern.fullmatch(entry[len(base):])
+            if not match:
+                continue
+            folder_date_str = match.group(2)
+            try:
+                folder_date = datetime.strptime(folder_date_str, '%Y-%m-%d').date()
+            except ValueError:
+                print(f'Skipping malformed date in: {folder_date_str}')
+                continue
+            if is_selected(folder_date):
+                yield entry
+
+# === DELETE (OR MEASURE) ALL OBJECTS UNDER A PREFIX ===
+def delete_prefix(prefix, dry_run, delete_pool):
+    """Lists a prefix page by page (1000 keys) and deletes each page with one delete_objects call."""
+    nb_of_objects, nb_of_bytes, pending = 0, 0, []
+
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': batch_size}):
+        objects = page.get('Contents', [])
+        nb_of_objects += len(objects)
+        nb_of_bytes += sum(obj['Size'] for obj in objects)
+        if objects and not dry_run:
+            pending.append(delete_pool.submit(delete_batch, [obj['Key'] for obj in objects]))
+
+    errors = sum(future.result() for future in pending)
+    return prefix, nb_of_objects, nb_of_bytes, errors
+
+def delete_batch(keys):
+    response = s3.delete_objects(
+        Bucket=bucket_name,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+    )
+    for error in response.get('Errors', []):
+        print(f" - Could not delete {error['Key']}: {error.get('Code')} {error.get('Message')}")
+    return len(response.get('Errors', []))
 
-    seen_folder = set()
+# === FUNCTION TO DELETE OLD TRANSACTIONS ===
+def delete_old_subfolders(is_selected, dry_run=False, workers=max_workers):
+    """Deletes every transaction folder whose date is selected by `is_selected`, in parallel."""
+    start = time.time()
+    totals = {}
 
+    with ThreadPoolExecutor(max_workers=workers) as list_pool, ThreadPoolExecutor(max_workers=workers) as delete_pool:
+        futures = [
+            list_pool.submit(delete_prefix, prefix, dry_run, delete_pool)
+            for base in base_folders
+            for prefix in transaction_prefixes(base, is_selected)
+        ]
+
+        for future in futures:
+            prefix, nb_of_objects, nb_of_bytes, errors = future.result()
+            base = next(b for b in base_folders if prefix.startswith(b))
+            count, size, folders, failed = totals.get(base, (0, 0, 0, 0))
+            totals[base] = (count + nb_of_objects, size + nb_of_bytes, folders + 1, failed + errors)
+            print(f"{'Would delete' if dry_run else 'Deleted'} {prefix}: {nb_of_objects:,} objects, {nb_of_bytes / 2**20:,.1f} MiB")
+
+    print(f"\n{'Dry run' if dry_run else 'Cleanup'} summary ({time.time() - start:.1f} s):")
     for base in base_folders:
-        paginator = s3.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name, Prefix=base):
-            if 'Contents' not in page:
-                continue
+        count, size, folders, failed = totals.get(base, (0, 0, 0, 0))
+        print(f"  {base:<22} {folders:>6,} transactions {count:>10,} objects {size / 2**20:>12,.1f} MiB"
+              + (f"  ({failed:,} errors)" if failed else ""))
+    count = sum(t[0] for t in totals.values())
+    size = sum(t[1] for t in totals.values())
+    print(f"  {'total':<22} {'':>19} {count:>10,} objects {size / 2**20:>12,.1f} MiB "
+          f"{'reclaimable' if dry_run else 'reclaimed'}")
 
-            for obj in page['Contents']:
-                key = obj['Key']
-                print(f"Checking: {key}")
-                match = pattern.search(key)
-                if match:
-                    folder_date_str = match.group(2)
-                    try:
-                        folder_date = datetime.strptime(folder_date_str, '%Y-%m-%d').date()
-                        if folder_date == target_date:
-                            prefix_to_delete = key.split(match.group(0))[0] + match.group(0)
-                            if prefix_to_delete not in seen_folder:
-                                print(f'Deleting folder: {prefix_to_delete}')
-                                delete_prefix(prefix_to_delete)
-                                seen_folder.add(prefix_to_delete)
-                    except ValueError:
-                        print(f'Skipping malformed date in: {folder_date_ster}')
-                        continue
-
-# === DELETE ALL OBJECTS UNDER A PREFIX ===
-def delete_prefix(prefix):
-    print(f'Fetching objects under: {prefix}')
-    objects_to_delete = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-    if 'Contents' in objects_to_delete:
-        for obj in objects_to_delete['Contents']:
-            print(f' - Deleting {obj["Key"]}')
-            s3.delete_object(Bucket=bucket_name, Key=obj['Key'])
-    else:
-        print(f"Nothing found under {prefix} to delete.")
+    return totals
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Clean up old transaction folders in s3.')
-    parser.add_argument('--date', required=True, help='Transaction date. Mask: "YYYY-MM-DD"')
+    selection = parser.add_mutually_exclusive_group(required=True)
+    selection.add_argument('--date', help='Transaction date. Mask: "YYYY-MM-DD"')
+    selection.add_argument('--from-date', help='First transaction date of a range (use with --to-date). Mask: "YYYY-MM-DD"')
+    selection.add_argument('--days-to-keep', type=int, nargs='?', const=days_to_keep,
+                           help=f'Delete transactions older than this many days (default: {days_to_keep})')
+    parser.add_argument('--to-date', help='Last transaction date of the range (inclusive). Mask: "YYYY-MM-DD"')
+    parser.add_argument('--dry-run', action='store_true', help='Only count the objects and bytes that would be deleted')
+    parser.add_argument('--workers', type=int, default=max_workers)
 
     args = parser.parse_args()
 
     try:
-        target_date = datetime.strptime(args.date, '%Y-%m-%d').date()
-        delete_old_subfolders(target_date)
+        if args.date:
+            target_date = datetime.strptime(args.date, '%Y-%m-%d').date()
+            is_selected = lambda d: d == target_date
+        elif args.from_date:
+            first = datetime.strptime(args.from_date, '%Y-%m-%d').date()
+            last = datetime.strptime(args.to_date, '%Y-%m-%d').date() if args.to_date else datetime.utcnow().date()
+            is_selected = lambda d: first <= d <= last
+        else:
+            cutoff_date = datetime.utcnow().date() - timedelta(days=args.days_to_keep)
+            print(f"Deleting transactions dated before {cutoff_date}")
+            is_selected = lambda d: d < cutoff_date
 
     except ValueError:
         print("Invalid date format. Please use YYYY-MM-DD.")
+    else:
+        delete_old_subfolders(is_selected, args.dry_run, args.workers)
@@ -2,72 +2,153 @@
 # This script converts .GEOtiff files with FP predictions into all-black images
 # The resulting images will be used to re-train the Model an fine-tune it.
 #
+# Only the profile (header) of each input is read: the all-black raster is created
+# from it and GDAL fills the unwritten blocks with zeros on close. Files are processed
+# across a process pool and rewritten atomically (temporary file + rename).
+#
+# Examples:
+#   python convertToAllBlack.py "data_split2sr_FT/*/labels/target(20??).tif"
+#   python convertToAllBlack.py --file-list false_positives.txt --workers 8
+#   python convertToAllBlack.py --negatives-from 000123-2025-03-14 --output-dir hard_negatives/labels
+#   python convertToAllBlack.py --negatives-from "predictions/*.tif" --output-dir hard_negatives/labels
+#
 
+import os
 import re
 import glob
-from PIL import Image
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import rasterio
+from rasterio.windows import Window
+
+BUCKET_NAME = "satellite-ml-solarp-detection-data"
+TRANSACTION_ID = re.compile(r'\d{6}-\d{4}-\d{2}-\d{2}')
 
 # Function to extract the numeric value from filenames
 def numeric_sort_key(filepath):
     # Extract numbers from the filename using a regular expression
-    match = re.search(r'\d+', filepath)
+    match = re.search(r'\d+', os.path.basename(filepath))
     # Return the integer value of the number if found, otherwise 0
     return int(match.group()) if match else 0
 
-folder_label_train = sorted(
-    glob.glob("../../../UCSD_MLBootcamp_Capstone/5-Data_Wrangling/data_split2sr_FT/train/labels/target(20??).tif"),
-    key=numeric_sort_key
-)
+# Function to expand paths and glob patterns into a sorted list of files
+def expand_paths(patterns):
+    files = []
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            print(f'No file matches {pattern}')
+        files.extend(matches)
+    # Keep the first occurrence of each file
+    return sorted(dict.fromkeys(files), key=numeric_sort_key)
+
+# Function to list the prediction GeoTIFFs of a transaction in S3 (opened remotely, header only)
+def prediction_files(transaction_id):
+    import boto3
+
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    files = []
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=f'predictions/{transaction_id}/'):
+        files.extend(f"s3://{BUCKET_NAME}/{obj['Key']}" for obj in page.get('Contents', []) if obj['Key'].endswith('.tif'))
+    return sorted(files, key=numeric_sort_key)
+
+def black_profile(profile):
+    """Profile of the all-black copy: same grid and georeferencing, no compression."""
+    profile = dict(profile)
+    profile['driver'] = 'GTiff'
+    # Cancel compression
+    profile['compress'] = 'none'
+    return profile
+
+def write_black(profile, path):
+    """Creates an all-black GeoTIFF at `path` without materializing a full band in memory."""
+    with rasterio.open(path, 'w', **profile) as dst:
+        if profile.get('nodata') in (None, 0):
+            return  # Unwritten blocks are filled with zeros by GDAL when the file is closed
+
+        # A non-zero nodata would be used as the fill value: write zeros one block at a time
+        block_h, block_w = dst.block_shapes[0]
+        zeros = np.zeros((dst.count, block_h, block_w), dtype=dst.dtypes[0])
+        for row in range(0, dst.height, block_h):
+            for col in range(0, dst.width, block_w):
+                window = Window(col, row, min(block_w, dst.width - col), min(block_h, dst.height - row))
+                dst.write(zeros[:, :window.height, :window.width], window=window)
 
-folder_label_val = sorted(
-    glob.glob("../../../UCSD_MLBootcamp_Capstone/5-Data_Wrangling/data_split2sr_FT/val/labels/target(20??).tif"),
-    key=numeric_sort_key
-)
+def convert_file(task):
+    """(source, destination): all-black copy of source at destination (in place if they are the same)."""
+    source, destination = task
 
-folder_label_test = sorted(
-    glob.glob("../../../UCSD_MLBootcamp_Capstone/5-Data_Wrangling/data_split2sr_FT/test/labels/target(20??).tif"),
-    key=numeric_sort_key
-)
+    # Only the header is read, never the pixel data
+    with rasterio.open(source) as src:
+        profile = black_profile(src.profile)
+
+    # Write next to the destination, then rename: an interrupted run never leaves a truncated label
+    temporary = f'{destination}.tmp{os.getpid()}'
+    try:
+        write_black(profile, temporary)
+        os.replace(temporary, destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return destination
+
+def convert_files(tasks, workers=None):
+    """Runs convert_file over (source, destination) pairs across a process pool; returns the number converted."""
+    start = time.perf_counter()
+    nb_of_images, failed = 0, 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(source, pool.submit(convert_file, (source, destination))) for source, destination in tasks]
+        for source, future in futures:
+            try:
+                future.result()
+                nb_of_images += 1
+            except Exception as e:
+                failed += 1
+                print(f'Failed on {source}: {e}')
+
+    elapsed = time.perf_counter() - start
+    print(f'{nb_of_images} treated images ({failed} failed) in {elapsed:.2f} s: '
+          f'{nb_of_images / elapsed if elapsed else 0:,.1f} files/sec')
+    return nb_of_images
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rewrite label GeoTIFFs as all-black (zero) rasters.')
+    parser.add_argument('files', nargs='*', help='Label files or glob patterns (quoted) to rewrite in place')
+    parser.add_argument('--file-list', help='Text file with one label path per line')
+    parser.add_argument('--negatives-from', nargs='+',
+                        help='Prediction outputs to build hard negatives from: transaction IDs (read from s3) '
+                             'and/or local files or glob patterns. Requires --output-dir')
+    parser.add_argument('--output-dir', help='Folder for the all-black labels built from --negatives-from')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+
+    # Labels rewritten in place
+    patterns = list(args.files)
+    if args.file_list:
+        with open(args.file_list) as f:
+            patterns.extend(line.strip() for line in f if line.strip())
+    tasks = [(file, file) for file in expand_paths(patterns)]
+
+    # Hard negatives: one all-black label per prediction, with the prediction's georeferencing
+    if args.negatives_from:
+        if not args.output_dir:
+            parser.error('--negatives-from requires --output-dir')
+        os.makedirs(args.output_dir, exist_ok=True)
+
+        sources = []
+        for item in args.negatives_from:
+            sources.extend(prediction_files(item) if TRANSACTION_ID.fullmatch(item) else expand_paths([item]))
+        tasks.extend((source, os.path.join(args.output_dir, os.path.basename(source))) for source in sources)
+
+    if not tasks:
+        parser.error('No files to treat')
 
-    print(f'Number of files to treat:')
-    print(f'/ttrain: {len(folder_label_train)}')
-    print(f'/tval: {len(folder_label_val)}')
-    print(f'/ttest: {len(folder_label_test)}')
-    
-    
-    print(80*'-')
-    print(f'first val: {folder_label_val[0]}')
-    file = folder_label_val[0]
-
-    folders = [folder_label_train, folder_label_val, folder_label_test]    
-    
-    for folder in folders:
-        nb_of_images = 0
-        for file in folder:
-            # Open the GeoTIFF in read mode
-            with rasterio.open(file) as src:
-                profile = src.profile  # Save metadata/profile
-                data = src.read()      
-                
-                # Cancel compression
-                profile.pop('compress', None)
-                profile['compress'] = 'none'
-
-            # Set all pixel values to zero
-            zero_data = np.zeros_like(data)
-            
-            # Overwrite the file with the same metadata and zeroed data
-            with rasterio.open(file, 'w', **profile) as dst:
-                dst.write(zero_data)
-            
-            nb_of_images += 1
-        
-        print(f'{folder}: {nb_of_images} treated images')
-    
-    
-    
\ No newline at end of file
+    print(f'Number of files to treat: {len(tasks)}')
+    convert_files(tasks, args.workers)
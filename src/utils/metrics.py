@@ -0,0 +1,186 @@
+#
+# Per-stage tracing and metrics, shared by every stage of the pipeline (acquisition
+# Lambda, enhancement, prediction and report jobs).
+#
+#   metrics.start("prediction", transaction_id)    # one recorder per transaction
+#   with metrics.span("inference"):                 # timed span
+#       ...
+#   metrics.count("tiles")                          # counter
+#   metrics.finish(s3, BUCKET_NAME)                 # summary line + upload
+#
+# Spans and counters are aggregated in memory (totals per name, thread safe). finish()
+# prints the stage summary as one JSON line (searchable in CloudWatch Logs) and uploads
+# metrics/{tid}/{stage}.json (summary) and metrics/{tid}/{stage}.jsonl (one JSON line
+# per span). The UI /status endpoint merges the summaries of every stage.
+#
+# Disabled unless METRICS=1: start() then records nothing, span() returns a shared
+# no-op context manager and count() returns at once, so instrumented code pays one
+# function call per span. S3 clients passed to watch_s3() count their requests by
+# operation (botocore event hook, registered only when enabled).
+#
+# The module is copied next to each stage's scripts (see the Dockerfiles) and imported
+# flat (`import metrics`); from the source tree, run the stages with src/utils and
+# src/acquisition on PYTHONPATH (sharding.run_stage does).
+#
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from datetime import datetime, timezone
+
+METRICS_ENABLED = os.getenv("METRICS", "false").lower() in ("1", "true", "yes")
+METRICS_PREFIX = "metrics/"
+# Spans kept for the .jsonl trace (the summary always covers every span)
+METRICS_MAX_EVENTS = int(os.getenv("METRICS_MAX_EVENTS", 100000))
+
+_current = None
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("recorder", "name", "fields", "start")
+
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.add_span(self.name, self.start, time.perf_counter() - self.start, self.fields, exc_type)
+        return False
+
+
+class Recorder:
+    """Spans and counters of one stage run on one transaction."""
+
+    def __init__(self, stage, transaction_id, part=None):
+        self.stage = stage
+        self.transaction_id = transaction_id
+        self.part = part
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.t0 = time.perf_counter()
+        self.spans = {}
+        self.counters = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def span(self, name, **fields):
+        return _Span(self, name, fields)
+
+    def add_span(self, name, start, seconds, fields=None, error=None):
+        with self.lock:
+            total = self.spans.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "errors": 0})
+            total["count"] += 1
+            total["seconds"] += seconds
+            total["max_seconds"] = max(total["max_seconds"], seconds)
+            if error is not None:
+                total["errors"] += 1
+            if len(self.events) < METRICS_MAX_EVENTS:
+                event = {"span": name, "start": round(start - self.t0, 6), "seconds": round(seconds, 6)}
+                if fields:
+                    event.update(fields)
+                if error is not None:
+                    event["error"] = error.__name__
+                self.events.append(event)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.lock:
+            return {
+                "stage": self.stage,
+                "transaction_id": self.transaction_id,
+                "part": self.part,
+                "started_at": self.started_at,
+                "wall_seconds": round(time.perf_counter() - self.t0, 3),
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+                "spans": {name: dict(total, seconds=round(total["seconds"], 3), max_seconds=round(total["max_seconds"], 3))
+                          for name, total in self.spans.items()},
+                "counters": dict(self.counters),
+                "events_dropped": max(sum(total["count"] for total in self.spans.values()) - len(self.events), 0),
+            }
+
+    def key(self, extension):
+        name = self.stage if self.part is None else f"{self.stage}.{self.part}"
+        return f"{METRICS_PREFIX}{self.transaction_id}/{name}.{extension}"
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss: KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def start(stage, transaction_id, part=None):
+    """Starts recording a stage run (replaces the previous recorder). None when disabled."""
+    global _current
+    _current = Recorder(stage, transaction_id, part) if METRICS_ENABLED else None
+    return _current
+
+
+def span(name, **fields):
+    """Timed span context manager (fields end up on the span's trace line)."""
+    recorder = _current
+    if recorder is None:
+        return _NOOP_SPAN
+    return recorder.span(name, **fields)
+
+
+def count(name, value=1):
+    recorder = _current
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def finish(s3=None, bucket=None):
+    """
+    Prints the summary of the current recorder as a JSON line and, given an S3 client,
+    uploads the summary and the span trace under metrics/{tid}/. Returns the summary.
+    """
+    global _current
+    recorder, _current = _current, None
+    if recorder is None:
+        return None
+
+    summary = recorder.summary()
+    print(json.dumps({"metrics": summary}))
+    if s3 is not None:
+        trace = "".join(json.dumps(event) + "\n" for event in recorder.events)
+        s3.put_object(Bucket=bucket, Key=recorder.key("json"), Body=json.dumps(summary).encode("utf-8"),
+                      ContentType="application/json")
+        s3.put_object(Bucket=bucket, Key=recorder.key("jsonl"), Body=trace.encode("utf-8"),
+                      ContentType="application/x-ndjson")
+    return summary
+
+
+def _count_s3_request(model, **kwargs):
+    recorder = _current
+    if recorder is not None:
+        recorder.count("s3_requests")
+        recorder.count(f"s3_requests.{model.name}")
+
+
+def watch_s3(client):
+    """Counts the requests of a boto3 S3 client (no hook when metrics are disabled)."""
+    if METRICS_ENABLED:
+        client.meta.events.register("before-parameter-build.s3", _count_s3_request)
+    return client
@@ -1,26 +1,32 @@
 from datetime import datetime
 import os
+import fcntl
 
 def ID_Gen(file_path):
     
     """Reads, increments, and updates a counter from a file, returning it with this mask: NNNNNN-YYYY-MM-DD """
     
-    try:
-        # Read the current counter value
-        with open(file_path, "r") as file:
-            counter = int(file.read())
-    except (FileNotFoundError, ValueError):
-        # If file doesn't exist or is empty, start from 0
-        counter = 0
+    # Exclusive lock around read-increment-write so concurrent processes never share a counter value
+    with open(file_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
 
-    # Increment counter
-    counter += 1
+        try:
+            # Read the current counter value
+            with open(file_path, "r") as file:
+                counter = int(file.read())
+        except (FileNotFoundError, ValueError):
+            # If file doesn't exist or is empty, start from 0
+            counter = 0
 
-    # Write updated counter back to file
-    with open(file_path, "w") as file:
-        file.write(str(counter))
+        # Increment counter
+        counter += 1
+
+        # Write updated counter back to file (atomic replace, readers never see a partial write)
+        with open(file_path + ".tmp", "w") as file:
+            file.write(str(counter))
+        os.replace(file_path + ".tmp", file_path)
 
     # current date using YYYY-MM-DD mask
     current_date = datetime.now().strftime("%Y-%m-%d")
     
-    return f"{counter:06d}-" + current_date
+    return f"{counter % 10**6:06d}-" + current_date
@@ -0,0 +1,401 @@
+#
+# Performance regression suite of the pipeline's hot functions, on synthetic scenes.
+#
+# Each AOI size (default 5, 20 and 50 km, 10 m pixels like the S2-16D-2 bands) gets a
+# seeded synthetic scene: a temporal stack of masked 4-band items (clouds, nodata and
+# bright "plant" rectangles over a smooth background) and the matching plant masks.
+# On CPU, the benchmarks time:
+#
+#   median      compositing.compute_median_band (one band's temporal stack)
+#   tiling      the acquisition tiling loop: compositing.extract_tile and encode_tile
+#               every 256 px tile of the 4 median bands
+#   upscale     Image_Enhancement.upscale_image of every tile
+#   inference   batched inference of every upscaled tile on a tiny U-Net
+#               (segmentation_models_pytorch, random weights)
+#   mosaic      report.normalize_tile + report.place_tile of every tile pair
+#   statistics  postprocess.remove_small_components + cell_stats.cell_statistics
+#
+# Each benchmark runs --repeats times and keeps the best time. A run is compared with
+# the median of the last BASELINE_RUNS runs of the same machine in a JSON history
+# (timestamp, git commit, machine fingerprint, seconds per benchmark@size): a benchmark
+# slower than that by more than --threshold (relative) and MIN_REGRESSION_SECONDS
+# (absolute) is a regression, and the script exits with 1. Only --record appends the
+# run to the history, which is local to the machine (git-ignored).
+# Benchmarks whose modules are not installed (e.g. torch) are skipped.
+#
+#   python tests/benchmark.py                          # every benchmark, 5/20/50 km
+#   python tests/benchmark.py --sizes 5 --bench median upscale --record
+#
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+
+import numpy as np
+import numpy.ma as ma
+
+# Stage modules from the source tree (the acquisition and enhancement stages create
+# their boto3 clients at import: no request is sent, but a region must be set)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+for stage_dir in ("acquisition", "enhancement", "report", "utils"):
+    sys.path.append(os.path.join(SRC_DIR, stage_dir))
+
+import metrics
+
+HISTORY_FILE = os.path.join(TESTS_DIR, "benchmark_history.json")
+SIZES_KM = [5, 20, 50]
+PIXEL_M = 10            # S2-16D-2 band resolution
+TILE_PIXELS = 256       # compositing.sub_image_pixels
+SCALE_FACTOR = 2        # Image_Enhancement.SCALE_FACTOR
+STACK_DEPTH = 4         # 16-day composites over the default two-month range
+NODATA = -9999.0
+MIN_PLANT_AREA_M2 = 1000
+INFERENCE_BATCH = 8
+ENHANCED_POOL = 16
+BASELINE_RUNS = 5
+REGRESSION_THRESHOLD = 0.20
+MIN_REGRESSION_SECONDS = 0.05
+SEED = 0
+
+
+class Skip(Exception):
+    """A benchmark that cannot run here (missing module)."""
+
+
+# ------------------------------------------------------------------ synthetic scenes
+
+class Scene:
+    """Synthetic AOI of `size_km` x `size_km`, built lazily (seeded, so reproducible)."""
+
+    def __init__(self, size_km, seed=SEED):
+        from rasterio import Affine
+        from rasterio.crs import CRS
+
+        self.size_km = size_km
+        self.pixels = int(size_km * 1000 / PIXEL_M)
+        # Tile grid of the acquisition Lambda (int() + 1 tiles per side)
+        self.grid_shape = (self.pixels // TILE_PIXELS + 1, self.pixels // TILE_PIXELS + 1)
+        self.extent = self.grid_shape[0] * TILE_PIXELS
+        self.transform = Affine(PIXEL_M, 0, 500000, 0, -PIXEL_M, 7500000)
+        self.crs = CRS.from_epsg(32723)
+        self.seed = seed
+        self._cache = {}
+
+    def rng(self, *stream):
+        # One generator per array, so every array is the same whatever the benchmark order
+        return np.random.default_rng([self.seed, int(self.size_km * 1000), *stream])
+
+    def _cached(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    def plants(self):
+        """Boolean plant map of the extent: rectangles of 30-400 m per side plus speckle."""
+        def build():
+            rng = self.rng(0)
+            plant_map = np.zeros((self.extent, self.extent), dtype=bool)
+            count = max(self.extent * self.extent // 40000, 1)
+            rows, cols = rng.integers(0, self.extent - 40, (2, count))
+            heights, widths = rng.integers(3, 40, (2, count))
+            for row, col, height, width in zip(rows, cols, heights, widths):
+                plant_map[row:row + height, col:col + width] = True
+            plant_map |= rng.random(plant_map.shape) < 0.0005
+            return plant_map
+        return self._cached("plants", build)
+
+    def band_stack(self, band):
+        """Temporal stack (list of masked float32 arrays) of one band, like read_multiple_items."""
+        def build():
+            rng = self.rng(1, band)
+            coarse = rng.normal(1500, 400, (self.extent // 64 + 1, self.extent // 64 + 1)).astype(np.float32)
+            background = np.kron(coarse, np.ones((64, 64), dtype=np.float32))[:self.extent, :self.extent]
+            background[self.plants()] = 3500 if band == 2 else 600  # bright in blue, dark elsewhere
+            items = []
+            for _ in range(STACK_DEPTH):
+                data = background + rng.normal(0, 50, background.shape).astype(np.float32)
+                cloud_row, cloud_col = rng.integers(0, self.extent, 2)
+                cloud = (slice(cloud_row, cloud_row + self.extent // 4), slice(cloud_col, cloud_col + self.extent // 4))
+                data[cloud] = 9000
+                mask = np.zeros(data.shape, dtype=bool)
+                mask[cloud] = True
+                mask[:, :self.extent // 50] = True  # nodata edge
+                items.append(ma.masked_array(data, mask=mask))
+            return items
+        return self._cached(f"band{band}", build)
+
+    def medians(self):
+        """Filled float32 median bands (the tiling loop's input)."""
+        def build():
+            medians = []
+            for band in range(4):
+                medians.append(ma.median(ma.stack(self.band_stack(band), axis=0), axis=0).filled(NODATA).astype(np.float32))
+                self.drop(f"band{band}")
+            return medians
+        return self._cached("medians", build)
+
+    def tiles(self):
+        """[(row, col, (4, 256, 256) float32 tile)] of the tile grid."""
+        def build():
+            medians = self.medians()
+            return [(i, j, np.stack([m[i * TILE_PIXELS:(i + 1) * TILE_PIXELS, j * TILE_PIXELS:(j + 1) * TILE_PIXELS] for m in medians]))
+                    for i in range(self.grid_shape[0]) for j in range(self.grid_shape[1])]
+        return self._cached("tiles", build)
+
+    def enhanced_tiles(self):
+        """
+        Tiles upscaled by SCALE_FACTOR (nearest neighbour: same shape as upscale_image,
+        cheaper). Only the first ENHANCED_POOL tiles are upscaled and the grid reuses
+        them, which keeps a 50 km scene in memory; timings do not depend on the pixels.
+        """
+        def build():
+            pool = [tile.repeat(SCALE_FACTOR, axis=1).repeat(SCALE_FACTOR, axis=2) for _, _, tile in self.tiles()[:ENHANCED_POOL]]
+            return [(i, j, pool[n % len(pool)]) for n, (i, j, _) in enumerate(self.tiles())]
+        return self._cached("enhanced", build)
+
+    def masks(self):
+        """0/1 uint8 prediction mask of every enhanced tile (the plant map)."""
+        def build():
+            plants = self.plants().repeat(SCALE_FACTOR, axis=0).repeat(SCALE_FACTOR, axis=1).astype(np.uint8)
+            size = TILE_PIXELS * SCALE_FACTOR
+            return [plants[i * size:(i + 1) * size, j * size:(j + 1) * size] for i, j, _ in self.tiles()]
+        return self._cached("masks", build)
+
+    def tile_transform(self, row, col, scale=1):
+        from rasterio import Affine
+        return self.transform * Affine.translation(col * TILE_PIXELS, row * TILE_PIXELS) * Affine.scale(1 / scale)
+
+    def drop(self, *names):
+        for name in names:
+            self._cache.pop(name, None)
+
+
+# ------------------------------------------------------------------ benchmarks
+
+def _import(module):
+    try:
+        return __import__(module)
+    except ImportError as e:
+        raise Skip(f"{module} not importable ({e})")
+
+
+def bench_median(scene):
+    compositing = _import("compositing")
+    stack = scene.band_stack(0)
+    return lambda: compositing.compute_median_band(stack)
+
+
+def bench_tiling(scene):
+    compositing = _import("compositing")
+    medians = scene.medians()
+    rows, cols = scene.grid_shape
+
+    def run():
+        for j in range(cols):
+            for i in range(rows):
+                stacked_tile = compositing.extract_tile(medians, i * TILE_PIXELS, j * TILE_PIXELS, NODATA)
+                compositing.encode_tile(stacked_tile, scene.crs, scene.tile_transform(i, j), NODATA)
+    return run
+
+
+def bench_upscale(scene):
+    Image_Enhancement = _import("Image_Enhancement")
+    tiles = scene.tiles()
+
+    def run():
+        for i, j, tile in tiles:
+            metadata = {"height": tile.shape[1], "width": tile.shape[2], "transform": scene.tile_transform(i, j)}
+            Image_Enhancement.upscale_image(tile, metadata, SCALE_FACTOR)
+    return run
+
+
+def bench_inference(scene):
+    torch = _import("torch")
+    smp = _import("segmentation_models_pytorch")
+    torch.manual_seed(SEED)
+    # Same architecture family as the prediction stage (4 bands in, sigmoid out), tiny encoder
+    model = smp.Unet(encoder_name="resnet18", encoder_depth=3, decoder_channels=(32, 16, 8),
+                     encoder_weights=None, in_channels=4, classes=1, activation="sigmoid").eval()
+    tiles = [tile for _, _, tile in scene.enhanced_tiles()]
+
+    def run():
+        with torch.no_grad():
+            for start in range(0, len(tiles), INFERENCE_BATCH):
+                model(torch.from_numpy(np.stack(tiles[start:start + INFERENCE_BATCH])))
+    return run
+
+
+def bench_mosaic(scene):
+    report = _import("report")
+    tiles = scene.enhanced_tiles()
+    masks = scene.masks()
+
+    def run():
+        rgb_tiles = [np.moveaxis(tile[:3], 0, -1) for _, _, tile in tiles]
+        min_val = min(float(rgb.min()) for rgb in rgb_tiles)
+        max_val = max(float(rgb.max()) for rgb in rgb_tiles)
+        canvas = {}
+        for (i, j, _), rgb, mask in zip(tiles, rgb_tiles, masks):
+            report.place_tile(canvas, scene.grid_shape, i, j, report.normalize_tile(rgb, min_val, max_val), mask,
+                              scene.tile_transform(i, j, SCALE_FACTOR), scene.crs)
+        return canvas
+    return run
+
+
+def bench_statistics(scene):
+    postprocess = _import("postprocess")
+    cell_stats = _import("cell_stats")
+    canvas = bench_mosaic(scene)()
+    scene.drop("enhanced")
+    tile_shape = (TILE_PIXELS * SCALE_FACTOR, TILE_PIXELS * SCALE_FACTOR)
+
+    def run():
+        prediction_mosaic = canvas["prediction"].copy()  # filtered in place
+        plants = postprocess.remove_small_components(prediction_mosaic, tile_shape[0], canvas["transform"], canvas["crs"],
+                                                     MIN_PLANT_AREA_M2, cell_shape=tile_shape)
+        cell_stats.cell_statistics(prediction_mosaic, scene.grid_shape, canvas["transform"], plants)
+    return run
+
+
+BENCHMARKS = {
+    "median": bench_median,
+    "tiling": bench_tiling,
+    "upscale": bench_upscale,
+    "inference": bench_inference,
+    "mosaic": bench_mosaic,
+    "statistics": bench_statistics,
+}
+
+
+def time_benchmark(run, repeats):
+    """Best and median wall time of `repeats` runs (stage prints silenced)."""
+    times = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    return {"seconds": round(min(times), 4), "median_seconds": round(float(np.median(times)), 4), "repeats": repeats}
+
+
+def run_benchmarks(names, sizes, repeats):
+    results, skipped = {}, {}
+    for size_km in sizes:
+        scene = Scene(size_km)
+        print(f"--- {size_km} km: {scene.pixels} x {scene.pixels} px, {scene.grid_shape[0]} x {scene.grid_shape[1]} tiles")
+        for name in names:
+            key = f"{name}@{size_km}km"
+            try:
+                run = BENCHMARKS[name](scene)
+            except Skip as e:
+                skipped[key] = str(e)
+                print(f"{key:<24} skipped: {e}")
+                continue
+            results[key] = time_benchmark(run, repeats)
+            print(f"{key:<24} {results[key]['seconds']:9.3f} s")
+        del scene
+    return results, skipped
+
+
+# ------------------------------------------------------------------ history
+
+def machine_fingerprint():
+    """Runs are only compared with runs of the same machine and software stack."""
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    except OSError:
+        pass
+    return {
+        "cpu": cpu,
+        "cpu_count": os.cpu_count(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=TESTS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def baseline(history, machine, key, runs=BASELINE_RUNS):
+    """Median time of `key` over the last `runs` runs of `machine` (None without any)."""
+    times = [run["results"][key]["seconds"] for run in history if run["machine"] == machine and key in run["results"]]
+    return float(np.median(times[-runs:])) if times else None
+
+
+def find_regressions(history, run, threshold, min_seconds):
+    regressions = []
+    for key, result in run["results"].items():
+        reference = baseline(history, run["machine"], key)
+        if reference is None:
+            continue
+        change = (result["seconds"] - reference) / reference if reference else 0.0
+        if change > threshold and result["seconds"] - reference > min_seconds:
+            regressions.append({"benchmark": key, "seconds": result["seconds"], "baseline": round(reference, 4), "change": round(change, 3)})
+        print(f"{key:<24} {result['seconds']:9.3f} s  baseline {reference:9.3f} s  {change:+7.1%}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Performance regression suite of the pipeline's hot functions on synthetic scenes.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=SIZES_KM, help="AOI sizes (km per side)")
+    parser.add_argument("--bench", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Relative slowdown flagged as a regression")
+    parser.add_argument("--min-seconds", type=float, default=MIN_REGRESSION_SECONDS, help="Absolute slowdown below which nothing is flagged")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--record", action="store_true", help="Append this run to the history (default: only compare)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) if float(size).is_integer() else size for size in args.sizes]
+    results, skipped = run_benchmarks(args.bench, sizes, args.repeats)
+
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "machine": machine_fingerprint(),
+        "seed": SEED,
+        "results": results,
+        "skipped": skipped,
+        "peak_rss_mb": round(metrics.peak_rss_mb(), 1),
+    }
+    history = load_history(args.history)
+    print("--- comparison with the history")
+    run["regressions"] = find_regressions(history, run, args.threshold, args.min_seconds)
+
+    if args.record:
+        history.append(run)
+        with open(args.history, "w") as f:
+            json.dump(history, f, indent=1)
+        print(f"Recorded run {len(history)} in {args.history}")
+
+    for regression in run["regressions"]:
+        print(f"REGRESSION {regression['benchmark']}: {regression['seconds']:.3f} s vs {regression['baseline']:.3f} s ({regression['change']:+.1%})")
+    return 1 if run["regressions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())